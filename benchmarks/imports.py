@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+'''
+Import time budget: every module (and the startup of the command line interface) is timed in fresh interpreters, the
+best of repeat runs is compared with its budget and the script exits with status 1 if any of them is over budget,
+so a heavy import added at module level (NLTK, scikit-learn, pandas, the Elasticsearch client...) is caught.
+The budgets are about twice the times measured when they were set, use --scale on slower machines.
+
+	python3 benchmarks/imports.py [--repeat 5] [--scale 1] [--importtime cli]
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.utils import *
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# budget of each target in milliseconds
+BUDGETS = {
+	'cli': 20,
+	'cli --help': 40,
+	'utils.utils': 25,
+	'utils.instrument': 40,
+	'indexer': 60,
+	'search': 60,
+	'demo': 60,
+	'pipeline': 60,
+	'bm25': 160,
+	'frequency': 140,
+	'store': 450,
+	'preprocessor': 450,
+	'service': 600,
+}
+
+TIMED_IMPORT = "import time; start = time.perf_counter(); import %s; print(time.perf_counter() - start)"
+TIMED_MAIN = ("import sys, time, runpy; start = time.perf_counter(); sys.argv = %r\n"
+	"try: runpy.run_path(sys.argv[0], run_name='__main__')\n"
+	"except SystemExit: pass\n"
+	"print(time.perf_counter() - start, file=sys.stderr)")
+
+
+def time_target(target):
+	'''
+	Time a target in a fresh interpreter: the import of a module or, for a target with arguments (e.g. 'cli --help'),
+	the run of the script with them.
+	:param target: module name, optionally followed by the arguments of the script;
+	:return: elapsed seconds
+	'''
+	module, *argv = target.split()
+	if argv:
+		script = os.path.join(*module.split('.')) + '.py'
+		code = TIMED_MAIN % ([script] + argv)
+	else:
+		code = TIMED_IMPORT % module
+	proc = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+	return float((proc.stderr if argv else proc.stdout).strip().splitlines()[-1])
+
+
+def importtime(module):
+	'''
+	Print the imports of a module taking the longest (cumulative) time, from python -X importtime.
+	'''
+	proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=ROOT,
+		capture_output=True, text=True)
+	rows = []
+	for line in proc.stderr.splitlines():
+		if line.startswith('import time:') and '|' in line:
+			_, cumulative, name = line[len('import time:'):].split('|')
+			if cumulative.strip().isdigit():
+				rows.append((int(cumulative), name.rstrip()))
+	for cumulative, name in sorted(rows, reverse=True)[:20]:
+		print("  %8.1f ms %s" % (cumulative / 1000, name))
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Import time budget of the modules")
+	parser.add_argument('--repeat', type=int, default=5, help="fresh interpreters timed for each target")
+	parser.add_argument('--scale', type=float, default=1, help="multiplier of the budgets")
+	parser.add_argument('--importtime', metavar='MODULE', default=None,
+		help="print the slowest imports of a module instead")
+	args = parser.parse_args()
+
+	if args.importtime:
+		importtime(args.importtime)
+		sys.exit(0)
+
+	over = 0
+	for target, budget in BUDGETS.items():
+		best = min(time_target(target) for _ in range(args.repeat)) * 1000
+		ok = best <= budget * args.scale
+		over += not ok
+		print("  %-18s %s  budget %6.0f ms" % (target, (g if ok else r)("%8.1f ms" % best), budget * args.scale))
+
+	if over:
+		pprint(r("%d targets over budget" % over))
+	else:
+		pprint(g("All the imports within budget"))
+	sys.exit(1 if over else 0)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+'''
+Benchmark suite of the ingest, profile and re-rank hot paths on synthetic corpora (see benchmarks/synthetic.py) of
+scale × the size of the bundled users datasets: the users corpus has scale × the seed users, each with about the same
+number of tweets of the seed ones, the news corpus has scale × the seed tweets.
+For every scale each stage is timed repeat times (best and mean wall time) and then run once more under tracemalloc
+for its peak memory; the results are written in a JSON file, which can be compared with the one of another commit.
+Elasticsearch is replaced by local stubs: indexDocuments sends its bulk requests to a client that only acknowledges
+them and the searches are served by the embedded BM25 index.
+
+	python3 benchmarks/suite.py [--scale 1 10] [--repeat 3] [--queries 20] [--out ./benchmarks/results.json]
+		[--compare previous.json] [--no-memory]
+'''
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import bm25
+from benchmarks.synthetic import TweetGenerator
+from preprocessor import Preprocessor
+from store import ProfileStore, save_store
+from search import msearch
+from utils.utils import *
+
+CONFIG_PATH = './utils/index_config.json'
+
+
+class StubSerializer:
+	def dumps(self, data):
+		return data if isinstance(data, str) else json.dumps(data)
+
+
+class StubIndices:
+	'''
+	Indices API of the stub client: the index settings and the aliases are kept in memory.
+	'''
+
+	def __init__(self):
+		self.settings = {}
+		self.aliases = {}
+
+	def create(self, index, body=None):
+		self.settings[index] = {'settings': {'index': {'number_of_replicas': '0', 'refresh_interval': None}}}
+
+	def exists(self, index):
+		return index in self.settings
+
+	def exists_alias(self, name):
+		return bool(self.aliases.get(name))
+
+	def get_alias(self, name):
+		return {index: {'aliases': {name: {}}} for index in self.aliases.get(name, ())}
+
+	def update_aliases(self, body):
+		for action in body['actions']:
+			(op, params), = action.items()
+			if op == 'add':
+				self.aliases.setdefault(params['alias'], set()).add(params['index'])
+			elif op == 'remove':
+				self.aliases.get(params['alias'], set()).discard(params['index'])
+			elif op == 'remove_index':
+				self.settings.pop(params['index'], None)
+
+	def delete(self, index):
+		self.settings.pop(index, None)
+
+	def get_settings(self, index):
+		return {index: self.settings[index]}
+
+	def put_settings(self, index, body):
+		pass
+
+	def refresh(self, index):
+		pass
+
+	def forcemerge(self, index, **kwargs):
+		pass
+
+
+class StubElasticsearch:
+	'''
+	Elasticsearch client stub for indexDocuments: the bulk requests are parsed and acknowledged, so the stage measures
+	the client side of the ingest (reading, fingerprinting, serialization and chunking of the documents).
+	'''
+
+	def __init__(self, *args, **kwargs):
+		self.indices = StubIndices()
+		self.transport = type('Transport', (), {'serializer': StubSerializer()})()
+		self.documents = 0
+
+	def bulk(self, body, *args, **kwargs):
+		lines = body.splitlines()
+		items = [{'index': {'_id': json.loads(action)['index'].get('_id'), 'status': 201}} for action in lines[::2]]
+		self.documents += len(items)
+		return {'errors': False, 'items': items}
+
+
+def measure(run, repeat=1, memory=True):
+	'''
+	Time repeat runs of a stage, then run it once more tracing its peak memory.
+	:param run: function running the stage;
+	:param repeat: number of timed runs;
+	:param memory: trace the peak memory of the stage;
+	:return: the result of the last run, the best and the mean wall time and the peak memory in bytes (None if not
+		traced)
+	'''
+	times = []
+	for _ in range(repeat):
+		gc.collect()
+		start = time.perf_counter()
+		result = run()
+		times.append(time.perf_counter() - start)
+
+	peak = None
+	if memory:
+		gc.collect()
+		tracemalloc.start()
+		try:
+			run()
+			peak = tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+
+	return result, min(times), sum(times) / len(times), peak
+
+
+def random_queries(generator, n, seed=0):
+	'''
+	Match queries of 2 to 4 words sampled from the tokens of the seed tweets.
+	'''
+	rand = random.Random(seed)
+	words = [t for user in generator.seed_users.values() for t in user['tokens'] if t.isalpha() and len(t) > 3]
+	return [{'match': {'text': ' '.join(rand.choices(words, k=rand.randint(2, 4)))}} for _ in range(n)]
+
+
+def bench_scale(scale, workdir, args):
+	'''
+	Run all the stages on the corpora of a scale.
+	:return: list with the measures of each stage
+	'''
+	generator = TweetGenerator(seed=0)
+	n_users = max(1, int(round(len(generator.seed_users) * scale)))
+	users_file = os.path.join(workdir, 'users-%g.jsonl' % scale)
+	news_file = os.path.join(workdir, 'news-%g.jsonl' % scale)
+	n_tweets = int(generator.size * scale)
+	generator.write(users_file, n_tweets, n_users)
+	TweetGenerator(seed=1).write(news_file, n_tweets, first_id=2 * 10 ** 18)
+	queries = random_queries(generator, args.queries)
+	pprint("Scale %s: %d users tweets of %d users, %d news" % (y(scale), n_tweets, n_users, n_tweets))
+
+	results = []
+
+	def stage(name, items, run, repeat=args.repeat):
+		result, best, mean, peak = measure(run, repeat, not args.no_memory)
+		results.append({
+			'scale': scale, 'stage': name, 'items': items, 'seconds': best, 'mean_seconds': mean,
+			'items_per_sec': items / best if best > 0 else None,
+			'peak_mb': None if peak is None else peak / 2 ** 20
+		})
+		print("  %-22s %s items/sec  %s" % (name, g("%12.1f" % (items / best if best > 0 else 0)),
+			y("%.3fs" % best) + ("" if peak is None else "  peak %.1f MB" % (peak / 2 ** 20))))
+		return result
+
+	def preprocessor():
+		return Preprocessor([users_file], tagger=args.tagger, workers=args.workers, n_features=args.n_features)
+
+	texts = [tweet['text'] for _, (_, tweet) in zip(range(args.sample), iter_tweets(users_file))]
+	p = preprocessor()
+	stage('filter', len(texts), lambda: [p.filter(text) for text in texts])
+
+	def parse():
+		parsed = preprocessor()
+		parsed.parser()
+		return parsed
+	p = stage('parser', n_tweets, parse)
+
+	profiles = stage('build_profiles', n_users, p.build_profiles)
+	p.set_profiles(profiles)
+
+	store_path = os.path.join(workdir, 'profiles-%g.store' % scale)
+	stage('save_store', n_tweets, lambda: save_store(store_path, p.tweets, profiles))
+	stage('load_store', n_tweets, lambda: ProfileStore(store_path).load())
+
+	import indexer
+	indexer.MANIFEST_DIR = os.path.join(workdir, 'index-manifest') + os.sep
+	stage('indexDocuments', n_tweets,
+		lambda: indexer.indexDocuments(news_file, CONFIG_PATH, 'bench', es=StubElasticsearch()))
+
+	client = bm25.Client()
+	stage('bm25_index', n_tweets, lambda: client.load(news_file, 'bench'))
+	responses = stage('search', len(queries), lambda: msearch(client, 'bench', queries, args.size))
+
+	news = [hit for res in responses for hit in res['hits']['hits']]
+	cnews = [text for text, mentions in p.analyze_news(news)]
+	stage('get_similarity_score', len(news), lambda: p.get_similarity_score(profiles['text'], None, cnews))
+
+	def personalize():
+		p.news_cache.clear()
+		return [p.personalize_query(res, []) for res in responses]
+	stage('personalize_query', len(responses), personalize)
+
+	return results
+
+
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+			check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def compare(results, previous):
+	'''
+	Print the ratio between the best times of the stages and the ones of a previous results file.
+	'''
+	with open(previous, encoding='utf-8') as f:
+		before = {(m['scale'], m['stage']): m for m in json.load(f)['results']}
+	pprint("Comparison with " + y(previous))
+	for m in results:
+		old = before.get((m['scale'], m['stage']))
+		if old and m['seconds']:
+			ratio = old['seconds'] / m['seconds']
+			print("  scale %-6s %-22s %s" % (m['scale'], m['stage'], (g if ratio >= 1 else r)("%.2fx" % ratio)))
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Benchmark suite of the pre-processing, indexing and re-rank stages")
+	parser.add_argument('--scale', type=float, nargs='+', default=[1, 10], help="corpus sizes, relative to the seed")
+	parser.add_argument('--repeat', type=int, default=3, help="timed runs of each stage")
+	parser.add_argument('--queries', type=int, default=20, help="number of search queries")
+	parser.add_argument('--size', type=int, default=100, help="results of each query to be re-ranked")
+	parser.add_argument('--sample', type=int, default=1000, help="tweets passed to Preprocessor.filter")
+	parser.add_argument('--tagger', default='perceptron')
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--n-features', type=int, default=None)
+	parser.add_argument('--no-memory', action='store_true', help="skip the peak memory measures")
+	parser.add_argument('--out', default='./benchmarks/results.json', help="results file")
+	parser.add_argument('--compare', default=None, help="previous results file to compare with")
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix='bench-')
+	try:
+		results = []
+		for scale in args.scale:
+			results.extend(bench_scale(scale, workdir, args))
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+
+	with open(args.out, 'w', encoding='utf-8') as o:
+		json.dump({
+			'meta': {
+				'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+				'numpy': np.__version__, 'platform': platform.platform(), 'args': vars(args)
+			},
+			'results': results
+		}, o, indent=1)
+	pprint(g("Results written in " + args.out))
+	if args.compare:
+		compare(results, args.compare)
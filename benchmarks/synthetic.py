@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+'''
+Synthetic tweets generator modeled on the bundled users datasets: every synthetic user takes the names, the tweets
+length distribution, the dates range and the tokens (words, mentions, hashtags, links and emojis, with their
+frequencies) of a seed user, so the corpus keeps the vocabulary and the skew of the real tweets at any size.
+The tweets are written as a stream, so corpora of 10× to 1000× the seed size don't need to fit in memory.
+
+	python3 benchmarks/synthetic.py --scale 10 [--users 60] [--seed 0] [--out ./benchmarks/data/synthetic-10.jsonl]
+'''
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.utils import *
+
+SEED_FILES = ["./datasets/group_one.json", "./datasets/group_two.json"]
+DATE_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+
+
+class TweetGenerator:
+	'''
+	Generator of synthetic tweets in the format of the scraper.
+	:param files: seed tweets files;
+	:param seed: seed of the random generator, the same seed produces the same tweets;
+	'''
+
+	def __init__(self, files=SEED_FILES, seed=0):
+		self.random = random.Random(seed)
+		self.seed_users = {}
+		self.size = 0
+		for file in files:
+			for tweet_id, tweet in iter_tweets(file):
+				user = self.seed_users.setdefault(tweet['user_name'], {
+					'screen_name': tweet['screen_name'], 'tokens': [], 'lengths': [], 'dates': []})
+				tokens = tweet['text'].split()
+				user['tokens'].extend(tokens)
+				user['lengths'].append(len(tokens))
+				user['dates'].append(datetime.strptime(tweet['date'], DATE_FORMAT).timestamp())
+				self.size += 1
+		for user in self.seed_users.values():
+			user['dates'] = (min(user['dates']), max(user['dates']))
+
+	def users(self, n=None):
+		'''
+		Synthetic users: the seed users, then their copies numbered from 2 (same tokens, different names).
+		:param n: number of users (default is the number of seed users);
+		:return: list of (user_name, screen_name, seed user) tuples
+		'''
+		seeds = list(self.seed_users.items())
+		n = n or len(seeds)
+		users = []
+		for i in range(n):
+			name, seed = seeds[i % len(seeds)]
+			copy = i // len(seeds) + 1
+			suffix = '' if copy == 1 else ' %d' % copy
+			users.append((name + suffix, seed['screen_name'] + suffix.strip(), seed))
+		return users
+
+	def tweets(self, n, users=None, first_id=10 ** 18):
+		'''
+		Yield n synthetic tweets, assigned to the users in turn.
+		:param n: number of tweets;
+		:param users: number of users (default is the number of seed users);
+		:param first_id: id of the first tweet, the following ones are consecutive;
+		:return: generator of the (tweet_id, tweet) pairs
+		'''
+		rand = self.random
+		users = self.users(users)
+		for i in range(n):
+			name, screen_name, seed = users[i % len(users)]
+			tokens = rand.choices(seed['tokens'], k=max(1, rand.choice(seed['lengths'])))
+			hashtags = [re.sub(r'\W+$', '', t[1:]) for t in tokens if t.startswith('#') and len(t) > 1]
+			date = datetime.fromtimestamp(rand.uniform(*seed['dates']), timezone.utc)
+			tweet_id = str(first_id + i)
+			yield tweet_id, {
+				'user_name': name,
+				'screen_name': screen_name,
+				'date': date.strftime(DATE_FORMAT),
+				'tweet_id': tweet_id,
+				'text': ' '.join(tokens),
+				'hashtags': hashtags or [None]
+			}
+
+	def write(self, out, n, users=None, first_id=10 ** 18):
+		'''
+		Write n synthetic tweets in a JSON lines (.jsonl) file or in a JSON file with the tweets ids as keys.
+		:return: the number of users
+		'''
+		os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+		with open(out, 'w', encoding='utf-8') as o:
+			if out.endswith('.jsonl'):
+				for tweet_id, tweet in self.tweets(n, users, first_id):
+					o.write(json.dumps(tweet) + '\n')
+			else:
+				o.write('{')
+				for i, (tweet_id, tweet) in enumerate(self.tweets(n, users, first_id)):
+					o.write((',\n' if i else '\n') + json.dumps(tweet_id) + ': ' + json.dumps(tweet))
+				o.write('\n}')
+		return len(self.users(users))
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Synthetic tweets generator")
+	parser.add_argument('--scale', type=float, default=10, help="size of the corpus, relative to the seed datasets")
+	parser.add_argument('--users', type=int, default=None, help="number of users (default is the seed users)")
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--out', default=None, help="output file, .jsonl for JSON lines")
+	args = parser.parse_args()
+
+	generator = TweetGenerator(seed=args.seed)
+	n = int(generator.size * args.scale)
+	out = args.out or './benchmarks/data/synthetic-%g.jsonl' % args.scale
+	users = generator.write(out, n, args.users)
+	pprint(g("%d tweets of %d users written in %s" % (n, users, out)))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+'''
+POS tagging strategies benchmark: for each Preprocessor tagger strategy ('perceptron', 'lexicon', 'none') reports on 
+the bundled datasets the tagging + normalization time and the quality delta against the 'perceptron' strategy, as 
+the fraction of tweets with the same normalized tokens and the mean Jaccard similarity of their tokens.
+The lexicon is built from the same datasets before timing.
+
+	python3 benchmarks/tagging.py [dataset.json ...]
+'''
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocessor import Preprocessor, TAGGERS
+from utils.utils import *
+
+
+def jaccard(a, b):
+	a, b = set(a), set(b)
+	return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def bench(files):
+	sentences = []
+	extractor = Preprocessor(files)
+	for file in files:
+		for tweet in json.load(open(file)).values():
+			sentences.append(extractor.extract_entities(tweet['text'])[0])
+	lexicon = extractor.build_lexicon(sentences)
+	pprint("%d tweets, %d words in the lexicon" % (len(sentences), len(lexicon)))
+
+	results = {}
+	for tagger in TAGGERS:
+		p = Preprocessor(files, tagger=tagger)
+		p.lexicon = lexicon
+		start = time.perf_counter()
+		results[tagger] = [p.normalize(t) for t in p.tag(sentences)]
+		elapsed = time.perf_counter() - start
+
+		reference = results['perceptron']
+		same = sum(a == b for a, b in zip(reference, results[tagger])) / len(sentences)
+		similarity = sum(jaccard(a, b) for a, b in zip(reference, results[tagger])) / len(sentences)
+		print("%-10s %s tweets/sec  same tokens: %s  mean jaccard: %s" % (
+			tagger, y("%8.0f" % (len(sentences) / elapsed)), g("%.4f" % same), g("%.4f" % similarity)))
+
+
+if __name__ == "__main__":
+	bench(sys.argv[1:] or ["./datasets/group_one.json", "./datasets/group_two.json"])
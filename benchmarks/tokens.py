@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+'''
+Token normalization benchmark: compares on the bundled datasets the tokens/sec of the previous normalization loop 
+(in place list.remove/append, stopwords list, no stemming cache) with Preprocessor.normalize.
+The POS tagging is executed once before timing, since it's the same for both the implementations.
+
+	python3 benchmarks/tokens.py [dataset.json ...]
+'''
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nltk
+from nltk.stem.porter import PorterStemmer
+from preprocessor import Preprocessor, stem
+from utils.utils import *
+
+
+def legacy_normalize(tagged, new_text, porter, stop_words, functional_words):
+	# previous preprocess_text loop
+	for word in tagged:
+		if word[0] in stop_words or word[1] in functional_words:
+			new_text.remove(word[0])
+		else:
+			new_text.remove(word[0])
+			new_text.append(porter.stem(word[0]))
+	return new_text
+
+
+def bench(files):
+	p = Preprocessor(files)
+	tagged = []
+	for file in files:
+		for tweet in json.load(open(file)).values():
+			tagged.append(nltk.pos_tag(p.extract_entities(tweet['text'])[0]))
+	n_tokens = sum(len(t) for t in tagged)
+
+	porter = PorterStemmer()
+	stop_words = list(p.stop_words)
+	functional_words = list(p.functional_words)
+	start = time.perf_counter()
+	for t in tagged:
+		legacy_normalize(t, [word for word, tag in t], porter, stop_words, functional_words)
+	before = time.perf_counter() - start
+
+	stem.cache_clear()
+	start = time.perf_counter()
+	for t in tagged:
+		p.normalize(t)
+	after = time.perf_counter() - start
+
+	pprint("%d tweets, %d tokens" % (len(tagged), n_tokens))
+	print("before: %s tokens/sec" % y("%.0f" % (n_tokens / before)))
+	print("after:  %s tokens/sec" % g("%.0f" % (n_tokens / after)))
+	print("stem cache: %s" % str(stem.cache_info()))
+
+
+if __name__ == "__main__":
+	bench(sys.argv[1:] or ["./datasets/group_one.json", "./datasets/group_two.json"])
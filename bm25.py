@@ -0,0 +1,781 @@
+import json
+import math
+import re
+import time
+from array import array
+from collections import Counter, defaultdict
+from datetime import datetime
+from functools import lru_cache, reduce
+from threading import RLock
+import numpy as np
+from utils.utils import iter_tweets
+
+CONFIG_PATH = './utils/index_config.json'
+SYNONYMS_PATH = './utils/wn_s.pl'
+DATE_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+
+# BM25 parameters (the Elasticsearch defaults) and number of documents of each postings block
+K1 = 1.2
+B = 0.75
+BLOCK = 128
+
+# Lucene _english_ stop words
+ENGLISH_STOPWORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is', 'it', 'no', 'not', 'of',
+    'on', 'or', 'such', 'that', 'the', 'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was', 'will', 'with'
+])
+
+# Char filters of the tweet_analyzer in utils/index_config.json, applied in order
+CHAR_FILTERS = [
+    (re.compile('[—’\\-”“]'), ' '),
+    (re.compile(r'\d+'), ''),
+    (re.compile('[!-/:-@\\[-`{-~]'), ''),
+    (re.compile(r'http\S+'), '')
+]
+TOKEN = re.compile(r'\w+')
+SYNSET = re.compile(r"^s\((\d+),\d+,'((?:[^']|'')*)',")
+
+synonyms = None
+
+
+class IndexNotFound(LookupError):
+    pass
+
+
+@lru_cache(maxsize=None)
+def stemmer():
+    # nltk is imported at the first analysis
+    from nltk.stem import PorterStemmer
+    return PorterStemmer(PorterStemmer.ORIGINAL_ALGORITHM)
+
+
+@lru_cache(maxsize=None)
+def stem(word):
+    return stemmer().stem(word)
+
+
+def tweetAnalyzer(text):
+    """
+    Python version of the tweet_analyzer: symbols, digits, punctuation and links removed, standard tokenization,
+    lowercase, english stop words and porter stemmer.
+    Returns
+    -------
+    list
+        (term, position) pairs, the positions of the stop words are skipped like in Lucene.
+    """
+    for pattern, replacement in CHAR_FILTERS:
+        text = pattern.sub(replacement, text)
+    return [(stem(token), position) for position, token in enumerate(TOKEN.findall(text.lower()))
+            if token not in ENGLISH_STOPWORDS]
+
+
+def standardAnalyzer(text):
+    """
+    Standard tokenization and lowercase, see tweetAnalyzer.
+    """
+    return [(token, position) for position, token in enumerate(TOKEN.findall(text.lower()))]
+
+
+def synonymAnalyzer(text):
+    """
+    Standard tokenization, lowercase and WordNet synonyms, added at the same position of the word, see tweetAnalyzer.
+    """
+    words = loadSynonyms()
+    return [(term, position) for token, position in standardAnalyzer(text) for term in words.get(token, (token,))]
+
+
+def keywordNormalizer(value):
+    return [(value.lower(), 0)]
+
+
+def keywordAnalyzer(value):
+    return [(value, 0)]
+
+
+ANALYZERS = {'tweet_analyzer': tweetAnalyzer, 'standard': standardAnalyzer, 'synonym': synonymAnalyzer}
+
+
+def loadSynonyms(path=SYNONYMS_PATH):
+    """
+    Loads, at the first call, the single word synonyms of the WordNet prolog file used by the synonym analyzer (none if
+    the file is missing). The multi-word synonyms are skipped.
+    Returns
+    -------
+    dict
+        Synonyms of each word (the word included).
+    """
+    global synonyms
+    if synonyms is None:
+        synsets = defaultdict(list)
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    match = SYNSET.match(line)
+                    if match and ' ' not in match.group(2):
+                        synsets[match.group(1)].append(match.group(2).replace("''", "'").lower())
+        except FileNotFoundError:
+            pass
+        words = defaultdict(set)
+        for synset in synsets.values():
+            for word in synset:
+                words[word].update(synset)
+        synonyms = {word: tuple(sorted(synset)) for word, synset in words.items()}
+    return synonyms
+
+
+def parseDate(value):
+    """
+    Parses a date in the format of the tweets (or ISO 8601), numbers are epoch milliseconds like in Elasticsearch.
+    Returns
+    -------
+    float
+        Epoch seconds.
+    """
+    if isinstance(value, (int, float)):
+        return value / 1000
+    try:
+        return datetime.strptime(value, DATE_FORMAT).timestamp()
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def fieldSpec(mapping):
+    """
+    Indexing and scoring of a field from its Elasticsearch mapping (None for the fields only kept in the source).
+    The analyzers and normalizers are the Python versions of the ones in utils/index_config.json.
+    """
+    kind = mapping.get('type')
+    if kind == 'text':
+        analyzer = mapping.get('analyzer', 'standard')
+        search_analyzer = mapping.get('search_analyzer', analyzer)
+        if analyzer not in ANALYZERS or search_analyzer not in ANALYZERS:
+            raise ValueError("Unsupported analyzer %s" % (search_analyzer if analyzer in ANALYZERS else analyzer))
+        return {'type': kind, 'analyzer': ANALYZERS[analyzer], 'search_analyzer': ANALYZERS[search_analyzer],
+                'bm25': mapping.get('similarity', 'BM25') == 'BM25'}
+    if kind == 'keyword':
+        analyzer = keywordNormalizer if 'normalizer' in mapping else keywordAnalyzer
+        return {'type': kind, 'analyzer': analyzer, 'search_analyzer': analyzer,
+                'bm25': mapping.get('similarity', 'BM25') == 'BM25', 'ignore_above': mapping.get('ignore_above')}
+    if kind == 'date':
+        return {'type': kind}
+    return None
+
+
+def narrow(values):
+    """
+    Encodes integers in the smallest unsigned type holding them.
+    Returns
+    -------
+    tuple
+        Bytes and type code.
+    """
+    values = values.tolist() if isinstance(values, np.ndarray) else values
+    top = max(values, default=0)
+    dtype = 'B' if top < 1 << 8 else 'H' if top < 1 << 16 else 'I'
+    return array(dtype, values).tobytes(), dtype
+
+
+def topK(docs, scores, k):
+    """
+    The k best documents, by decreasing score and then by document number like in Elasticsearch.
+    """
+    if not k:
+        return docs[:0], scores[:0]
+    if k < len(docs):
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        keep = scores >= threshold
+        docs, scores = docs[keep], scores[keep]
+    order = np.lexsort((docs, -scores))[:k]
+    return docs[order], scores[order]
+
+
+class Postings:
+    """
+    Compressed postings list of a term: the document numbers are delta-encoded, the term frequencies and the positions
+    of each document follow, every array is stored as bytes in the smallest integer type holding its values.
+    The documents are split in blocks of BLOCK deltas with the last document of each block, so the frequencies of few
+    documents are read decoding only the blocks that can contain them.
+    """
+    __slots__ = ('df', 'first', 'last', 'deltas', 'frequencies', 'places', 'dtypes')
+
+    def __init__(self, docs, tfs, positions):
+        docs = docs.tolist() if isinstance(docs, np.ndarray) else docs
+        self.df = len(docs)
+        self.first = docs[0]
+        self.last = np.array(docs[BLOCK - 1::BLOCK] + ([docs[-1]] if self.df % BLOCK else []), dtype=np.int64) \
+            if self.df > BLOCK else None
+        self.deltas, docs_dtype = narrow([0] + [b - a for a, b in zip(docs, docs[1:])])
+        self.frequencies, tfs_dtype = narrow(tfs)
+        self.places, positions_dtype = narrow(positions)
+        self.dtypes = docs_dtype + tfs_dtype + positions_dtype
+
+    def docs(self):
+        return self.first + np.cumsum(np.frombuffer(self.deltas, self.dtypes[0]), dtype=np.int64)
+
+    def tfs(self):
+        return np.frombuffer(self.frequencies, self.dtypes[1])
+
+    def positions(self):
+        """
+        Positions of the term in each document, in the order of the documents (tfs positions for each one).
+        """
+        return np.frombuffer(self.places, self.dtypes[2])
+
+    def block(self, j):
+        dtype = np.dtype(self.dtypes[0])
+        start = j * BLOCK
+        deltas = np.frombuffer(self.deltas, dtype, min(BLOCK, self.df - start), start * dtype.itemsize)
+        return (self.first if j == 0 else int(self.last[j - 1])) + np.cumsum(deltas, dtype=np.int64), start
+
+    def lookup(self, docs):
+        """
+        Term frequency in each of the given documents (0 if the term is missing), decoding only their blocks.
+        """
+        tfs = np.zeros(len(docs), dtype=np.int64)
+        blocks = np.zeros(len(docs), dtype=np.int64) if self.last is None else np.searchsorted(self.last, docs)
+        n_blocks = 1 if self.last is None else len(self.last)
+        dtype = np.dtype(self.dtypes[1])
+        for j in np.unique(blocks).tolist():
+            if j >= n_blocks:
+                continue
+            selected = np.flatnonzero(blocks == j)
+            block, start = self.block(j)
+            pos = np.minimum(np.searchsorted(block, docs[selected]), len(block) - 1)
+            hit = block[pos] == docs[selected]
+            frequencies = np.frombuffer(self.frequencies, dtype, len(block), start * dtype.itemsize)
+            tfs[selected[hit]] = frequencies[pos[hit]]
+        return tfs
+
+
+class BM25Index:
+    """
+    In-process inverted index of the tweets, scored with BM25 like the Elasticsearch index built by indexDocuments.
+    The fields are indexed as in the mappings of the index configuration: the text with the tweet_analyzer and BM25,
+    screen_name and hashtags as lowercase keywords and user_name as standard text (all three with boolean scoring)
+    and the date as epoch seconds for the range queries.
+    The documents are buffered and added to the postings at the next refresh (done before each search); a document
+    indexed again with the same _id replaces the previous one, which is only hidden, its postings are kept.
+    The writes and the searches are serialized by a lock, so the index can be updated while it is searched.
+    Supported queries are match (with operator, minimum_should_match and analyzer), match_phrase, term, terms, range,
+    bool (must, should, filter, must_not and minimum_should_match) and match_all. The scores are close to the
+    Elasticsearch ones, which are computed on the lossy encoded documents lengths.
+    Parameters
+    ----------
+    body : dict
+        Index configuration with the mappings, as given to Elasticsearch (default is utils/index_config.json).
+    k1 : float
+        BM25 term frequency saturation (default is 1.2).
+    b : float
+        BM25 length normalization (default is 0.75).
+    """
+
+    def __init__(self, body=None, k1=K1, b=B):
+        if body is None:
+            with open(CONFIG_PATH, encoding='utf-8') as c:
+                body = json.load(c)
+        specs = {field: fieldSpec(mapping) for field, mapping in body['mappings']['properties'].items()}
+        self.fields = {field: spec for field, spec in specs.items() if spec is not None}
+        self.k1 = k1
+        self.b = b
+        self.lock = RLock()
+
+        self.ids = []
+        self.sources = []
+        self.numbers = {}
+        self.live = np.zeros(0, dtype=bool)
+        self.postings = {field: {} for field, spec in self.fields.items() if spec['type'] != 'date'}
+        self.lengths = {field: np.zeros(0) for field in self.postings}
+        self.spans = {field: 1 for field in self.postings}
+        self.stats = {}
+        self.dates = {field: np.zeros(0) for field, spec in self.fields.items() if spec['type'] == 'date'}
+        self.queries = {'match': self.match, 'match_phrase': self.match_phrase, 'term': self.term,
+                        'terms': self.terms, 'range': self.range, 'bool': self.bool, 'match_all': self.match_all}
+        self.clear()
+
+    def clear(self):
+        # buffer of the documents indexed after the last refresh
+        self.pending = {field: {} for field in self.postings}
+        self.pending_lengths = {field: [] for field in self.postings}
+        self.pending_dates = {field: [] for field in self.dates}
+        self.pending_docs = 0
+
+    def __len__(self):
+        return int(self.live.sum()) + self.pending_docs
+
+    def index(self, document, id):
+        """
+        Adds a document, replacing the one with the same id.
+        """
+        with self.lock:
+            # the dates are parsed first, so an invalid document leaves the index unchanged
+            dates = {field: parseDate(document[field]) if document.get(field) is not None else np.nan
+                     for field in self.pending_dates}
+            number = len(self.ids)
+            previous = self.numbers.get(id)
+            if previous is not None and previous < len(self.live):
+                self.live[previous] = False
+            self.numbers[id] = number
+            self.ids.append(id)
+            self.sources.append(document)
+            self.pending_docs += 1
+
+            for field, table in self.pending.items():
+                spec = self.fields[field]
+                values = document.get(field)
+                values = values if isinstance(values, list) else [values]
+                tokens = []
+                for value in values:
+                    if not isinstance(value, str) or spec.get('ignore_above') and len(value) > spec['ignore_above']:
+                        continue
+                    tokens.extend(spec['analyzer'](value))
+                terms = {}
+                for term, position in tokens:
+                    terms.setdefault(term, []).append(position)
+                    self.spans[field] = max(self.spans[field], position + 1)
+                for term, positions in terms.items():
+                    postings = table.get(term)
+                    if postings is None:
+                        postings = table[term] = ([], [], [])
+                    postings[0].append(number)
+                    postings[1].append(len(positions))
+                    postings[2].extend(positions)
+                self.pending_lengths[field].append(len(tokens))
+
+            for field, pending in self.pending_dates.items():
+                pending.append(dates[field])
+
+    def delete(self, id):
+        """
+        Removes a document.
+        """
+        with self.lock:
+            self.refresh()
+            self.live[self.numbers.pop(id)] = False
+
+    def refresh(self):
+        """
+        Adds the buffered documents to the postings and updates the statistics of the fields.
+        """
+        with self.lock:
+            if not self.pending_docs:
+                return
+            for field, table in self.pending.items():
+                postings = self.postings[field]
+                for term, (docs, tfs, positions) in table.items():
+                    old = postings.get(term)
+                    if old is not None:
+                        docs = np.concatenate([old.docs(), docs])
+                        tfs = np.concatenate([old.tfs(), tfs])
+                        positions = np.concatenate([old.positions(), positions])
+                    postings[term] = Postings(docs, tfs, positions)
+                lengths = self.lengths[field] = np.concatenate([self.lengths[field], self.pending_lengths[field]])
+                count = int((lengths > 0).sum())
+                self.stats[field] = (count, lengths.sum() / count if count else 1.0)
+            for field, dates in self.pending_dates.items():
+                self.dates[field] = np.concatenate([self.dates[field], dates])
+            # the documents replaced by a later one of the same batch are hidden
+            self.live = np.concatenate([self.live, np.zeros(self.pending_docs, dtype=bool)])
+            first = len(self.live) - self.pending_docs
+            self.live[[number for number in self.numbers.values() if number >= first]] = True
+            self.clear()
+
+    def spec(self, field, types=('text', 'keyword')):
+        spec = self.fields.get(field)
+        if spec is None or spec['type'] not in types:
+            raise ValueError("Field [%s] is not a %s field of the index" % (field, ' or '.join(types)))
+        return spec
+
+    def idf(self, field, df):
+        n = self.stats[field][0]
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def bm25(self, field, idf, tfs, docs):
+        norm = self.k1 * (1 - self.b + self.b * self.lengths[field][docs] / self.stats[field][1])
+        return idf * tfs / (tfs + norm)
+
+    def term_scores(self, field, term):
+        """
+        Documents containing a term and their scores (1 for the boolean similarity).
+        """
+        postings = self.postings[field].get(term)
+        if postings is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        docs = postings.docs()
+        if not self.fields[field]['bm25']:
+            return docs, np.ones(len(docs))
+        return docs, self.bm25(field, self.idf(field, postings.df), postings.tfs().astype(float), docs)
+
+    def empty(self):
+        return np.zeros(len(self.ids), dtype=bool), np.zeros(len(self.ids))
+
+    def evaluate(self, query):
+        """
+        Matches a query on all the documents.
+        Returns
+        -------
+        tuple
+            Boolean mask of the matching documents and their scores.
+        """
+        if not isinstance(query, dict) or len(query) != 1:
+            raise ValueError("A query must be an object with a single query type")
+        (kind, params), = query.items()
+        if kind not in self.queries:
+            raise ValueError("Unsupported query [%s]" % kind)
+        return self.queries[kind](params)
+
+    @staticmethod
+    def options(params, key='query'):
+        # field and options of a single field query, in the short or in the object form
+        (field, value), = params.items()
+        return field, value if isinstance(value, dict) else {key: value}
+
+    def analyze(self, field, options):
+        spec = self.spec(field)
+        analyzer = ANALYZERS[options['analyzer']] if 'analyzer' in options else spec['search_analyzer']
+        return analyzer(str(options['query']))
+
+    @staticmethod
+    def minimum(options, clauses, default=1):
+        # number of optional clauses that must match, as an integer or a percentage
+        value = options.get('minimum_should_match', default)
+        if isinstance(value, str) and value.endswith('%'):
+            value = int(clauses * int(value[:-1]) / 100)
+        value = int(value)
+        return clauses + value if value < 0 else value
+
+    def match(self, params):
+        field, options = self.options(params)
+        terms = Counter(term for term, _ in self.analyze(field, options))
+        matched, scores = self.empty()
+        count = np.zeros(len(self.ids), dtype=np.int64)
+        for term, weight in terms.items():
+            docs, term_scores = self.term_scores(field, term)
+            scores[docs] += weight * term_scores
+            count[docs] += 1
+        need = len(terms) if options.get('operator', 'or').lower() == 'and' else self.minimum(options, len(terms))
+        matched = count >= max(need, 1)
+        return matched, scores * options.get('boost', 1.0)
+
+    def match_phrase(self, params):
+        field, options = self.options(params)
+        tokens = self.analyze(field, options)
+        matched, scores = self.empty()
+        postings = [self.postings[field].get(term) for term, _ in tokens]
+        if not tokens or None in postings:
+            return matched, scores
+
+        docs = reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), [p.docs() for p in postings])
+        # keys of the (document, phrase start) pairs where each term is at its offset in the phrase
+        span = self.spans[field] + 1
+        keys = None
+        for (_, position), p in zip(tokens, postings):
+            owners = np.repeat(p.docs(), p.tfs())
+            starts = p.positions().astype(np.int64) - (position - tokens[0][1])
+            selected = np.isin(owners, docs) & (starts >= 0)
+            term_keys = owners[selected] * span + starts[selected]
+            keys = term_keys if keys is None else np.intersect1d(keys, term_keys, assume_unique=True)
+        docs, freqs = np.unique(keys // span, return_counts=True)
+
+        matched[docs] = True
+        if self.fields[field]['bm25']:
+            idf = sum(self.idf(field, p.df) for p in postings)
+            scores[docs] = self.bm25(field, idf, freqs.astype(float), docs)
+        else:
+            scores[docs] = 1.0
+        return matched, scores * options.get('boost', 1.0)
+
+    def term(self, params):
+        field, options = self.options(params, 'value')
+        spec = self.spec(field)
+        matched, scores = self.empty()
+        value = options['value']
+        term = spec['analyzer'](value)[0][0] if spec['type'] == 'keyword' and isinstance(value, str) else value
+        docs, term_scores = self.term_scores(field, term)
+        matched[docs] = True
+        scores[docs] = term_scores * options.get('boost', 1.0)
+        return matched, scores
+
+    def terms(self, params):
+        params = dict(params)
+        boost = params.pop('boost', 1.0)
+        (field, values), = params.items()
+        spec = self.spec(field)
+        matched, scores = self.empty()
+        for value in values:
+            term = spec['analyzer'](value)[0][0] if spec['type'] == 'keyword' and isinstance(value, str) else value
+            matched[self.term_scores(field, term)[0]] = True
+        scores[matched] = boost
+        return matched, scores
+
+    def range(self, params):
+        (field, bounds), = params.items()
+        self.spec(field, ('date',))
+        dates = self.dates[field]
+        matched = ~np.isnan(dates)
+        with np.errstate(invalid='ignore'):
+            for op, compare in (('gt', np.greater), ('gte', np.greater_equal), ('lt', np.less),
+                                ('lte', np.less_equal)):
+                if bounds.get(op) is not None:
+                    matched &= compare(dates, parseDate(bounds[op]))
+        return matched, matched * float(bounds.get('boost', 1.0))
+
+    def bool(self, params):
+        matched = np.ones(len(self.ids), dtype=bool)
+        scores = np.zeros(len(self.ids))
+
+        def clauses(occur):
+            values = params.get(occur, [])
+            return [self.evaluate(clause) for clause in (values if isinstance(values, list) else [values])]
+
+        for clause_matched, clause_scores in clauses('must'):
+            matched &= clause_matched
+            scores += clause_scores
+        for clause_matched, _ in clauses('filter'):
+            matched &= clause_matched
+        for clause_matched, _ in clauses('must_not'):
+            matched &= ~clause_matched
+        should = clauses('should')
+        if should:
+            count = np.zeros(len(self.ids), dtype=np.int64)
+            for clause_matched, clause_scores in should:
+                count += clause_matched
+                scores += np.where(clause_matched, clause_scores, 0)
+            default = 0 if params.get('must') or params.get('filter') else 1
+            matched &= count >= self.minimum(params, len(should), default)
+        return matched, np.where(matched, scores, 0) * params.get('boost', 1.0)
+
+    def match_all(self, params):
+        return np.ones(len(self.ids), dtype=bool), np.full(len(self.ids), float((params or {}).get('boost', 1.0)))
+
+    def prunable(self, query):
+        # top level disjunctive match on a BM25 field, whose top documents are found with MaxScore
+        if not isinstance(query, dict) or list(query) != ['match']:
+            return False
+        params = query['match']
+        if not isinstance(params, dict) or len(params) != 1:
+            return False
+        field, options = self.options(params)
+        spec = self.fields.get(field)
+        return spec is not None and spec['type'] != 'date' and spec['bm25'] \
+            and options.get('operator', 'or').lower() == 'or' and options.get('minimum_should_match', 1) in (1, '1') \
+            and float(options.get('boost', 1.0)) > 0
+
+    def max_score(self, field, options, k):
+        """
+        Top k documents of a disjunctive match with MaxScore early termination: the terms are scored in decreasing
+        order of their maximum score (the idf, times the boost); when the k-th best score exceeds the maximum score of
+        the remaining terms, no unseen document can enter the top k, so the remaining terms are only looked up in the
+        blocks of the documents that still can.
+        Returns
+        -------
+        tuple
+            Top documents, their scores, the number of matching documents found and whether it is exact.
+        """
+        terms = Counter(term for term, _ in self.analyze(field, options))
+        boost = float(options.get('boost', 1.0))
+        entries = []
+        for term, weight in terms.items():
+            postings = self.postings[field].get(term)
+            if postings is not None:
+                # the boost scales both the maximum score of the term and its scores, as in the exact match
+                weight *= boost
+                idf = self.idf(field, postings.df)
+                entries.append((weight * idf, term, weight, idf, postings))
+        entries.sort(key=lambda entry: (-entry[0], entry[1]))
+        remaining = np.cumsum([entry[0] for entry in entries][::-1])[::-1].tolist()
+
+        scores = np.zeros(len(self.ids))
+        seen = np.zeros(len(self.ids), dtype=bool)
+        exact = True
+        for i, (_, _, weight, idf, postings) in enumerate(entries):
+            candidates = np.flatnonzero(seen & self.live)
+            if i and k and len(candidates) >= k:
+                threshold = np.partition(scores[candidates], len(candidates) - k)[len(candidates) - k]
+                if threshold > remaining[i]:
+                    candidates = candidates[scores[candidates] + remaining[i] >= threshold]
+                    for _, _, weight, idf, postings in entries[i:]:
+                        tfs = postings.lookup(candidates)
+                        hit = tfs > 0
+                        scores[candidates[hit]] += weight * self.bm25(field, idf, tfs[hit].astype(float),
+                                                                      candidates[hit])
+                    exact = False
+                    break
+            docs = postings.docs()
+            scores[docs] += weight * self.bm25(field, idf, postings.tfs().astype(float), docs)
+            seen[docs] = True
+
+        docs = np.flatnonzero(seen & self.live)
+        return topK(docs, scores[docs], k) + (len(docs), exact)
+
+    def top(self, query, k, exact=False):
+        """
+        Top k documents of a query.
+        Returns
+        -------
+        tuple
+            Top documents, their scores, the number of matching documents and whether it is exact.
+        """
+        with self.lock:
+            self.refresh()
+            if not exact and self.prunable(query):
+                return self.max_score(*self.options(query['match']), k)
+            matched, scores = self.evaluate(query)
+            docs = np.flatnonzero(matched & self.live)
+            return topK(docs, scores[docs], k) + (len(docs), True)
+
+    def search(self, body=None, size=None, name=None):
+        """
+        Performs a search, see Client.search.
+        """
+        start = time.perf_counter()
+        body = body or {}
+        size = body.get('size', 10) if size is None else size
+        offset = body.get('from', 0)
+        docs, scores, total, exact = self.top(body.get('query') or {'match_all': {}}, offset + size,
+                                              body.get('track_total_hits') is True)
+        hits = [{'_index': name, '_type': '_doc', '_id': self.ids[doc], '_score': score,
+                 '_source': dict(self.sources[doc])}
+                for doc, score in zip(docs[offset:].tolist(), scores[offset:].tolist())]
+        return {
+            'took': int((time.perf_counter() - start) * 1000), 'timed_out': False,
+            'hits': {'total': {'value': total, 'relation': 'eq' if exact else 'gte'},
+                     'max_score': float(scores[0]) if len(scores) else None, 'hits': hits}
+        }
+
+
+class Client:
+    """
+    Embedded search backend with the search and msearch methods of the Elasticsearch client, so it can replace it in
+    the search helpers, the demo and the search service without a running Elasticsearch: the tweets are indexed in
+    named BM25Index instances of the same process and the responses have the Elasticsearch format.
+    """
+
+    def __init__(self):
+        self.indexes = {}
+
+    def create(self, index, body=None):
+        """
+        Creates (or replaces) an index with the given configuration (default is utils/index_config.json).
+        """
+        self.indexes[index] = BM25Index(body)
+        return {'acknowledged': True, 'index': index}
+
+    def get(self, index):
+        if index not in self.indexes:
+            raise IndexNotFound("no such index [%s]" % index)
+        return self.indexes[index]
+
+    def index(self, index, body, id):
+        """
+        Indexes a document, the index is created with the default configuration if missing.
+        """
+        if index not in self.indexes:
+            self.create(index)
+        self.indexes[index].index(body, id)
+        return {'_index': index, '_id': id, 'result': 'created'}
+
+    def bulk(self, body, index=None, refresh=None):
+        """
+        Performs many index and delete actions, body is the bulk request of Elasticsearch: a newline delimited JSON
+        string (or the list) of action and document pairs, the delete actions have no document. The missing indices
+        are created with the default configuration and the documents are searchable at once.
+        Returns
+        -------
+        dict
+            The result of each action in items, errors is true if some document could not be indexed.
+        """
+        start = time.perf_counter()
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()] if isinstance(body, str) else body
+        items = []
+        touched = set()
+        i = 0
+        while i < len(lines):
+            (op, meta), = lines[i].items()
+            name = meta.get('_index', index)
+            if name not in self.indexes:
+                self.create(name)
+            touched.add(name)
+            result = {'_index': name, '_id': meta['_id']}
+            if op == 'delete':
+                found = meta['_id'] in self.indexes[name].numbers
+                if found:
+                    self.indexes[name].delete(meta['_id'])
+                result.update(status=200 if found else 404, result='deleted' if found else 'not_found')
+                i += 1
+            else:
+                try:
+                    self.indexes[name].index(lines[i + 1], meta['_id'])
+                    result.update(status=201, result='created')
+                except (ValueError, TypeError) as e:
+                    result.update(status=400, error={'type': 'mapper_parsing_exception', 'reason': str(e)})
+                i += 2
+            items.append({op: result})
+        for name in touched:
+            self.indexes[name].refresh()
+        return {'took': int((time.perf_counter() - start) * 1000),
+                'errors': any('error' in result for item in items for result in item.values()), 'items': items}
+
+    def load(self, data_path, index, config_path=CONFIG_PATH):
+        """
+        Indexes the tweets of a JSON or JSON lines file, streamed with iter_tweets, in a new index.
+        Parameters
+        ----------
+        data_path : str
+            JSON or JSON lines (.jsonl, .jsonl.gz) file location of the tweets, or directory of the sharded tweets
+            store.
+        index : str
+            Index name.
+        config_path : str
+            JSON file location of the index settings and mappings.
+        Returns
+        -------
+        dict
+            Number of indexed documents and indexing rate (docs/sec).
+        """
+        start = time.perf_counter()
+        with open(config_path, encoding='utf-8') as c:
+            self.create(index, json.load(c))
+        target = self.indexes[index]
+        for tweet_id, tweet in iter_tweets(data_path):
+            target.index(tweet, tweet_id)
+        target.refresh()
+        elapsed = time.perf_counter() - start
+        return {'indexed': len(target), 'docs_per_sec': len(target) / elapsed if elapsed else 0.0}
+
+    def search(self, index=None, body=None, size=None):
+        """
+        Performs a query on an index.
+        Parameters
+        ----------
+        index : str
+            Index name.
+        body : dict
+            Search request with the query DSL, size, from and track_total_hits (true to count all the matching
+            documents, otherwise the match queries stop early and the total can be a lower bound).
+        size : int
+            Number of results, overrides the one of the body (default is 10).
+        Returns
+        -------
+        dict
+            Response in the Elasticsearch format (hits.hits with _id, _score and _source of each result).
+        """
+        return self.get(index).search(body, size, index)
+
+    def msearch(self, index=None, body=None):
+        """
+        Performs many queries, body is the list of header and search request pairs of the Elasticsearch multi-search
+        (the header can set the index).
+        Returns
+        -------
+        dict
+            The response of each query in responses, the failed queries have the error and status.
+        """
+        responses = []
+        for header, request in zip(body[::2], body[1::2]):
+            try:
+                responses.append(self.search(header.get('index', index), request))
+            except LookupError as e:
+                responses.append({'error': {'type': 'index_not_found_exception', 'reason': str(e)}, 'status': 404})
+            except (ValueError, KeyError, TypeError) as e:
+                responses.append({'error': {'type': 'parsing_exception', 'reason': str(e)}, 'status': 400})
+        return {'responses': responses}
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+'''
+Command line interface of the search engine:
+
+    python3 cli.py index DATA [--index twitter_index] [--incremental]
+    python3 cli.py search QUERY [--index twitter_index] [--size 10] [--bm25 DATA] [--json]
+    python3 cli.py personalize QUERY --users USER [USER ...] [--size 100] [-k 10] [--bm25 DATA] [--json]
+    python3 cli.py build-profiles [--users-tweets FILE [FILE ...]] [--n-features N]
+
+QUERY is a text matched on the tweets text, or a query DSL if it starts with '{'.
+Every subcommand imports only the modules it runs (e.g. a search never loads NLTK, scikit-learn or the profiles
+code), so the startup of the interface stays fast; see benchmarks/imports.py for the import times budget.
+'''
+
+import argparse
+import json
+import sys
+
+USERS_TWEETS = ["./datasets/group_one.json", "./datasets/group_two.json"]
+
+
+def parse_query(query, field='text', phrase=False):
+    # a query starting with '{' is a query DSL, otherwise a match (or match_phrase) on the field
+    if query.lstrip().startswith('{'):
+        return json.loads(query)
+    return {'match_phrase' if phrase else 'match': {field: query}}
+
+
+def client(args):
+    # embedded BM25 index of the data file or Elasticsearch client of the hosts
+    if args.bm25:
+        from bm25 import Client
+        es = Client()
+        es.load(args.bm25, args.index)
+        return es
+    from search import getClient
+    return getClient(args.es)
+
+
+def dump(result):
+    # numpy scalars of the personalized scores are written as plain numbers
+    json.dump(result, sys.stdout, indent=1, default=lambda o: o.item() if hasattr(o, 'item') else str(o))
+    print()
+
+
+def run_index(args):
+    from indexer import indexDocuments
+    from utils.utils import pprint, g, r
+    report = indexDocuments(args.data, args.config, args.index, incremental=args.incremental, workers=args.workers,
+                            chunk_size=args.chunk_size)
+    pprint(g("%d documents indexed" % report['indexed']) + ", " + r("%d failed" % report['failed']))
+    return 1 if report['failed'] else 0
+
+
+def run_search(args):
+    from search import search
+    res = search(client(args), args.index, parse_query(args.query, args.field, args.phrase), args.size)
+    if args.json or 'error' in res:
+        dump(res)
+        return 1 if 'error' in res else 0
+    from utils.utils import printRes
+    printRes(res)
+    return 0
+
+
+def run_personalize(args):
+    from preprocessor import Preprocessor
+    from search import personalizedSearch
+    preprocessor = Preprocessor(args.users_tweets, n_features=args.n_features)
+    res, = personalizedSearch(client(args), args.index, [parse_query(args.query, args.field, args.phrase)],
+                              preprocessor, args.users, args.size, args.k)
+    if args.json or 'error' in res:
+        dump(res)
+        return 1 if 'error' in res else 0
+    from utils.utils import printResAdv
+    printResAdv(res)
+    return 0
+
+
+def run_build_profiles(args):
+    from preprocessor import Preprocessor
+    from utils.utils import pprint, g
+    preprocessor = Preprocessor(args.users_tweets, workers=args.workers, tagger=args.tagger,
+                                n_features=args.n_features)
+    profiles = preprocessor.reload_profiles()
+    pprint(g("%d users profiles built" % len(profiles['users'])))
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Personalized search of the news tweets")
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+
+    backend = argparse.ArgumentParser(add_help=False)
+    backend.add_argument('--index', default='twitter_index', help="index (or alias) name")
+    backend.add_argument('--es', nargs='+', default=None, help="Elasticsearch hosts")
+    backend.add_argument('--bm25', metavar='DATA', default=None,
+                         help="tweets file searched with the embedded BM25 index instead of Elasticsearch")
+    backend.add_argument('--field', default='text', help="field matched by a text query")
+    backend.add_argument('--phrase', action='store_true', help="match the text query as a phrase")
+    backend.add_argument('--json', action='store_true', help="print the raw JSON response")
+
+    profiles = argparse.ArgumentParser(add_help=False)
+    profiles.add_argument('--users-tweets', nargs='+', default=USERS_TWEETS, help="users tweets files")
+    profiles.add_argument('--n-features', type=int, default=None,
+                          help="vectorize the profiles with the hashing trick in n features")
+
+    index = commands.add_parser('index', help="index a tweets file in Elasticsearch")
+    index.add_argument('data', help="JSON or JSON lines tweets file")
+    index.add_argument('--index', default='twitter_index', help="index alias name")
+    index.add_argument('--config', default='./utils/index_config.json', help="index settings and mappings")
+    index.add_argument('--incremental', action='store_true', help="index only the new or changed tweets")
+    index.add_argument('--workers', type=int, default=4, help="threads sending the bulk requests")
+    index.add_argument('--chunk-size', type=int, default=500, help="documents of each bulk request")
+    index.set_defaults(run=run_index)
+
+    search = commands.add_parser('search', parents=[backend], help="search the news tweets")
+    search.add_argument('query', help="text or query DSL")
+    search.add_argument('--size', type=int, default=10, help="number of results")
+    search.set_defaults(run=run_search)
+
+    personalize = commands.add_parser('personalize', parents=[backend, profiles],
+                                      help="search the news tweets and re-rank them for the users")
+    personalize.add_argument('query', help="text or query DSL")
+    personalize.add_argument('--users', nargs='+', default=[], help="users (default is all the users)")
+    personalize.add_argument('--size', type=int, default=100, help="results re-ranked")
+    personalize.add_argument('-k', type=int, default=10, help="personalized results of each user")
+    personalize.set_defaults(run=run_personalize)
+
+    build = commands.add_parser('build-profiles', parents=[profiles],
+                                help="build (or update) the users profiles store")
+    build.add_argument('--workers', type=int, default=1, help="processes parsing the tweets")
+    build.add_argument('--tagger', default='perceptron', help="POS tagger of the tweets")
+    build.set_defaults(run=run_build_profiles)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
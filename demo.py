@@ -1,26 +1,19 @@
 #!/usr/bin/env python3
 
 from utils.utils import *
-from indexer import indexDocuments
-from preprocessor import Preprocessor
-
-from elasticsearch import Elasticsearch
+from search import getClient, msearch, personalizedSearch
 
 
 def basicQueries():
     '''
-    Performs standard queries on the news twitter index
+    Performs standard queries on the news twitter index, all the queries are sent with a single multi-search request
     '''
 
-    def search(index, query=None, n_res=10):
-        es = Elasticsearch()
-        res = es.search(index=index_name, body={
-            "query" : query
-        }, size=n_res)
+    queries = []
+    n_res = 10
 
-        pprint(g("%d documents found (showing first %d)" % (res['hits']['total']['value'], n_res)))
-        printRes(res)
-        return res
+    def search(index, query=None):
+        queries.append(query)
 
 
     pprint(r("BASIC QUERIES DEMO"))
@@ -78,22 +71,24 @@ def basicQueries():
                         {"match": {"text":"Covid19 Pfizer vaccine approvals"}}
                     ]
                 }})
+
+    for res in msearch(getClient(), index_name, queries, n_res):
+        if 'error' not in res:
+            pprint(g("%d documents found (showing first %d)" % (res['hits']['total']['value'], n_res)))
+        printRes(res)
     
 
 
 def advancedQueries(users_tweets):
     '''
     Performs advanced queries on the news twitter index, customizing the results based on the tweets of the users 
-    considered.
+    considered. All the queries are sent with a single multi-search request and their results are personalized at once.
     '''
 
-    def search(index, query=None, n_res=100):
-        es = Elasticsearch()
-        res = es.search(index=index_name, body={
-            "query" : query
-        }, size=n_res)
+    queries = []
 
-        return res
+    def search(index, query=None):
+        queries.append(query)
 
 
     pprint(r("ADVANCED QUERIES DEMO"))
@@ -114,23 +109,19 @@ def advancedQueries(users_tweets):
 
     user = ['Joe Biden','Brian Cox']
     # ES standard query
-    query_res = search(index_name, query={
+    search(index_name, query={
                     "bool" : {
                         "must" : [
                             {"match" : {"text" : "What this pandemic year can teach us about"}},
                             {"match" : {"text" : "coronavirus"}}
                         ]
                     }})
-    # Personalization re-rank process
-    personalized_res = users_tweets.personalize_query(query_res, user)
-    #printRes(query_res)
-    printResAdv(personalized_res)
 
 
     ## USER CASE 4 - Expand the search adding synonyms of the words in the query ##
 
     # Query  - expanding previous query with synonyms
-    query_res = search(index_name, query={
+    search(index_name, query={
                     "bool" : {
                         "must" : [
                             {"match" : {"text" : {
@@ -140,31 +131,10 @@ def advancedQueries(users_tweets):
                         ]
                     }})
     
-    # Personalization re-rank process
-    personalized_res = users_tweets.personalize_query(query_res, user)
-    #printRes(query_res)
-    printResAdv(personalized_res)
-
-
-
-## Utils functions
-def printRes(res):
-    for doc in res['hits']['hits']:
-        print(y("Tweet ID: ") + doc['_id'] + 
-                g("\nUser: ") + doc['_source']['user_name'] +
-                g("\nCreated at: ") + doc['_source']['date'] +
-                g("\nText: ") + doc['_source']['text'] + 
-                r("\nScore: ") + str(doc['_score']) + "\n")
+    # Personalization re-rank process of the results of all the queries
+    for personalized_res in personalizedSearch(getClient(), index_name, queries, users_tweets, user):
+        printResAdv(personalized_res)
 
-def printResAdv(res):
-    for usr in res:
-        pprint('Personalized results for user: ' + usr)
-        for doc in res[usr]['news']:
-            print(y("Tweet ID: ") + doc['_id'] + 
-                    g("\nUser: ") + doc['_source']['user_name'] +
-                    g("\nCreated at: ") + doc['_source']['date'] +
-                    g("\nText: ") + doc['_source']['text'] + 
-                    r("\nPersonalized score: ") + str(doc['new_score']) + "\n")
 
 
 
@@ -175,13 +145,15 @@ if __name__ == "__main__":
     data_path = './datasets/news_tweets.json'
     config_path = './utils/index_config.json'
 
-    ## Index document specified in ES server, only the first time
+    ## Index document specified in ES server, only the first time (then incremental=True to add the new tweets)
+    #from indexer import indexDocuments
     #indexDocuments(data_path, config_path, index_name)
 
     ## Basic queries on Elasticsearch
     basicQueries()
 
-    ## User tweets-based personalization
+    ## User tweets-based personalization, the preprocessor (and NLTK) is imported only for the advanced queries
+    from preprocessor import Preprocessor
     users_tweets_path = ["./datasets/group_one.json","./datasets/group_two.json"]
     users_tweets = Preprocessor(users_tweets_path)
 
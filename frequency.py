@@ -0,0 +1,316 @@
+import numpy as np
+from array import array
+from collections import Counter
+from collections.abc import Mapping, MutableMapping
+
+# Minimum number of pending updates merged at once into the count arrays
+COMPACT_MIN = 1024
+# Fields of the pre-processed tweets: plain values and lists of terms stored as term ids
+TWEET_FIELDS = ['author', 'screen_name', 'date', 'text']
+TOKEN_FIELDS = ['tokenized', 'user', 'user_tokenized', 'hashtags', 'emoji', 'links']
+
+
+class Vocabulary:
+    '''
+    Global interned term dictionary: every term is stored once and identified by an integer id, the token lists and
+    the frequency counters refer to the same term objects.
+    '''
+
+    def __init__(self, terms=()):
+        self.terms = []
+        self.ids = {}
+        for term in terms:
+            self.id(term)
+
+    def id(self, term):
+        '''
+        Id of a term, the term is added to the vocabulary if not present.
+        '''
+        i = self.ids.get(term)
+        if i is None:
+            i = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return i
+
+    def get(self, term, default=None):
+        return self.ids.get(term, default)
+
+    def remap(self, other):
+        '''
+        Ids in this vocabulary of the terms of another one, indexed by their id in the other (the missing terms are
+        added).
+        '''
+        return np.fromiter((self.id(term) for term in other.terms), np.int32, len(other.terms))
+
+    def intern(self, term):
+        '''
+        Interned copy of a term, equal terms share the same object.
+        '''
+        i = self.ids.get(term)
+        return self.terms[self.id(term) if i is None else i]
+
+    def items(self):
+        return self.ids.items()
+
+    def __getitem__(self, i):
+        return self.terms[i]
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+
+class HashingVocabulary:
+    '''
+    Stateless vocabulary of the hashing trick: the id of a term is its murmurhash modulo n_features, so users and news
+    share the same feature space without fitting a vocabulary.
+    '''
+
+    def __init__(self, n_features=2 ** 20):
+        # sklearn is imported only by the hashed profiles
+        from sklearn.utils import murmurhash3_32
+        self.n_features = n_features
+        self.hash = murmurhash3_32
+
+    def get(self, term, default=None):
+        return self.hash(term, positive=True) % self.n_features
+
+    def __len__(self):
+        return self.n_features
+
+
+class TermCounts(Mapping):
+    '''
+    Array-backed replacement of a Counter of terms: the counts are two sorted numpy arrays of term ids and counts, the
+    updates are buffered by term id and merged into the arrays before the next read.
+    Reading a missing term returns 0 like a Counter, the terms whose count drops to 0 or less are removed.
+    '''
+    __slots__ = ('vocabulary', 'ids', 'counts', 'pending')
+
+    def __init__(self, vocabulary, ids=(), counts=()):
+        ids = np.asarray(ids, dtype=np.int32)
+        counts = np.asarray(counts, dtype=np.int32)
+        order = np.argsort(ids, kind='stable')
+        self.vocabulary = vocabulary
+        self.ids = ids[order]
+        self.counts = counts[order]
+        self.pending = {}
+
+    def add(self, values, sign):
+        if not isinstance(values, Mapping):
+            values = Counter(values)
+        pending = self.pending
+        ids = self.vocabulary.ids
+        for term, count in values.items():
+            i = ids.get(term)
+            if i is None:
+                i = self.vocabulary.id(term)
+            pending[i] = pending.get(i, 0) + sign * count
+        if len(pending) > max(COMPACT_MIN, len(self.ids)):
+            self.compact()
+
+    def update(self, values=()):
+        '''
+        Add the counts of an iterable of terms or of a mapping of terms to counts, like Counter.update.
+        '''
+        self.add(values, 1)
+
+    def subtract(self, values=()):
+        '''
+        Subtract the counts of an iterable of terms or of a mapping of terms to counts, like Counter.subtract.
+        '''
+        self.add(values, -1)
+
+    def compact(self):
+        '''
+        Merge the pending updates into the count arrays.
+        '''
+        if not self.pending:
+            return
+        ids = np.concatenate([self.ids, np.fromiter(self.pending.keys(), np.int32, len(self.pending))])
+        counts = np.concatenate([self.counts, np.fromiter(self.pending.values(), np.int32, len(self.pending))])
+        self.pending = {}
+
+        ids, inverse = np.unique(ids, return_inverse=True)
+        totals = np.zeros(len(ids), dtype=np.int32)
+        np.add.at(totals, inverse, counts)
+        keep = totals > 0
+        self.ids, self.counts = ids[keep], totals[keep]
+
+    def __getitem__(self, term):
+        self.compact()
+        i = self.vocabulary.get(term)
+        if i is None:
+            return 0
+        pos = np.searchsorted(self.ids, i)
+        return int(self.counts[pos]) if pos < len(self.ids) and self.ids[pos] == i else 0
+
+    def __setitem__(self, term, count):
+        self.add({term: count - self[term]}, 1)
+
+    def __delitem__(self, term):
+        self[term] = 0
+
+    def __contains__(self, term):
+        return self[term] > 0
+
+    def get(self, term, default=None):
+        return self[term] if term in self else default
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        self.compact()
+        return len(self.ids)
+
+    def keys(self):
+        self.compact()
+        terms = self.vocabulary.terms
+        return [terms[i] for i in self.ids.tolist()]
+
+    def values(self):
+        self.compact()
+        return self.counts.tolist()
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def most_common(self, n=None):
+        return sorted(self.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def __repr__(self):
+        return 'TermCounts(%r)' % dict(self.most_common())
+
+
+class TweetTable(MutableMapping):
+    '''
+    Pre-processed tweets of a user stored by column: the token lists of all the tweets are concatenated in an int32
+    array of term ids for each field, with the offsets of each tweet, and the other fields are lists. Reading a tweet
+    decodes it in the dictionary of the pre-processed tweet, with tuples of terms (hashtags is None for the tweets
+    without them), so the table can be read like the dictionary of tweets ids to tweets it replaces.
+    The removed tweets are only hidden, their rows are dropped when they are more than the live ones.
+    '''
+    __slots__ = ('vocabulary', 'rows', 'fields', 'tokens', 'offsets', 'none')
+
+    def __init__(self, vocabulary, tweet_ids=(), fields=None, tokens=None, none=()):
+        self.vocabulary = vocabulary
+        self.rows = {tweet_id: row for row, tweet_id in enumerate(tweet_ids)}
+        self.fields = {field: list(fields[field]) if fields else [] for field in TWEET_FIELDS}
+        self.tokens = {}
+        self.offsets = {}
+        for field in TOKEN_FIELDS:
+            ids, offsets = tokens[field] if tokens else ((), (0,))
+            # the offsets of the columns read from a store are rebased on the first tweet
+            offsets = np.asarray(offsets, dtype=np.int64)
+            self.tokens[field] = array('i', np.asarray(ids, dtype=np.int32).tobytes())
+            self.offsets[field] = array('i', (offsets - offsets[0]).astype(np.int32).tobytes())
+        self.none = bytearray(np.asarray(none, dtype=np.uint8).tobytes()) if len(none) else bytearray(len(self.rows))
+
+    def __setitem__(self, tweet_id, tweet):
+        if tweet_id in self.rows:
+            del self[tweet_id]
+        for field in TWEET_FIELDS:
+            self.fields[field].append(tweet[field])
+        for field in TOKEN_FIELDS:
+            column = self.tokens[field]
+            column.extend(map(self.vocabulary.id, tweet[field] or ()))
+            self.offsets[field].append(len(column))
+        self.rows[tweet_id] = len(self.none)
+        self.none.append(tweet['hashtags'] is None)
+
+    def __getitem__(self, tweet_id):
+        row = self.rows[tweet_id]
+        terms = self.vocabulary.terms
+        tweet = {field: self.fields[field][row] for field in TWEET_FIELDS}
+        for field in TOKEN_FIELDS:
+            offsets = self.offsets[field]
+            tweet[field] = tuple([terms[i] for i in self.tokens[field][offsets[row]:offsets[row + 1]]])
+        if self.none[row]:
+            tweet['hashtags'] = None
+        return tweet
+
+    def __delitem__(self, tweet_id):
+        del self.rows[tweet_id]
+        if len(self.rows) * 2 < len(self.none):
+            self.compact()
+
+    def __contains__(self, tweet_id):
+        return tweet_id in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def compact(self):
+        '''
+        Drop the rows of the removed tweets, the live ones keep their order.
+        '''
+        if len(self.rows) == len(self.none):
+            return
+        rows = np.fromiter(self.rows.values(), np.int64, len(self.rows))
+        self.fields = {field: [values[row] for row in rows.tolist()] for field, values in self.fields.items()}
+        for field in TOKEN_FIELDS:
+            ids, offsets = self.column(field, rows)
+            self.tokens[field] = array('i', ids.tobytes())
+            self.offsets[field] = array('i', offsets.astype(np.int32).tobytes())
+        self.none = bytearray(np.frombuffer(bytes(self.none), dtype=np.uint8)[rows].tobytes())
+        self.rows = {tweet_id: row for row, tweet_id in enumerate(self.rows)}
+
+    def column(self, field, rows=None):
+        '''
+        Term ids of a token field of the live tweets, in their order.
+        :param field: token field;
+        :param rows: rows of the tweets (default is the live ones);
+        :return: tuple with the int32 array of the term ids and the int64 array of the offsets of each tweet
+        '''
+        ids = np.array(self.tokens[field], dtype=np.int32)
+        offsets = np.array(self.offsets[field], dtype=np.int64)
+        if rows is None:
+            if len(self.rows) == len(self.none):
+                return ids, offsets
+            rows = np.fromiter(self.rows.values(), np.int64, len(self.rows))
+        starts, ends = offsets[rows], offsets[rows + 1]
+        lengths = ends - starts
+        new_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        # index of every term id kept: the start of its tweet plus its position in the tweet
+        positions = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1] - starts, lengths)
+        return ids[positions], new_offsets
+
+    def counts(self, field):
+        '''
+        Terms counts of a token field over all the tweets.
+        '''
+        ids, counts = np.unique(self.column(field)[0], return_counts=True)
+        return TermCounts(self.vocabulary, ids, counts)
+
+    def extend(self, other, remap=None):
+        '''
+        Add the tweets of another table (e.g. parsed by a worker with its own vocabulary), replacing the ones with
+        the same ids.
+        :param other: TweetTable;
+        :param remap: ids in this vocabulary of the terms of the other one (see Vocabulary.remap), computed if None;
+        '''
+        if remap is None:
+            remap = self.vocabulary.remap(other.vocabulary)
+        other.compact()
+        for tweet_id in other.rows:
+            if tweet_id in self.rows:
+                del self[tweet_id]
+        first = len(self.none)
+        for field in TWEET_FIELDS:
+            self.fields[field].extend(other.fields[field])
+        for field in TOKEN_FIELDS:
+            ids, offsets = other.column(field)
+            column = self.tokens[field]
+            self.offsets[field].extend((offsets[1:] + len(column)).tolist())
+            column.frombytes(remap[ids].astype(np.int32).tobytes())
+        self.rows.update((tweet_id, first + row) for tweet_id, row in other.rows.items())
+        self.none.extend(other.none)
+
+    def __repr__(self):
+        return 'TweetTable(%d tweets)' % len(self.rows)
@@ -1,27 +1,57 @@
 import json
-import tqdm
+import os
+import time
 from os import path
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import streaming_bulk
 from utils.utils import *
+from utils.instrument import timer, count
 
+MANIFEST_DIR = './utils/index-manifest/'
 
-def indexDocuments(data_path, config_path, index_name="my-index"):
+
+def indexDocuments(data_path, config_path, index_name="my-index", incremental=False, workers=4, chunk_size=500,
+                   es=None):
     """
-    Indexes a document using python library for ElasticSearch.
+    Indexes a document using python library for ElasticSearch, the documents are streamed from the data file.
+    The documents are stored in versioned indices (index_name-<timestamp>) behind the index_name alias, so the 
+    queries on index_name never find a missing index.
+    A full indexing loads all the documents in a new index, with the refresh disabled and the replicas set to zero, 
+    then the alias is atomically swapped to it and the previous indices are deleted.
+    An incremental indexing upserts by tweet id, in the index currently behind the alias, only the new or changed 
+    documents (compared with the manifest of the documents already indexed).
+    Every indexing bumps the version of the alias, so the cached query results are invalidated.
     Parameters
     ----------
     data_path : str
-        JSON file location of documents to index.
+        JSON or JSON lines (.jsonl, .jsonl.gz) file location of documents to index, or directory of the sharded tweets
+        store written by the scraper.
     config_path : str
         HSON file location of index settings and mappings.
     index_name : str
-        Name of index (default is 'my-index').
+        Name of the index alias (default is 'my-index').
+    incremental : bool
+        Index only the new or changed documents in the current index (default is False).
+    workers : int
+        Number of threads sending the bulk requests in parallel (default is 4).
+    chunk_size : int
+        Number of documents sent in each bulk request (default is 500).
+    es : Elasticsearch
+        Client used for the indexing (default is a client of the local server).
+    Returns
+    -------
+    dict
+        Number of indexed and failed documents, indexing rate (docs/sec) and the failed items.
     """
 
-    def genData():
-        for tweet in tweets:
-            yield tweets[tweet]
+    def genData(known):
+        # only the tweets not in known (or changed) are sent, tweet id used as document _id, so changed tweets are 
+        # overwritten and the news cache key is stable
+        for tweet_id, tweet in iter_tweets(data_path):
+            count('index.docs_read')
+            digest = fingerprint(tweet)
+            if known.get(tweet_id) != digest:
+                fingerprints[tweet_id] = digest
+                count('index.docs_sent')
+                yield dict(tweet, _id=tweet_id)
 
 
     # Load a JSON mapping file for elasticsearch indexing
@@ -29,24 +59,173 @@ def indexDocuments(data_path, config_path, index_name="my-index"):
         with open(file=config_path, encoding='utf-8') as p:
             index_config = json.load(p)
 
-    # Load JSON with documents
-    if path.exists(data_path):
-        with open(data_path) as o:
-            tweets = json.load(o)
+    if es is None:
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch(hosts=["http://localhost:9200"])
+
+    current = getAliasIndices(es, index_name)
+    manifest = loadManifest(index_name)
+    fingerprints = {}
+
+    # Documents are streamed from data_path while indexing
+    if incremental and len(current) == 1:
+        # Upsert only the documents not indexed or changed since the last indexing
+        target = current[0]
+        known = manifest['docs'] if manifest['index'] == target else {}
+        pprint("Incremental indexing of the new or changed documents in " + y(target))
+        stats = bulkIndex(es, target, genData(known), workers, chunk_size)
+        with timer('index.refresh'):
+            es.indices.refresh(index=target)
+        manifest = {'index': target, 'docs': dict(known)}
+    else:
+        # Full indexing in a new index, swapped in when complete
+        target = index_name + '-' + time.strftime('%Y%m%d%H%M%S')
+        with timer('index.create'):
+            es.indices.create(index=target, body=index_config)
+        pprint("Full indexing in " + y(target))
+        stats = loadIndex(es, target, genData({}), workers, chunk_size)
+        with timer('index.swap_alias'):
+            swapAlias(es, index_name, target, current)
+        manifest = {'index': target, 'docs': {}}
+
+    for item in stats['errors']:
+        fingerprints.pop(item.get('index', {}).get('_id'), None)
+    manifest['docs'].update(fingerprints)
+    with timer('index.manifest'):
+        saveManifest(index_name, manifest)
+        bumpVersion(index_name, target)
+    count('index.indexed', stats['indexed'])
+    count('index.failed', stats['failed'])
+
+    return stats
+
+
+def getAliasIndices(es, alias):
+    """
+    Returns the indices behind the alias (empty if the alias doesn't exist).
+    """
+    if not es.indices.exists_alias(name=alias):
+        return []
+    return sorted(es.indices.get_alias(name=alias))
+
 
-    es = Elasticsearch(hosts=["http://localhost:9200"])
+def swapAlias(es, alias, index, previous):
+    """
+    Atomically moves the alias from the previous indices to index, then deletes the previous indices.
+    An old index with the same name of the alias (indexed before the versioned indices) is removed in the same 
+    atomic operation.
+    """
+    actions = [{'remove': {'index': old, 'alias': alias}} for old in previous]
+    if not previous and es.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': index, 'alias': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+    pprint("Alias %s now points to %s" % (y(alias), y(index)))
+
+    for old in previous:
+        es.indices.delete(index=old)
+
+
+def loadIndex(es, index, actions, workers, chunk_size):
+    """
+    Bulk loads the documents in a new index with refresh disabled and zero replicas, then restores the original 
+    settings and merges the index segments.
+    """
+    # Settings restored after the bulk load
+    settings = es.indices.get_settings(index=index)[index]['settings']['index']
+    restore = {
+        'refresh_interval': settings.get('refresh_interval'),
+        'number_of_replicas': settings.get('number_of_replicas')
+    }
+    es.indices.put_settings(index=index, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+
+    try:
+        stats = bulkIndex(es, index, actions, workers, chunk_size)
+    finally:
+        with timer('index.refresh'):
+            es.indices.put_settings(index=index, body={'index': restore})
+            es.indices.refresh(index=index)
+    with timer('index.forcemerge'):
+        es.indices.forcemerge(index=index, max_num_segments=1)
 
-    if es.indices.exists(index=index_name):
-        es.indices.delete(index=index_name)
-    es.indices.create(index=index_name, body=index_config)
+    return stats
 
-    # Index document with bulk function
+
+def bulkIndex(es, index, actions, workers, chunk_size):
+    """
+    Index the documents with parallel bulk requests, reporting the indexing rate and the failed items.
+    """
+    import tqdm
+    from elasticsearch.helpers import parallel_bulk
     pprint("Indexing documents...")
-    progress = tqdm.tqdm(unit="docs", total=len(tweets))
+    progress = tqdm.tqdm(unit="docs")
     successes = 0
-    for ok, action in streaming_bulk(
-        client=es, index=index_name, actions=genData(),
-    ):
-        progress.update(1)
-        successes += ok
-    pprint("Indexed %d/%d documents" % (successes, len(tweets)))
+    failed = []
+    start = time.time()
+    try:
+        with timer('index.bulk'):
+            for ok, item in parallel_bulk(
+                client=es, index=index, actions=actions, thread_count=workers, chunk_size=chunk_size,
+                raise_on_error=False, raise_on_exception=False
+            ):
+                progress.update(1)
+                successes += ok
+                if not ok:
+                    failed.append(item)
+    finally:
+        progress.close()
+    elapsed = time.time() - start
+
+    rate = successes / elapsed if elapsed > 0 else 0.0
+    pprint("Indexed %d/%d documents (%s docs/sec, %s failed)" % (successes, successes + len(failed), g("%.0f" % rate), 
+        r(len(failed)) if failed else g(0)))
+    for item in failed[:10]:
+        print(r("Failed: ") + json.dumps(item))
+
+    return {'indexed': successes, 'failed': len(failed), 'docs_per_sec': rate, 'errors': failed}
+
+
+def loadManifest(alias):
+    """
+    Returns the manifest of the documents indexed behind the alias: the index name and the fingerprint of each 
+    document by tweet id.
+    """
+    try:
+        with open(MANIFEST_DIR + alias + '.json') as m:
+            return json.load(m)
+    except (OSError, ValueError):
+        return {'index': None, 'docs': {}}
+
+
+def saveManifest(alias, manifest):
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    with open(MANIFEST_DIR + alias + '.json', 'w') as m:
+        json.dump(manifest, m)
+
+
+def bumpVersion(alias, index):
+    """
+    Writes a new version of the documents behind the alias, read by indexVersion.
+    """
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    with open(MANIFEST_DIR + alias + '.version', 'w') as v:
+        v.write('%s@%.6f' % (index, time.time()))
+
+
+versions = {}
+
+
+def indexVersion(alias):
+    """
+    Returns the version of the documents behind the alias (None if never indexed), changed by every indexDocuments.
+    The version file is read again only when its modification time changes, so the check costs a stat call.
+    """
+    try:
+        stat = os.stat(MANIFEST_DIR + alias + '.version')
+    except OSError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+    if versions.get(alias, (None,))[0] != key:
+        with open(MANIFEST_DIR + alias + '.version') as v:
+            versions[alias] = (key, v.read())
+    return versions[alias][1]
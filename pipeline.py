@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import time
+import zlib
+from queue import Queue
+from threading import Thread, Event
+from utils.utils import *
+from utils.instrument import timer, count
+from indexer import getAliasIndices, bumpVersion
+
+# end of the stream, forwarded by every stage to the next one
+STOP = object()
+
+
+class FileTailer:
+    """
+    Follows a tweets source, each poll returns the tweets added since the previous one:
+    - JSON lines file (.jsonl): read from the last offset, an incomplete last line is read at the next poll;
+    - store directory written by the scraper (see utils/tweetstore.py): every shard is followed from its last offset,
+      the gzip compressed ones from the end of their last complete gzip member (the store appends a member with
+      every write), so only the new members are decompressed and the unchanged shards are not read at all;
+    - JSON file with the tweets ids as keys (rewritten as a whole): read again when it changes, only the tweets not
+      returned yet are returned.
+    Parameters
+    ----------
+    path : str
+        Tweets file or store directory, it doesn't need to exist yet.
+    from_start : bool
+        Return the tweets already in the source at the first poll (default is False, only the new ones).
+    """
+
+    def __init__(self, path, from_start=False):
+        self.path = path
+        self.offsets = {}
+        self.partial = {}
+        self.seen = set()
+        self.stat = None
+        if not from_start:
+            self.poll()
+
+    def poll(self):
+        """
+        Returns
+        -------
+        list
+            The (tweet_id, tweet) pairs added to the source since the previous poll.
+        """
+        if os.path.isdir(self.path):
+            return [tweet for file in shards(self.path) for tweet in self.follow(file)]
+        if not os.path.exists(self.path):
+            return []
+        if self.path.endswith(('.jsonl', '.jsonl.gz')):
+            return self.follow(self.path)
+        return self.reread()
+
+    def follow(self, file):
+        # new complete lines of a JSON lines file
+        offset = self.offsets.get(file, 0)
+        size = os.path.getsize(file)
+        if size < offset:
+            # file truncated or replaced
+            offset = 0
+            self.partial.pop(file, None)
+        if size == offset:
+            return []
+        with open(file, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+
+        if file.endswith('.gz'):
+            # complete gzip members after the offset, an incomplete one is decompressed again at the next poll
+            chunks = [self.partial.pop(file, b'')]
+            while data:
+                member = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                try:
+                    chunk = member.decompress(data)
+                except zlib.error:
+                    break
+                if not member.eof:
+                    break
+                chunks.append(chunk)
+                offset += len(data) - len(member.unused_data)
+                data = member.unused_data
+            data = b''.join(chunks)
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                # a line split between two members
+                self.partial[file] = data[end:]
+            self.offsets[file] = offset
+        else:
+            end = data.rfind(b'\n') + 1
+            self.offsets[file] = offset + end
+        lines = data[:end].decode('utf-8').splitlines()
+
+        tweets = []
+        for line in lines:
+            if line.strip():
+                tweet = json.loads(line)
+                tweets.append((tweet['tweet_id'], tweet))
+        return tweets
+
+    def reread(self):
+        # tweets of a JSON file not returned yet, read again only when the file changed
+        stat = file_stat(self.path)
+        if stat == self.stat:
+            return []
+        try:
+            tweets = [(tweet_id, tweet) for tweet_id, tweet in iter_tweets(self.path) if tweet_id not in self.seen]
+        except json.JSONDecodeError:
+            # file still being written
+            return []
+        self.stat = stat
+        self.seen.update(tweet_id for tweet_id, tweet in tweets)
+        return tweets
+
+
+class Stage(Thread):
+    """
+    Stage of the pipeline running in its own thread: the batches of the inbox queue are processed by work and its
+    results (when not None) are put in the outbox queue. The queues are bounded, so a stage blocks while the next one
+    is behind (backpressure) and the slowest stage sets the pace of the ones before it instead of letting the queues
+    grow. The items and batches processed, the busy time and the time blocked on the outbox are measured.
+    Parameters
+    ----------
+    name : str
+        Stage name, used in the reports and in the instrumentation timers (pipeline.<name>).
+    work : callable
+        Function processing a batch.
+    inbox : Queue
+        Queue of the input batches, the STOP marker ends the stage.
+    outbox : Queue
+        Queue of the output batches (None for the last stage).
+    size : callable
+        Number of items of an input batch (default is len).
+    """
+
+    def __init__(self, name, work, inbox, outbox=None, size=len):
+        super().__init__(name=name, daemon=True)
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.size = size
+        self.items = 0
+        self.batches = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+
+    def run(self):
+        while True:
+            batch = self.inbox.get()
+            if batch is STOP:
+                break
+            self.process(batch)
+        if self.outbox is not None:
+            self.outbox.put(STOP)
+
+    def process(self, batch):
+        start = time.perf_counter()
+        try:
+            with timer('pipeline.' + self.name):
+                result = self.work(batch)
+        except Exception as e:
+            # a failed batch is reported and dropped, the stream goes on
+            self.errors += 1
+            result = None
+            print(r("ERROR: ") + "%s: %s" % (self.name, e))
+        done = time.perf_counter()
+        if self.outbox is not None and result is not None:
+            self.outbox.put(result)
+        self.blocked += time.perf_counter() - done
+        self.busy += done - start
+        self.items += self.size(batch)
+        self.batches += 1
+        count('pipeline.%s.items' % self.name, self.size(batch))
+
+    def stats(self):
+        return {'items': self.items, 'batches': self.batches, 'errors': self.errors, 'busy_s': self.busy,
+                'blocked_s': self.blocked, 'queue': self.outbox.qsize() if self.outbox is not None else 0}
+
+
+class Producer(Stage):
+    """
+    First stage of the pipeline: polls a FileTailer every poll seconds and puts the new tweets in the outbox, in
+    batches of at most batch_size tweets (dictionaries with the tweets ids as keys). While the outbox is full the
+    source is not read.
+    """
+
+    def __init__(self, name, tailer, outbox, batch_size=500, poll=1.0, stopped=None):
+        super().__init__(name, None, None, outbox)
+        self.tailer = tailer
+        self.batch_size = batch_size
+        self.poll = poll
+        self.stopped = stopped or Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            try:
+                with timer('pipeline.' + self.name):
+                    tweets = self.tailer.poll()
+            except (OSError, ValueError) as e:
+                self.errors += 1
+                tweets = []
+                print(r("ERROR: ") + "%s: %s" % (self.name, e))
+            self.busy += time.perf_counter() - start
+            for i in range(0, len(tweets), self.batch_size):
+                batch = dict(tweets[i:i + self.batch_size])
+                done = time.perf_counter()
+                self.outbox.put(batch)
+                self.blocked += time.perf_counter() - done
+                self.items += len(batch)
+                self.batches += 1
+                count('pipeline.%s.items' % self.name, len(batch))
+            if not tweets:
+                self.stopped.wait(self.poll)
+        self.outbox.put(STOP)
+
+
+class IngestPipeline:
+    """
+    Streaming ingest of the tweets, so the new news become searchable and the new users tweets change the
+    personalization within seconds instead of after the next batch indexing and profiles rebuild:
+        news:  read (FileTailer) -> analyze (Preprocessor.analyze_news) -> index (bulk upsert)
+        users: read (FileTailer) -> analyze (Preprocessor.analyze_tweets) -> profiles (Preprocessor.ingest)
+    The news are upserted by tweet id in the index behind the alias (the one written by indexDocuments), then the
+    version of the alias is bumped, so the cached query results are invalidated; their analysis is cached by the
+    preprocessor, so their first personalization doesn't pay it, and a tweet upserted again with a new text replaces
+    its cached analysis. The users tweets are added to the profiles of the preprocessor (the changed ones replace
+    their previous version), replaced at once for the concurrent queries.
+    Every stage runs in its own thread and the stages are connected by queues of at most queue_size batches, a slow
+    stage blocks the ones before it down to the reading of the source (backpressure).
+    Parameters
+    ----------
+    es : Elasticsearch
+        Client of the news index (or any object with the same bulk method, e.g. the embedded bm25.Client).
+    index : str
+        Index (or alias) name of the news.
+    preprocessor : Preprocessor
+        Preprocessor of the users tweets (None to only index the news).
+    news : str
+        News tweets source followed by the pipeline (file or store directory, None for no news).
+    users : str
+        Users tweets source followed by the pipeline (file or store directory, None for no users tweets).
+    queue_size : int
+        Maximum number of batches waiting between two stages (default is 4).
+    batch_size : int
+        Maximum number of tweets of a batch (default is 500).
+    poll : float
+        Seconds between two polls of a source without new tweets (default is 1).
+    from_start : bool
+        Ingest also the tweets already in the sources (default is False).
+    """
+
+    def __init__(self, es, index, preprocessor=None, news=None, users=None, queue_size=4, batch_size=500, poll=1.0,
+                 from_start=False):
+        self.es = es
+        self.index = index
+        self.preprocessor = preprocessor
+        self.queue_size = queue_size
+        self.stopped = Event()
+        self.stages = []
+        self.started = None
+        self.last = {}
+
+        if news is not None:
+            steps = [('analyze', self.analyze_news, len)] if preprocessor is not None else []
+            self.chain('news', FileTailer(news, from_start), batch_size, poll,
+                       steps + [('index', self.index_news, len)])
+        if users is not None:
+            if preprocessor is None:
+                raise ValueError("a preprocessor is needed to ingest the users tweets")
+            self.chain('users', FileTailer(users, from_start), batch_size, poll,
+                       [('analyze', self.analyze_users, len), ('profiles', self.ingest_users, lambda b: len(b[0]))])
+
+    def chain(self, name, tailer, batch_size, poll, steps):
+        # producer followed by the steps, connected by bounded queues
+        queue = Queue(self.queue_size)
+        self.stages.append(Producer(name + '.read', tailer, queue, batch_size, poll, self.stopped))
+        for i, (step, work, size) in enumerate(steps):
+            outbox = Queue(self.queue_size) if i < len(steps) - 1 else None
+            self.stages.append(Stage(name + '.' + step, work, queue, outbox, size))
+            queue = outbox
+
+    def analyze_news(self, batch):
+        # the cache is keyed by id and text fingerprint, so the edited tweets of the batch are analyzed again
+        self.preprocessor.analyze_news([{'_id': tweet_id, '_source': tweet} for tweet_id, tweet in batch.items()])
+        return batch
+
+    def index_news(self, batch):
+        # the index currently behind the alias, it changes when indexDocuments swaps it
+        indices = getAliasIndices(self.es, self.index) if hasattr(self.es, 'indices') else []
+        target = indices[0] if len(indices) == 1 else self.index
+        body = ''.join(json.dumps({'index': {'_index': target, '_id': tweet_id}}) + '\n' + json.dumps(tweet) + '\n'
+                       for tweet_id, tweet in batch.items())
+        res = self.es.bulk(body=body)
+        failed = [item for item in res['items'] for result in item.values() if 'error' in result]
+        for item in failed[:10]:
+            print(r("Failed: ") + json.dumps(item))
+        count('pipeline.news.failed', len(failed))
+        bumpVersion(self.index, target)
+
+    def analyze_users(self, batch):
+        return batch, self.preprocessor.analyze_tweets(batch)
+
+    def ingest_users(self, batch):
+        data, analyzed = batch
+        self.preprocessor.ingest(data, analyzed)
+
+    def start(self):
+        """
+        Starts the stages, the users profiles are loaded first.
+        """
+        if self.preprocessor is not None:
+            self.preprocessor.load_profiles()
+        self.started = time.perf_counter()
+        self.last = {stage.name: (self.started, 0) for stage in self.stages}
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        """
+        Stops reading the sources and waits until the batches already read went through all the stages.
+        """
+        self.stopped.set()
+        for stage in self.stages:
+            stage.join()
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict
+            For each stage the items and batches processed, the failed batches, the busy time, the time blocked on
+            the next stage, the batches waiting for it and its throughput (items/sec) since the start.
+        """
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        return {stage.name: dict(stage.stats(), items_per_sec=stage.items / elapsed if elapsed else 0.0)
+                for stage in self.stages}
+
+    def report(self):
+        """
+        Prints the throughput of each stage since the previous report.
+        """
+        now = time.perf_counter()
+        for stage in self.stages:
+            since, items = self.last.get(stage.name, (self.started, 0))
+            rate = (stage.items - items) / (now - since) if now > since else 0.0
+            self.last[stage.name] = (now, stage.items)
+            stats = stage.stats()
+            print("  %-16s %s items/sec  %8d items  busy %5.1fs  blocked %5.1fs  queue %d/%d%s" % (
+                stage.name, g("%10.1f" % rate), stats['items'], stats['busy_s'], stats['blocked_s'], stats['queue'],
+                self.queue_size, r("  %d errors" % stats['errors']) if stats['errors'] else ""))
+
+    def run(self, duration=None, interval=10):
+        """
+        Runs the pipeline for duration seconds (until interrupted if None), reporting the throughput of the stages
+        every interval seconds.
+        """
+        self.start()
+        end = None if duration is None else time.perf_counter() + duration
+        try:
+            while end is None or time.perf_counter() < end:
+                time.sleep(interval if end is None else max(0.0, min(interval, end - time.perf_counter())))
+                self.report()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            pprint(g("Pipeline stopped"))
+            self.report()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Streaming ingest of the news and users tweets")
+    parser.add_argument('--news', default=None, help="news tweets file or store directory to follow")
+    parser.add_argument('--users', default=None, help="users tweets file or store directory to follow")
+    parser.add_argument('--users-tweets', nargs='+', default=None,
+                        help="other users tweets files of the profiles")
+    parser.add_argument('--index', default='twitter_index', help="index (or alias) name of the news")
+    parser.add_argument('--es', nargs='+', default=None, help="Elasticsearch hosts")
+    parser.add_argument('--bm25', action='store_true',
+                        help="index the news in an embedded BM25 index (for tests and benchmarks)")
+    parser.add_argument('--n-features', type=int, default=None)
+    parser.add_argument('--queue-size', type=int, default=4, help="batches waiting between two stages")
+    parser.add_argument('--batch-size', type=int, default=500, help="tweets of each batch")
+    parser.add_argument('--poll', type=float, default=1.0, help="seconds between two polls of the sources")
+    parser.add_argument('--from-start', action='store_true', help="ingest also the tweets already in the sources")
+    parser.add_argument('--report', type=float, default=10, help="seconds between two throughput reports")
+    parser.add_argument('--duration', type=float, default=None, help="seconds to run (default is until interrupted)")
+    args = parser.parse_args()
+
+    if args.news is None and args.users is None:
+        parser.error("at least one of --news and --users is required")
+
+    if args.bm25:
+        from bm25 import Client
+        es = Client()
+    else:
+        from search import getClient
+        es = getClient(args.es)
+    preprocessor = None
+    if args.users is not None:
+        from preprocessor import Preprocessor
+        # the followed users tweets are also a source of the profiles, so they are kept after a restart
+        users_tweets = list(args.users_tweets or [])
+        if args.users not in users_tweets:
+            users_tweets.append(args.users)
+        preprocessor = Preprocessor(users_tweets, n_features=args.n_features)
+
+    IngestPipeline(es, args.index, preprocessor, args.news, args.users, args.queue_size, args.batch_size, args.poll,
+                   args.from_start).run(args.duration, args.report)
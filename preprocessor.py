@@ -1,23 +1,141 @@
 import re
+import regex
 import string
 import emoji
 import json
-import pandas as pd
-import nltk
-import pickle
 import sys
 import os
 import numpy as np
-from nltk import word_tokenize, sent_tokenize, pos_tag
-from nltk.tokenize import WordPunctTokenizer, RegexpTokenizer
-from nltk.corpus import stopwords
-from nltk.stem.porter import PorterStemmer
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn import preprocessing
-from collections import Counter, OrderedDict
-from operator import itemgetter
+from scipy.sparse import csr_matrix, diags, vstack
+from collections import Counter
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool
+from threading import Lock
 from utils.utils import *
+from utils.instrument import timer, count
+from store import ProfileStore, save_store
+from frequency import Vocabulary, TermCounts, HashingVocabulary, TweetTable
+
+
+def char_ranges(chars):
+	'''
+	Build a regex matching a single character of chars, expressed as ranges of consecutive code points (a plain 
+	character set of many non-ASCII characters is really slow to match) and checking the ASCII ones first.
+	:param chars: iterable of the characters to be matched;
+	:return: the regex pattern
+	'''
+	chars = sorted(set(chars))
+	ascii = ''.join(re.escape(c) for c in chars if ord(c) < 128)
+	ranges = []
+	for c in (ord(c) for c in chars if ord(c) >= 128):
+		if ranges and c == ranges[-1][1] + 1:
+			ranges[-1][1] = c
+		else:
+			ranges.append([c, c])
+	others = ''.join(re.escape(chr(a)) + ('-' + re.escape(chr(b)) if b > a else '') for a, b in ranges)
+
+	return '(?:[' + ascii + ']|(?=[^\\x00-\\x7f])[' + others + '])'
+
+
+LINK_RE = re.compile(r'http\S+')
+USER_RE = re.compile(r'@(\S+)')
+EMOJI_MAXLEN = max(len(e) for e in emoji.UNICODE_EMOJI)
+# emojis are matched by their first code point, then the longest emoji starting there is looked up
+EMOJI_START = char_ranges(e[0] for e in emoji.UNICODE_EMOJI)
+EMOJI_START_RE = re.compile(EMOJI_START)
+ENTITY_RE = re.compile(r'(?P<link>http\S+)|@(?P<user>\S+)|(?P<emoji>' + EMOJI_START + ')')
+DIGITS_RE = re.compile(r'\d+')
+# same tokens of nltk WordPunctTokenizer, matched with the regex module (its \w includes marks and joiners)
+WORDPUNCT_RE = regex.compile(r'\w+|[^\w\s]+', regex.UNICODE | regex.MULTILINE | regex.DOTALL)
+# dashes and quotes are replaced by a space, the other punctuation is removed
+PUNCT_TABLE = str.maketrans({**dict.fromkeys(string.punctuation), **dict.fromkeys('—’-”“‘', ' ')})
+
+
+def match_emoji(text, pos):
+	'''
+	Return the longest emoji (also composed by more than one code point) that starts at pos inside text.
+	:param text: text in which search the emoji;
+	:param pos: position of the first code point of the emoji;
+	:return: the emoji or None if there isn't an emoji at pos
+	'''
+	for end in range(min(len(text), pos + EMOJI_MAXLEN), pos, -1):
+		if text[pos:end] in emoji.UNICODE_EMOJI:
+			return text[pos:end]
+
+
+def find_emojis(text):
+	'''
+	Return all the emojis inside text, the emojis composed by more than one code point are not split.
+	:param text: text in which search the emojis;
+	:return: a list that contains all emojis identified inside the text
+	'''
+	emojis = []
+	last = 0
+	for match in EMOJI_START_RE.finditer(text):
+		if match.start() >= last:
+			found = match_emoji(text, match.start())
+			if found:
+				emojis.append(found)
+				last = match.start() + len(found)
+
+	return emojis
+
+
+@lru_cache(maxsize=None)
+def porter():
+	'''
+	Porter stemmer shared by all the preprocessors, nltk (more than a second to import) is loaded at the first use.
+	'''
+	from nltk.stem.porter import PorterStemmer
+	return PorterStemmer()
+
+
+@lru_cache(maxsize=100000)
+def stem(word):
+	'''
+	Porter stemming of word, memoized for all the preprocessors of the process since the words repeat a lot across tweets.
+	:param word: word to be stemmed;
+	:return: the stem of the word
+	'''
+	return porter().stem(word)
+
+
+def l2_normalize(matrix):
+	'''
+	Scale each row of a sparse matrix to unit l2 norm, the rows of zeros are left as they are.
+	:param matrix: sparse matrix;
+	:return: the normalized CSR matrix
+	'''
+	matrix = csr_matrix(matrix, dtype=np.float64, copy=True)
+	lengths = np.diff(matrix.indptr)
+	norms = np.sqrt(np.bincount(np.repeat(np.arange(len(lengths)), lengths), weights=matrix.data ** 2, 
+		minlength=len(lengths)))
+	norms[norms == 0] = 1.0
+	matrix.data /= np.repeat(norms, lengths)
+	return matrix
+
+# English closed-class words (determiners, pronouns, prepositions, conjunctions, auxiliaries, particles and numerals) 
+# filtered instead of the functional POS tags when the tagger is disabled
+CLOSED_CLASS_WORDS = frozenset("""
+	a an the this that these those some any each every either neither no all both half several many much more most 
+	few fewer less least other another such what which whatever whichever whose
+	i me my mine myself we us our ours ourselves you your yours yourself yourselves he him his himself she her hers 
+	herself it its itself they them their theirs themselves one oneself who whom whoever whomever someone somebody 
+	something anyone anybody anything everyone everybody everything nobody nothing none
+	about above across after against along amid among around as at before behind below beneath beside besides 
+	between beyond by despite down during except for from in inside into like near of off on onto out outside over 
+	past per since than through throughout till to toward towards under underneath unlike until up upon via with 
+	within without
+	and but or nor so yet for although because if unless whereas while whether though once lest
+	am is are was were be been being have has had having do does did doing will would shall should can could may 
+	might must ought
+	not to there here then thus hence however therefore
+	zero two three four five six seven eight nine ten eleven twelve hundred thousand million billion first second 
+	third
+""".split())
+TAGGERS = ('perceptron', 'lexicon', 'none')
+LEXICON_PATH = './utils/pos_lexicon.json'
 
 # Need to be downloaded only once at the first execution
 # nltk.download('stopwords')
@@ -25,9 +143,20 @@ from utils.utils import *
 # nltk.download('averaged_perceptron_tagger')
 
 class Preprocessor:
-	def __init__(self, filesName):
+	def __init__(self, filesName, news_cache_size=10000, workers=1, chunksize=500, tagger='perceptron', 
+				 n_features=None):
+		if tagger not in TAGGERS:
+			raise ValueError("tagger must be one of %s" % ', '.join(TAGGERS))
 		self.fileNames = filesName
-		self.tweets = {'tweets': {}, 'frequency': {}}
+		self.tagger = tagger
+		self.lexicon = None
+		self.workers = workers
+		self.chunksize = chunksize
+		# with n_features the profiles are vectorized with the hashing trick
+		self.n_features = n_features
+		self.tweets = {'tweets': {}, 'frequency': {}, 'sources': {}, 'fingerprints': {}}
+		# the tokens of the tweets (as term ids) and the five corpus_counter share a single vocabulary
+		self.vocabulary = Vocabulary()
 		self.freq_text = dict()
 		self.freq_user = dict()
 		self.freq_links = dict()
@@ -35,11 +164,123 @@ class Preprocessor:
 		self.freq_hashtags = dict()
 		self.TFD = {}
 		self.data = {}
-		self.porter = PorterStemmer()
-		stopwords.words('english')
-		self.stop_words = nltk.corpus.stopwords.words('english')
-		self.functional_words = ["ADP", "AUX", "CCONJ", "DET", "NUM", "PART", "PRON", "SCONJ", "PUNCT", "SYM", "X"]
+		self.profiles = None
+		self.profiles_version = None
+		self.profiles_lock = Lock()
+		self.news_cache = LRUCache(news_cache_size)
+		from nltk.corpus import stopwords
+		self.porter = porter()
+		self.stop_words = set(stopwords.words('english'))
+		self.functional_words = {"ADP", "AUX", "CCONJ", "DET", "NUM", "PART", "PRON", "SCONJ", "PUNCT", "SYM", "X"}
+		# without POS tags the closed-class words are filtered together with the stopwords
+		self.filter_words = self.stop_words | CLOSED_CLASS_WORDS if tagger == 'none' else self.stop_words
 	
+	def extract_entities(self, text):
+		'''
+		Identifies in a single pass over the tweet text all URLs, user_ids and emojis (also the ones composed by more 
+		than one code point) and produce the filtered text's tokens: lowercaps, without URLs, user_ids, numbers, 
+		special characters and punctuation.
+		:param text: text of the tweet;
+		:return: tuple with the lists of tokens, user_ids, URLs and emojis identified inside the text
+		'''
+		pieces = []
+		users = []
+		links = []
+		emojis = []
+		last = 0
+		last_emoji = 0
+
+		for match in ENTITY_RE.finditer(text):
+			kind = match.lastgroup
+			if kind == 'emoji':
+				if match.start() >= last_emoji:
+					found = match_emoji(text, match.start())
+					if found:
+						emojis.append(found)
+						last_emoji = match.start() + len(found)
+				continue
+
+			# URLs and user_ids are removed from the text, but they can contain each other and emojis
+			pieces.append(text[last:match.start()])
+			last = match.end()
+			if kind == 'link':
+				links.append(match.group())
+				users.extend(USER_RE.findall(match.group()))
+			else:
+				users.append(match.group('user'))
+				links.extend(LINK_RE.findall(match.group()))
+			emojis.extend(find_emojis(match.group()))
+
+		pieces.append(text[last:])
+		new_text = DIGITS_RE.sub('', ''.join(pieces).lower().translate(PUNCT_TABLE))
+
+		return WORDPUNCT_RE.findall(new_text), users, links, emojis
+
+	def build_lexicon(self, sentences, min_count=5):
+		'''
+		Build the word->tag lexicon of the unambiguous frequent words, tagging the sentences with the POS tagger: a word 
+		is added if it appears at least min_count times and always with the same tag.
+		:param sentences: list of tokenized sentences;
+		:param min_count: minimum number of occurrences of a word;
+		:return: dictionary with words as keys and their POS tag as values
+		'''
+		import nltk
+		tags = {}
+		for tagged in nltk.pos_tag_sents(sentences):
+			for word, tag in tagged:
+				tags.setdefault(word, Counter())[tag] += 1
+
+		return {word: next(iter(c)) for word, c in tags.items() if len(c) == 1 and sum(c.values()) >= min_count}
+
+	def load_lexicon(self):
+		'''
+		Try to retrive the POS tag lexicon, otherwise build it from the tweets in fileNames and save it.
+		:return: dictionary with words as keys and their POS tag as values
+		'''
+		if self.lexicon is not None:
+			return self.lexicon
+
+		try:
+			self.lexicon = json.load(open(LEXICON_PATH))
+		except (OSError, ValueError):
+			print("POS tag lexicon not yet built.")
+			sentences = []
+			for file in filter(os.path.exists, self.fileNames):
+				for tweet_id, tweet in iter_tweets(file):
+					sentences.append(self.extract_entities(tweet['text'])[0])
+			self.lexicon = self.build_lexicon(sentences)
+			print("Saving POS tag lexicon in " + y(LEXICON_PATH))
+			json.dump(self.lexicon, open(LEXICON_PATH, 'w'))
+
+		return self.lexicon
+
+	def tag(self, sentences):
+		'''
+		POS tagging of many tokenized sentences at once, with the strategy selected by the tagger attribute:
+		'perceptron' tags all the sentences with the nltk tagger, 'lexicon' uses the tags of the lexicon for the 
+		sentences composed only by known words and the nltk tagger for the others, 'none' doesn't tag the sentences.
+		:param sentences: list of tokenized sentences;
+		:return: a list with the tagged sentences, tokens with the associated POS tag
+		'''
+		if self.tagger == 'none':
+			return [[(word, None) for word in sentence] for sentence in sentences]
+		import nltk
+		if self.tagger == 'perceptron':
+			return nltk.pos_tag_sents(sentences)
+
+		lexicon = self.load_lexicon()
+		tagged = [None] * len(sentences)
+		unknown = []
+		for i, sentence in enumerate(sentences):
+			if all(word in lexicon for word in sentence):
+				tagged[i] = [(word, lexicon[word]) for word in sentence]
+			else:
+				unknown.append(i)
+		for i, t in zip(unknown, nltk.pos_tag_sents([sentences[i] for i in unknown])):
+			tagged[i] = t
+
+		return tagged
+
 	def filter(self, text):
 		'''
 		Parse the text parameter, consists in following steps: lowercaps, filter it removing numbers, special 
@@ -48,137 +289,242 @@ class Preprocessor:
 		:param text: text of the tweet that must be filtered;
 		:return: the new_text filtered and POS tag associated with token
 		'''
-		new_text = re.sub(r'http\S+', '', text)
-		new_text = re.sub(r'@[^\s]+', '', new_text)
-		new_text = new_text.lower()
-		new_text = re.sub(r'—|’|’’|-|”|“|‘', ' ', new_text)
-		new_text = new_text.strip()
-		new_text = re.sub(r'\d+', '', new_text)
-		new_text = new_text.translate(str.maketrans('', '', string.punctuation))
-		new_text = WordPunctTokenizer().tokenize(new_text)
+		new_text = self.extract_entities(text)[0]
 		
-		tagged = nltk.pos_tag(new_text)
+		tagged = self.tag([new_text])[0]
 		
 		return new_text, tagged
 	
-	def generate_tokens(self, tweet, text):
+	def normalize(self, tagged):
+		'''
+		Remove functional and stop words from the POS tagged tokens and execute stemming's operation for each word, 
+		in a single pass that preserves the tokens order.
+		:param tagged: list of tokens with the associated POS tag;
+		:return: a list that contains the stemmed tokens
+		'''
+		return [stem(word) for word, tag in tagged if word not in self.filter_words and tag not in self.functional_words]
+
+	def generate_tokens(self, tweet, tagged):
 		'''
 		Creates a unique set of tokens that were identified after processing, filtering and lemmatize the corpus text.
 		Remove from it functional and stop words and execute stemming's operation for each word.
 		:param tweet: tweet id to identify the corresponding tweet and the corresponding text;
+		:param tagged: filtered tokens of the tweet text, produced by extract_entities, with the associated POS tag;
 		:return: a list that contains the parsed text
 		'''
 		
-		new_text, tagged = self.filter(text)
-		
-		for word in tagged:
-			if word[0] not in self.stop_words and word[1] not in self.functional_words:
-				lemma = self.porter.stem(word[0])
-				if lemma not in self.stop_words:
-					self.freq_text[self.data[tweet]['user_name']][lemma] += 1
-					new_text.remove(word[0])
-					new_text.append(lemma)
-			else:
-				new_text.remove(word[0])
-		return new_text
+		tokens = [lemma for lemma in self.normalize(tagged) if lemma not in self.stop_words]
+		self.freq_text[self.data[tweet]['user_name']].update(tokens)
+		return tokens
 	
-	def identify_emoji(self, tweet, text):
+	def identify_hashtags(self, tweet, hashtags):
 		'''
-		Identifies and return all emojis who are present inside the single tweet:
+		Identifies and return all hashtags who are present inside the single tweet:
 		:param tweet: tweet id to identify the corresponding tweet inside the tweets dictionary 'data';
-		:return: a list that contains all emojis identified inside the text
+		:return: a list that contains all hashtags identified inside the text
 		'''
-		
-		emojis = []
-		for pos, c in enumerate(text):
-			if c in emoji.UNICODE_EMOJI:
-				# print("Matched!!", c, c.encode("ascii", "backslashreplace"))
-				self.freq_emoji[self.data[tweet]['user_name']][c] += 1
-				emojis.append(c)
-		
-		return emojis
+		if not hashtags == [None]:
+			self.freq_hashtags[self.data[tweet]['user_name']].update(self.data[tweet]['hashtags'])
+			return self.data[tweet]['hashtags']
 	
-	def identify_user(self, tweet, text):
+	def parse_tweets(self, data):
 		'''
-		Identifies and return all user_id who are presents inside the single tweet:
-		:param tweet: tweet id to identify the corresponding tweet inside the tweets dictionary 'data';
-		:return: a list that contains all user_id identified inside the text
+		Pre-process the tweets contained in data, adding them to the tweets dictionary and updating the five corpus_counter.
+		:param data: dictionary of tweets with tweets ids as keys and their attributes as values;
 		'''
-		users = []
-		
-		user = re.compile(r'@(\S+)')
-		match_pattern = user.findall(text)
-		for us in match_pattern:
-			self.freq_user[self.data[tweet]['user_name']][us] += 1
-			users.append(us)
-		
-		return users
-	
-	def identify_links(self, tweet, text):
+		self.data = data
+		count('parser.tweets', len(data))
+		extracted, tagged = self.analyze_tweets(data)
+
+		with timer('parser.normalize'):
+			self.add_tweets(extracted, tagged)
+
+	def analyze_tweets(self, data):
 		'''
-		Identifies and return all URLs who are presents inside the single tweet:
-		:param tweet: tweet id to identify the corresponding tweet inside the tweets dictionary 'data';
-		:return: a list that contains all URLs identified inside the text
+		Extract the entities of the tweets contained in data and POS tag their text and user_ids, without adding them 
+		to the tweets dictionary (see add_tweets).
+		:param data: dictionary of tweets with tweets ids as keys and their attributes as values;
+		:return: tuple with the entities of each tweet, produced by extract_entities, and the POS tagged text of each 
+			tweet followed by the POS tagged user_ids of each tweet
 		'''
-		group = []
-		
-		link = re.compile(r'http\S+')
-		links = link.findall(text)
-		for us in links:
-			self.freq_links[self.data[tweet]['user_name']][us] += 1
-			group.append(us)
-		
-		return group
-	
-	def identify_hashtags(self, tweet, hashtags):
+		with timer('parser.extract_entities'):
+			extracted = [self.extract_entities(data[tweet]['text']) for tweet in data]
+			mentions = [self.extract_entities(' '.join(e[1]))[0] for e in extracted]
+		# the text and the user_ids of all the tweets are tagged in one batch
+		with timer('parser.tag'):
+			tagged = self.tag([e[0] for e in extracted] + mentions)
+
+		return extracted, tagged
+
+	def add_tweets(self, extracted, tagged):
 		'''
-		Identifies and return all hashtags who are present inside the single tweet:
-		:param tweet: tweet id to identify the corresponding tweet inside the tweets dictionary 'data';
-		:return: a list that contains all hashtags identified inside the text
+		Normalize the tagged tweets of data and add them to the tweets dictionary (the TweetTable of their user, which 
+		stores the tokens as term ids) and to the five corpus_counter.
+		:param extracted: entities of each tweet of data, produced by extract_entities;
+		:param tagged: POS tagged text of each tweet followed by the POS tagged user_ids of each tweet;
 		'''
-		if not hashtags == [None]:
-			for i in self.data[tweet]['hashtags']:
-				self.freq_hashtags[self.data[tweet]['user_name']][i] += 1
-			return self.data[tweet]['hashtags']
-	
+		for tweet, (tokens, user, links, emoji), tags, user_tags in zip(self.data, extracted, tagged, 
+																		tagged[len(extracted):]):
+			if not self.data[tweet]['user_name'] in self.freq_text:
+				self.add_user(self.data[tweet]['user_name'])
+			
+			tokenized = self.generate_tokens(tweet, tags)
+			hashtags = self.identify_hashtags(tweet, self.data[tweet]['hashtags'])
+			self.freq_emoji[self.data[tweet]['user_name']].update(emoji)
+			self.freq_links[self.data[tweet]['user_name']].update(links)
+			self.freq_user[self.data[tweet]['user_name']].update(user)
+
+			self.tweets['tweets'][self.data[tweet]['user_name']][tweet] = {
+				'author': self.data[tweet]['user_name'],
+				'screen_name': self.data[tweet]['screen_name'],
+				'date': self.data[tweet]['date'],
+				'text': self.data[tweet]['text'],
+				'tokenized': tokenized, 'user': user,
+				'user_tokenized': self.normalize(user_tags),
+				'hashtags': hashtags, 'emoji': emoji,
+				'links': links
+			}
+
+	def add_user(self, user):
+		'''
+		Add an user without tweets to the tweets dictionary and to the five corpus_counter.
+		:param user: user name;
+		'''
+		self.tweets['tweets'][user] = TweetTable(self.vocabulary)
+		for counter in (self.freq_text, self.freq_emoji, self.freq_links, self.freq_hashtags, self.freq_user):
+			counter[user] = TermCounts(self.vocabulary)
+
+	def merge(self, tweets, frequency):
+		'''
+		Merge into this preprocessor the tweets and the corpus_counter produced by another one (e.g. a parser worker).
+		:param tweets: pre-processed tweets dictionary, with users as keys and their TweetTable as values;
+		:param frequency: dictionary with the five corpus_counter, with users as keys;
+		'''
+		remap = None
+		for user in tweets:
+			if not user in self.freq_text:
+				self.add_user(user)
+
+			# the term ids of the other vocabulary are mapped on this one once for all the users
+			if remap is None:
+				remap = self.vocabulary.remap(tweets[user].vocabulary)
+			self.tweets['tweets'][user].extend(tweets[user], remap)
+			self.freq_text[user].update(frequency['freq_text'][user])
+			self.freq_emoji[user].update(frequency['freq_emoji'][user])
+			self.freq_links[user].update(frequency['freq_links'][user])
+			self.freq_hashtags[user].update(frequency['freq_hashtags'][user])
+			self.freq_user[user].update(frequency['freq_user'][user])
+
+	def remove_tweet(self, tweet):
+		'''
+		Remove a pre-processed tweet from the tweets dictionary and its contribution from the five corpus_counter (the 
+		terms whose count drops to 0 are removed from the counters).
+		:param tweet: tweet id of the tweet to be removed;
+		'''
+		for user in self.tweets['tweets']:
+			if tweet in self.tweets['tweets'][user]:
+				old = self.tweets['tweets'][user].pop(tweet)
+				for counter, values in ((self.freq_text, old['tokenized']), (self.freq_user, old['user']), 
+										(self.freq_hashtags, old['hashtags'] or []), (self.freq_links, old['links']), 
+										(self.freq_emoji, old['emoji'])):
+					counter[user].subtract(values)
+				break
+		self.tweets['fingerprints'].pop(tweet, None)
+
+	def track(self, file):
+		'''
+		Read the tweets of a file recording the fingerprint of its content and of each tweet, used to identify the 
+		changes at the next parsing.
+		A file that doesn't exist yet (e.g. the users tweets file of the ingest pipeline) is tracked as empty.
+		:param file: tweets file (or store directory) path;
+		:return: generator of the (tweet_id, tweet) pairs of the file
+		'''
+		if not os.path.exists(file):
+			self.tweets['sources'][file] = {'size': 0, 'mtime': None, 'digest': None, 'tweets': []}
+			return
+		size, mtime = file_stat(file)
+		ids = []
+		for tweet_id, tweet in iter_tweets(file):
+			self.tweets['fingerprints'][tweet_id] = fingerprint(tweet)
+			ids.append(tweet_id)
+			yield tweet_id, tweet
+		self.tweets['sources'][file] = {
+			'size': size, 'mtime': mtime, 'digest': file_digest(file), 'tweets': ids
+		}
+
+	def source_changed(self, file, sources):
+		'''
+		Check if a file changed since it was recorded in sources, comparing the file size and modification time and 
+		then, if they differ, its content fingerprint. A missing file is compared as an empty one.
+		:param file: tweets file (or store directory) path;
+		:param sources: dictionary of the recorded files;
+		:return: True if the file is new or its content changed
+		'''
+		source = sources.get(file)
+		if source is None:
+			return True
+		exists = os.path.exists(file)
+		size, mtime = file_stat(file) if exists else (0, None)
+		if size == source['size'] and mtime == source['mtime']:
+			return False
+		return (file_digest(file) if exists else None) != source['digest']
+
+	def parse_stream(self, tweets, pool=None):
+		'''
+		Pre-process the (tweet_id, tweet) pairs read in shards of chunksize tweets. If pool is given the shards are 
+		parsed by the pool of processes, the partial results are merged in the shards order so the output is the same 
+		of the serial parsing.
+		:param tweets: iterator of (tweet_id, tweet) pairs;
+		:param pool: optional multiprocessing pool;
+		'''
+		def read():
+			with timer('parser.read'):
+				return dict(islice(tweets, self.chunksize))
+
+		if pool is None:
+			for shard in iter(read, {}):
+				self.parse_tweets(shard)
+			return
+
+		# a bounded number of shards is read and sent to the workers at once
+		while True:
+			shards = [read() for _ in range(2 * self.workers)]
+			shards = [shard for shard in shards if shard]
+			if not shards:
+				break
+			count('parser.tweets', sum(map(len, shards)))
+			for shard_tweets, frequency in pool.imap(parse_shard, 
+					[(shard, self.tagger, self.lexicon) for shard in shards]):
+				with timer('parser.merge'):
+					self.merge(shard_tweets, frequency)
+
 	def parser(self):
 		'''
 		Transforms all the corpus in the filesName insert them into dictionary whit tweets ids as keys and their 
 		attributes as values into a similar dictionary with more attributes for the same tweet as tokenized message, 
 		emojis, URLs, and user_id that are contained into original tweet.
+		The files are read incrementally in shards of chunksize tweets. If workers is greater than one the shards are 
+		parsed by a pool of processes, the partial results are merged in the shards order so the output is the same of 
+		the serial parsing.
 
 		:return: a list of dictionaries for each tweet, containing their id, author, original text, tokenized text, 
 			hashtags, user_ids, emoji, and URLs;
-			Five corpus_counter of the words, emoji, hashtags, URLs and user_ids and their corresponding frequencies.
+			Five corpus_counter of the words, emoji, hashtags, URLs and user_ids and their corresponding frequencies;
+			The fingerprints of the files and of the tweets parsed.
 		'''
-		for file in self.fileNames:
-			self.data = json.load(open(file))
-			for tweet in self.data:
-				if not self.data[tweet]['user_name'] in self.freq_text:
-					self.tweets['tweets'][self.data[tweet]['user_name']] = {}
-					self.tweets['frequency'][self.data[tweet]['user_name']] = {}
-					self.freq_text[self.data[tweet]['user_name']] = Counter()
-					self.freq_emoji[self.data[tweet]['user_name']] = Counter()
-					self.freq_links[self.data[tweet]['user_name']] = Counter()
-					self.freq_hashtags[self.data[tweet]['user_name']] = Counter()
-					self.freq_user[self.data[tweet]['user_name']] = Counter()
-				
-				tokenized = self.generate_tokens(tweet, self.data[tweet]['text'])
-				emoji = self.identify_emoji(tweet, self.data[tweet]['text'])
-				links = self.identify_links(tweet, self.data[tweet]['text'])
-				hashtags = self.identify_hashtags(tweet, self.data[tweet]['hashtags'])
-				user = self.identify_user(tweet, self.data[tweet]['text'])
-
-				self.tweets['tweets'][self.data[tweet]['user_name']][tweet] = {
-					'author': self.data[tweet]['user_name'],
-					'screen_name': self.data[tweet]['screen_name'],
-					'date': self.data[tweet]['date'],
-					'text': self.data[tweet]['text'],
-					'tokenized': tokenized, 'user': user,
-					'hashtags': hashtags, 'emoji': emoji,
-					'links': links
-				}
+		pool = Pool(self.workers) if self.workers > 1 else None
+		if pool is not None and self.tagger == 'lexicon':
+			self.load_lexicon()
 
+		try:
+			for file in self.fileNames:
+				with timer('parser'):
+					self.parse_stream(self.track(file), pool)
+		finally:
+			# the workers are released also when a shard fails
+			if pool is not None:
+				pool.close()
+				pool.join()
 
 		self.tweets['frequency'] = {
 			'freq_text': self.freq_text,
@@ -189,6 +535,42 @@ class Preprocessor:
 		}
 		
 		return self.tweets
+
+	def refresh(self):
+		'''
+		Update the pre-processed tweets with the changes of the files in fileNames since their last parsing: only the 
+		new or changed tweets are pre-processed and the removed ones are subtracted from the corpus_counter.
+		:return: number of tweets added, changed or removed
+		'''
+		changed = 0
+		for file in self.fileNames:
+			if not self.source_changed(file, self.tweets['sources']):
+				continue
+
+			previous = self.tweets['sources'].get(file, {'tweets': []})['tweets']
+			fingerprints = dict(self.tweets['fingerprints'])
+			new = {}
+			for tweet_id, tweet in self.track(file):
+				if fingerprints.get(tweet_id) != self.tweets['fingerprints'][tweet_id]:
+					new[tweet_id] = tweet
+			removed = set(previous) - set(self.tweets['sources'][file]['tweets'])
+
+			for tweet_id in removed | (new.keys() & fingerprints.keys()):
+				self.remove_tweet(tweet_id)
+			for tweet_id in new:
+				self.tweets['fingerprints'][tweet_id] = fingerprint(new[tweet_id])
+			self.parse_stream(iter(new.items()))
+
+			# users without tweets left are removed
+			for user in [user for user in self.tweets['tweets'] if not self.tweets['tweets'][user]]:
+				for freq in (self.tweets['tweets'], self.freq_text, self.freq_user, self.freq_hashtags, 
+								self.freq_links, self.freq_emoji):
+					del freq[user]
+
+			changed += len(new) + len(removed)
+			print("Updated %s tweets from %s" % (y(len(new) + len(removed)), y(file)))
+
+		return changed
 	
 	def preprocess_text(self, text):
 		'''
@@ -200,140 +582,494 @@ class Preprocessor:
 		
 		new_text, tagged = self.filter(text)
 		
-		for word in tagged:
-			if word[0] in self.stop_words or word[1] in self.functional_words:
-				new_text.remove(word[0])
-			else:
-				new_text.remove(word[0])
-				new_text.append(self.porter.stem(word[0]))
-		return new_text
-	
-	def get_similarity_score(self, corpus, cnews, vectoriser):
+		return self.normalize(tagged)
+
+	def preprocess_texts(self, texts):
 		'''
-		Compute and return similarity scores between two corpus.
-		:param corpus: user's tweet or mentions on whom will computed the tf-idf; 
-		:param cnews: news's text or mentions on whom will computed tf-idf;
-		:param vectoriser: fitted tf-idf vectorizer for transform input corpus;
-		:return: dataframe who contain the similarity score between tweet
+		Same of preprocess_text for many texts at once, the POS tagging of all the texts is executed in one batch.
+		:param texts: list of tweet's texts;
+		:return: a list that contains the parsed text of each text
 		'''
-
-		X = vectoriser.transform(corpus)
-		Y = vectoriser.transform(cnews)
 		
-		similarity = cosine_similarity(X, Y)
+		tagged = self.tag([self.extract_entities(text)[0] for text in texts])
 		
-		Pnews = pd.DataFrame(Y.toarray())
-		Pnews['score'] = preprocessing.minmax_scale(similarity[0])
-		
-		return Pnews
+		return [self.normalize(t) for t in tagged]
+	
+	def analyze_news(self, news):
+		'''
+		Analyze text and mentions of the news, the results are cached by the news Elasticsearch _id together with the 
+		fingerprint of their text: a news upserted with a new text under the same _id (e.g. by an incremental 
+		indexing) is analyzed again and its entry replaced. The news not yet cached are analyzed in one batch.
+		:param news: list of news returned by Elasticsearch (hits containing _id and _source);
+		:return: list with a tuple for each news, containing the analyzed text tokens and the analyzed mentions tokens
+		'''
+		digests = [fingerprint(n['_source']['text']) for n in news]
+		cached = [self.news_cache.get(n['_id']) for n in news]
+		analyzed = [c[1] if c is not None and c[0] == d else None for c, d in zip(cached, digests)]
+		missing = [i for i, a in enumerate(analyzed) if a is None]
+		count('news_cache.hits', len(news) - len(missing))
+		count('news_cache.misses', len(missing))
+
+		if missing:
+			texts = [news[i]['_source']['text'] for i in missing]
+			mentions = [' '.join(self.extract_entities(text)[1]) for text in texts]
+			tokens = self.preprocess_texts(texts + mentions)
+			for j, i in enumerate(missing):
+				analyzed[i] = (tokens[j], tokens[len(missing) + j])
+				self.news_cache[news[i]['_id']] = (digests[i], analyzed[i])
+
+		return analyzed
+
+	def get_similarity_score(self, profile, rows, cnews):
+		'''
+		Compute and return similarity scores between users profiles and news. The profiles and the news rows are l2 
+		normalized, so the cosine similarity is the sparse product of the two matrices; only the users × news scores 
+		are dense.
+		:param profile: users profile (text or mentions) produced by build_profiles;
+		:param rows: indexes of the users, inside the profile matrix, to be scored (None for all the users);
+		:param cnews: analyzed news's text or mentions on whom will computed tf-idf;
+		:return: array with the similarity scores, scaled between 0 and 1, of each user (rows) for each news (columns)
+		'''
+
+		return minmax(self.similarity(profile, rows, cnews))
+
+	def similarity(self, profile, rows, cnews):
+		'''
+		Cosine similarity between users profiles and news, not scaled.
+		:param profile: users profile (text or mentions) produced by build_profiles;
+		:param rows: indexes of the users, inside the profile matrix, to be scored (None for all the users);
+		:param cnews: analyzed news's text or mentions on whom will computed tf-idf;
+		:return: array with the similarity scores of each user (rows) for each news (columns)
+		'''
+		X = profile['matrix'] if rows is None else profile['matrix'][rows]
+		if not cnews:
+			return np.zeros((X.shape[0], 0))
+		Y = self.transform(profile, cnews)
+
+		return np.asarray((X @ Y.T).todense())
+
+	def transform(self, profile, docs):
+		'''
+		Project analyzed documents over the vocabulary of a profile and weight them with its idf, the terms out of the 
+		vocabulary are ignored.
+		:param profile: users profile (text or mentions) produced by build_profiles;
+		:param docs: list of analyzed documents (lists of terms);
+		:return: documents × terms tf-idf sparse matrix, rows normalized with l2 norm
+		'''
+		counts = self.count_matrix(profile['vocabulary'], [Counter(doc) for doc in docs], len(profile['idf']))
+
+		return l2_normalize(counts @ diags(profile['idf']))
+
+	def count_matrix(self, vocabulary, counts, terms):
+		'''
+		Build the sparse matrix of the terms counts projected over a vocabulary, the terms out of the vocabulary are 
+		ignored and the counts of the terms mapped on the same column (hash collisions) are summed.
+		:param vocabulary: mapping of the terms to their columns (dictionary, Vocabulary or HashingVocabulary);
+		:param counts: list of Counter of the terms, one for each row;
+		:param terms: number of columns;
+		:return: rows × terms sparse matrix of the counts
+		'''
+		indptr = [0]
+		indices = []
+		data = []
+		for row_counts in counts:
+			for term, value in row_counts.items():
+				j = vocabulary.get(term)
+				# a shared vocabulary can grow after the profile was built
+				if j is not None and j < terms:
+					indices.append(j)
+					data.append(value)
+			indptr.append(len(indices))
+
+		matrix = csr_matrix((np.array(data, dtype=np.float64), indices, indptr), shape=(len(counts), terms))
+		matrix.sum_duplicates()
+
+		return matrix
+
+	def weight_profile(self, vocabulary, matrix):
+		'''
+		Weight the users terms counts with the smoothed idf, ln((1 + n) / (1 + df)) + 1, and normalize the rows with 
+		l2 norm.
+		:param vocabulary: mapping of the terms to the matrix columns;
+		:param matrix: users × terms sparse matrix of the counts;
+		:return: dictionary with the vocabulary, the idf array and the users × terms tf-idf sparse matrix, with 
+			hashing also the counts matrix used to update the profile
+		'''
+		df = np.bincount(matrix.indices, minlength=matrix.shape[1])
+		idf = np.log((1 + matrix.shape[0]) / (1 + df)) + 1
+		profile = {'vocabulary': vocabulary, 'idf': idf, 'matrix': l2_normalize(matrix @ diags(idf))}
+		if isinstance(vocabulary, HashingVocabulary):
+			profile['counts'] = matrix
+
+		return profile
+
+	def fit_profile(self, counts):
+		'''
+		Fit a tf-idf model over the users term counts, all the users share the same vocabulary. With n_features the 
+		terms are hashed in a fixed feature space, so no vocabulary is fitted.
+		:param counts: list of Counter, one for each user, of the analyzed terms;
+		:return: the profile produced by weight_profile
+		'''
+		if self.n_features:
+			vocabulary = HashingVocabulary(self.n_features)
+		else:
+			vocabulary = {term: j for j, term in enumerate(sorted(set().union(*counts)))}
+
+		return self.weight_profile(vocabulary, self.count_matrix(vocabulary, counts, len(vocabulary)))
+
+	def update_profile(self, profile, users, counts):
+		'''
+		Update a hashed profile without fitting: only the rows of the given users are hashed again, the rows of the 
+		other users are kept, then the global idf is recomputed from the counts.
+		:param profile: hashed profile (text or mentions) produced by build_profiles;
+		:param users: list of rows of the updated profile, the index of the row in the previous profile or None for the 
+			users to be hashed;
+		:param counts: list of Counter of the terms of the users to be hashed, in order;
+		:return: the updated profile
+		'''
+		vocabulary = profile['vocabulary']
+		previous = profile['counts'].shape[0]
+		stacked = vstack([profile['counts'], self.count_matrix(vocabulary, counts, len(vocabulary))]).tocsr()
+		new = iter(range(previous, previous + len(counts)))
+		rows = [next(new) if i is None else i for i in users]
+
+		return self.weight_profile(vocabulary, stacked[rows])
+
+	def user_counts(self, user):
+		'''
+		Terms counts of the tweets text and of the mentions of an user.
+		:param user: user name;
+		:return: tuple with the text and the mentions counts
+		'''
+		return self.freq_text[user], self.tweets['tweets'][user].counts('user_tokenized')
+
+	def build_profiles(self, previous=None):
+		'''
+		Produce the user_profile of every user in the dataset as a row of a sparse tf-idf matrix, one for the tweets 
+		text and one for the mentions, so that all users can be scored against the news with a single product.
+		The terms counts are the ones of the pre-processed tweets, so no further analysis is needed.
+		:param previous: optional hashed profiles with the same n_features, only the users whose tweets changed are 
+			hashed again;
+		:return: dictionary with the list of users, the text and mentions profiles and the fingerprints of the users 
+			tweets and of the files from which they were built
+		'''
+		users = list(self.tweets['tweets'])
+		fingerprints = self.users_fingerprints()
+		profiles = {
+			'users': users,
+			'fingerprints': fingerprints,
+			'sources': {file: dict(source, tweets=None) for file, source in self.tweets['sources'].items()}
+		}
+
+		if previous is not None:
+			index = {user: i for i, user in enumerate(previous['users'])}
+			rows = [index[user] if previous['fingerprints'].get(user) == fingerprints[user] else None for user in users]
+			counts = [self.user_counts(user) for user, i in zip(users, rows) if i is None]
+			profiles['text'] = self.update_profile(previous['text'], rows, [c[0] for c in counts])
+			profiles['mentions'] = self.update_profile(previous['mentions'], rows, [c[1] for c in counts])
+		else:
+			counts = [self.user_counts(user) for user in users]
+			profiles['text'] = self.fit_profile([c[0] for c in counts])
+			profiles['mentions'] = self.fit_profile([c[1] for c in counts])
+
+		return profiles
+
+	def profile_features(self, profiles):
+		'''
+		Number of hashed features of the profiles.
+		:param profiles: users profiles produced by build_profiles;
+		:return: n_features of the hashed profiles, None for the profiles with a fitted vocabulary
+		'''
+		return getattr(profiles['text']['vocabulary'], 'n_features', None)
+
+	def users_fingerprints(self):
+		'''
+		Fingerprint of the tweets of each user, changes when a tweet of the user is added, changed or removed.
+		:return: dictionary with users as keys and their fingerprints as values
+		'''
+		return {user: fingerprint(sorted(self.tweets['fingerprints'][tweet] for tweet in self.tweets['tweets'][user]))
+				for user in self.tweets['tweets']}
+
+	def profiles_path(self):
+		'''
+		Path of the store in which are saved the pre-processed data and the profiles of the datasets in fileNames.
+		:return: the store directory path
+		'''
+		return './utils/user-profiles/' + '&'.join(sum(
+			[re.findall(r'[^\/]+(?=\.)', test) or [os.path.basename(os.path.normpath(test))] for test in self.fileNames],
+			[])) + '.store'
+
+	def open_store(self):
+		'''
+		Open the store of the datasets in fileNames, the store arrays are memory-mapped and read only when needed.
+		:return: the ProfileStore, or None if it doesn't exist or it is not readable
+		'''
+		try:
+			return ProfileStore(self.profiles_path())
+		except (OSError, ValueError, KeyError):
+			return None
+
+	def load_tweets(self, store=None):
+		'''
+		Try to retrive pre-processed user tweets from the store and update them with the new or changed tweets, 
+		otherwise parse them.
+		:param store: optional ProfileStore already opened;
+		:return: the pre-processed tweets
+		'''
+		store = store or self.open_store()
+
+		if store is not None:
+			self.vocabulary = store.vocabulary()
+			self.tweets = store.load()
+			self.freq_text = self.tweets['frequency']['freq_text']
+			self.freq_user = self.tweets['frequency']['freq_user']
+			self.freq_hashtags = self.tweets['frequency']['freq_hashtags']
+			self.freq_links = self.tweets['frequency']['freq_links']
+			self.freq_emoji = self.tweets['frequency']['freq_emoji']
+			print("User profiles loaded correctly from " + y(store.path))
+			self.refresh()
+		else:
+			print("User profiles tweets not yet pre-processed.")
+			self.parser()
+
+		return self.tweets
+
+	def load_profiles(self):
+		'''
+		Try to retrive the pre-built users profiles matrices from the store, otherwise build and save them. The profiles 
+		are rebuilt when the tweets files changed since they were built and the tweets of some user changed.
+		:return: the users profiles produced by build_profiles
+		'''
+		if self.profiles is not None:
+			return self.profiles
+
+		with self.profiles_lock:
+			if self.profiles is None:
+				self.set_profiles(self.build_store())
+
+		return self.profiles
+
+	def reload_profiles(self):
+		'''
+		Load again the users profiles, rebuilt if the tweets files changed since they were loaded. The queries served 
+		meanwhile use the previous profiles.
+		:return: the users profiles produced by build_profiles
+		'''
+		with self.profiles_lock:
+			self.set_profiles(self.build_store())
+
+		return self.profiles
+
+	def ingest(self, data, analyzed=None):
+		'''
+		Add to the users profiles the tweets received after they were built (e.g. by the ingest pipeline) without 
+		reading the tweets files: the new or changed tweets of data are pre-processed and added to the corpus_counter, 
+		then the profiles are rebuilt from the counters (the hashed ones only for the users whose tweets changed) and 
+		replaced at once, so concurrent queries use either the previous or the new profiles. The store is updated by 
+		the next reload_profiles.
+		:param data: dictionary of tweets with tweets ids as keys and their attributes as values;
+		:param analyzed: optional output of analyze_tweets for data, computed outside the profiles lock;
+		:return: number of tweets added or changed
+		'''
+		self.load_profiles()
+		with self.profiles_lock:
+			if not self.tweets['sources']:
+				# profiles loaded from the store without the pre-processed tweets
+				self.load_tweets()
+			digests = {tweet_id: fingerprint(tweet) for tweet_id, tweet in data.items()}
+			new = [i for i, tweet_id in enumerate(data) if self.tweets['fingerprints'].get(tweet_id) != digests[tweet_id]]
+			if not new:
+				return 0
+
+			ids = list(data)
+			extracted, tagged = analyzed or self.analyze_tweets(data)
+			for i in new:
+				if ids[i] in self.tweets['fingerprints']:
+					self.remove_tweet(ids[i])
+				self.tweets['fingerprints'][ids[i]] = digests[ids[i]]
+
+			self.data = {ids[i]: data[ids[i]] for i in new}
+			with timer('profiles.ingest'):
+				self.add_tweets([extracted[i] for i in new], [tagged[i] for i in new] + 
+								[tagged[len(ids) + i] for i in new])
+				self.set_profiles(self.build_profiles(self.profiles if self.n_features else None))
+			count('profiles.ingested', len(new))
+
+		return len(new)
+
+	def set_profiles(self, profiles):
+		'''
+		Replace the users profiles, with their version: the fingerprint of the users tweets and of the vectorization, 
+		used to invalidate the cached personalized results.
+		:param profiles: the users profiles produced by build_profiles;
+		'''
+		self.profiles_version = fingerprint([profiles['fingerprints'], self.n_features])
+		self.profiles = profiles
+
+	def build_store(self):
+		'''
+		Load the users profiles from the store, updating it if the tweets files changed. The profiles are assigned only 
+		when complete, so concurrent queries never see partially updated profiles.
+		:return: the users profiles produced by build_profiles
+		'''
+		store_path = self.profiles_path()
+		store = self.open_store()
+		profiles = None
+
+		if store is not None:
+			with timer('profiles.open_store'):
+				profiles = store.profiles()
+			print("User profiles tf-idf matrices loaded from " + y(store_path))
+			if self.profile_features(profiles) != self.n_features:
+				print("User profiles tf-idf matrices built with a different vectorization.")
+				profiles = None
+			elif not any(self.source_changed(file, profiles['sources']) for file in self.fileNames):
+				return profiles
+		else:
+			print("User profiles tf-idf matrices not yet pre-processed.")
+
+		with timer('profiles.load_tweets'):
+			self.load_tweets(store)
+		if profiles is None:
+			with timer('profiles.build'):
+				profiles = self.build_profiles()
+		elif profiles['fingerprints'] != self.users_fingerprints():
+			# hashed profiles are updated only for the users whose tweets changed
+			with timer('profiles.build'):
+				profiles = self.build_profiles(profiles if self.n_features else None)
+		else:
+			# files touched without changing the users tweets
+			profiles = dict(profiles, 
+				sources={file: dict(source, tweets=None) for file, source in self.tweets['sources'].items()})
+		print("Saving pre-processed tweets and profiles tf-idf matrices in " + y(store_path))
+		os.makedirs(os.path.dirname(store_path), exist_ok=True)
+		with timer('profiles.save_store'):
+			save_store(store_path, self.tweets, profiles)
+			profiles = ProfileStore(store_path).profiles()
+
+		return profiles
 	
-	def personalize_query(self, news, sp_user):
+	def personalize_query(self, news, sp_user, k=10):
 		'''
-		Produce user_profile for each specified user and then filter news based on user_profile to personalize the search
+		Filter news based on user_profile of each specified user to personalize the search
 		:param news: news's text derived by Elasticsearch;
 		:param sp_user: list of users to wich personalize search (if empty return all users personalization);
+		:param k: number of re-ranked news returned for each user (default is 10);
 		:return: re-ranked news's list with user personalization.
 		'''
+		return self.personalize_queries([news], sp_user, k)[0]
+
+	def personalize_queries(self, results, sp_user, k=10):
+		'''
+		Personalize many search results at once: the news of all the results are analyzed in one batch and scored 
+		against all the specified users with a single product for the text and one for the mentions, then the scores 
+		are scaled and ranked for each result separately, as done by personalize_query for a single result.
+		:param results: list of Elasticsearch results (e.g. the responses of a multi-search);
+		:param sp_user: list of users to wich personalize search (if empty return all users personalization);
+		:param k: number of re-ranked news returned for each user and result (default is 10);
+		:return: list with the re-ranked news's list with user personalization of each result
+		'''
+
+		with timer('personalize.load_profiles'):
+			profiles = self.load_profiles()
+		count('personalize.queries', len(results))
 
 		# If sp_user list is empty, return personalization for all user avaiable in dataset
-		retr_all = False
-		if not sp_user:
-			retr_all = True
+		rows = [i for i, user in enumerate(profiles['users']) if (user in sp_user) or not sp_user]
 
-		# Try to retrive pre-processed user tweets from dataset
-		pickle_path = './utils/user-profiles/' + '&'.join(sum(
-			[re.findall(r'[^\/]+(?=\.)', test) for test in self.fileNames],[])) + '.pickle'
-		
-		try:
-			self.tweets = pickle.load(open(pickle_path, 'rb'))
-			print("User profiles loaded correctly from " + y(pickle_path))
-		except:
-			print("User profiles tweets not yet pre-processed.")
-			a = self.parser()
-			print("Saving preprocessed user profiles in " + y(pickle_path))
-			os.makedirs(os.path.dirname(pickle_path), exist_ok=True)
-			pickle.dump(a, open(pickle_path, 'wb'))
-		
+		if not rows:
+			print(r("ERROR: ") + "Usernames provided not found in tweet dataset.")
+			sys.exit()
 
-		personalized = {}
+		# The hits of all the results are concatenated, offsets delimit the hits of each result
+		hits = [n for res in results for n in res['hits']['hits']]
+		offsets = np.cumsum([0] + [len(res['hits']['hits']) for res in results])
 		cnews = []
 		mnews = []
-		rex = re.compile(r'@(\S+)')
 
-		# Elasticsearch scores normalization between 0 and 1
-		scores = [n['_score'] for n in news['hits']['hits']]
-		scores_r = preprocessing.minmax_scale(scores)
-		
-		# Extraction of news tweets text and mentions
-		for idx, n in enumerate(news['hits']['hits']):
-			n['_score']=scores_r[idx]
-			us = ""
-			cnews.append(n['_source']['text'])
-			match_pattern = rex.findall(n['_source']['text'])
-			for u in match_pattern:
-				us += " " + u
-				mnews.append(us)
-			if len(match_pattern) < 1:
-				mnews.append(" ")
-
-
-		# Personalization for each specified user in sp_user parameter
-		for user in self.tweets['tweets']:
-			if (user in sp_user) or retr_all:
-
-				st = ""
-				hg = ""
-				
-				for tweet in self.tweets['tweets'][user]:
-					st += " " + self.tweets['tweets'][user][tweet]['text']
-					users = self.tweets['tweets'][user][tweet]['user']
-					for u in users:
-						hg += " " + u
-
-				corpus = [st]  # string containing specified user tweets text
-				corpus_m = [hg] # string containing specified user tweets mentions
-				
-				# Try to retrive pre-fitted tf-idf user profiles vectorizer
-				vectoriser_path_text = './utils/user-profiles/' + user.replace(" ", "") + '/vect_text.pickle'
-				vectoriser_path_ment = './utils/user-profiles/' + user.replace(" ", "") + '/vect_mentions.pickle'
-				try:
-					vect_t_fit = pickle.load(open(vectoriser_path_text, 'rb'))
-					vect_m_fit = pickle.load(open(vectoriser_path_ment, 'rb'))
-					print("User profile %s tf-idf vectorizer loaded." % y(user))
-				except:
-					print("User profile tf-idf vectorizer not yet pre-processed.")
-					vectoriser_t = TfidfVectorizer(analyzer=self.preprocess_text, min_df=0.01)
-					vectoriser_m = TfidfVectorizer(analyzer=self.preprocess_text, min_df=0.01)
-
-					vect_t_fit = vectoriser_t.fit(corpus)
-					vect_m_fit = vectoriser_m.fit(corpus_m)
-					print("Saving profile tf-idf vectorizer in " + vectoriser_path_text)
-					os.makedirs(os.path.dirname(vectoriser_path_text), exist_ok=True)
-					os.makedirs(os.path.dirname(vectoriser_path_ment), exist_ok=True)
-					pickle.dump(vect_t_fit, open(vectoriser_path_text, 'wb'))
-					pickle.dump(vect_m_fit, open(vectoriser_path_ment, 'wb'))
-
-
-				# Computes similarity scores
-				Pnews = self.get_similarity_score(corpus, cnews, vect_t_fit)
-				Mnews = self.get_similarity_score(corpus_m, mnews, vect_m_fit)
-
-				# Personalized scoring
-				filtered = news['hits']['hits']
-				for i, n in enumerate(filtered):
-					n['new_score'] = np.around(0.2 * n['_score'] + 0.5 * Pnews['score'][i] + 0.3 * Mnews['score'][i], 
-												decimals=6)
-
-				# Re-ranking Elasticsearch query results and return first 10 results
-				ordered = sorted(filtered, key=itemgetter('new_score'), reverse=True)
-				if len(ordered) > 10:
-					personalized[user] = {'news': ordered[:10]}
-				else:
-					personalized[user] = {'news': ordered}
-
-
-		if not personalized:
-			print(r("ERROR: ") + "Usernames provided not found in tweet dataset.")
-			sys.exit()
+		count('personalize.news', len(hits))
+
+		# Extraction of news tweets analyzed text and mentions
+		with timer('personalize.analyze_news'):
+			for text, mentions in self.analyze_news(hits):
+				cnews.append(text)
+				mnews.append(mentions)
+
+		# Elasticsearch scores normalization between 0 and 1 for each result (the hits are not modified, so the same 
+		# results can be personalized by concurrent queries)
+		scores = minmax(segments(np.array([n['_score'] for n in hits], dtype=np.float64), offsets))
+
+		# Computes similarity scores of all the specified users for all the news at once, then scales them for each 
+		# result, one row for each user
+		with timer('personalize.similarity'):
+			Pnews = minmax(segments(self.similarity(profiles['text'], rows, cnews), offsets))
+			Mnews = minmax(segments(self.similarity(profiles['mentions'], rows, mnews), offsets))
+
+		# Personalized scoring, the padding of the shorter results is ranked last
+		with timer('personalize.rank'):
+			new_scores = np.around(0.2 * scores + 0.5 * Pnews + 0.3 * Mnews, decimals=6)
+			ranking = np.argsort(-np.nan_to_num(new_scores, nan=-np.inf), axis=-1, kind='stable')[..., :k]
+
+		# Re-ranking Elasticsearch query results and return first k results for each specified user
+		personalized = []
+		for q, start in enumerate(offsets[:-1]):
+			length = offsets[q + 1] - start
+			personalized.append({
+				profiles['users'][i]: {'news': [
+					dict(hits[start + n], _score=scores[q][n], new_score=new_scores[j][q][n]) 
+					for n in ranking[j][q] if n < length
+				]} for j, i in enumerate(rows)
+			})
 		
-		return personalized
\ No newline at end of file
+		return personalized
+
+
+def minmax(scores):
+	'''
+	Scale the scores of each row between 0 and 1, the rows with all equal scores are scaled to 0. NaN scores (e.g. 
+	padding) are ignored.
+	:param scores: array of scores, one row for each user (or a single row);
+	:return: array of the scaled scores
+	'''
+	if not scores.shape[-1]:
+		return scores
+	low = np.fmin.reduce(scores, axis=-1, keepdims=True)
+	span = np.fmax.reduce(scores, axis=-1, keepdims=True) - low
+	span[~(span > 0)] = 1
+
+	return (scores - low) / span
+
+
+def segments(values, offsets):
+	'''
+	Split the last axis of an array in consecutive segments, padded with NaN to the length of the longest one.
+	:param values: array whose last axis is the concatenation of the segments;
+	:param offsets: start of each segment and end of the last one;
+	:return: array with the segments in the second-to-last axis and their values in the last one
+	'''
+	lengths = np.diff(offsets)
+	padded = np.full(values.shape[:-1] + (len(lengths), lengths.max(initial=0)), np.nan)
+	segment = np.repeat(np.arange(len(lengths)), lengths)
+	padded[..., segment, np.arange(offsets[-1]) - offsets[segment]] = values
+
+	return padded
+
+
+def parse_shard(args):
+	'''
+	Parser worker: pre-process a shard of tweets with a new Preprocessor.
+	:param args: tuple with the dictionary of tweets (tweets ids as keys and their attributes as values), the tagger 
+		strategy and the POS tag lexicon;
+	:return: the pre-processed tweets and the five corpus_counter of the shard
+	'''
+	data, tagger, lexicon = args
+	worker = Preprocessor([], tagger=tagger)
+	worker.lexicon = lexicon
+	worker.parse_tweets(data)
+	return worker.tweets['tweets'], {
+		'freq_text': worker.freq_text,
+		'freq_user': worker.freq_user,
+		'freq_hashtags': worker.freq_hashtags,
+		'freq_links': worker.freq_links,
+		'freq_emoji': worker.freq_emoji
+	}
@@ -0,0 +1,196 @@
+from threading import Lock
+from indexer import indexVersion
+from utils.utils import LRUCache, fingerprint
+from utils.instrument import timer, count
+
+DEFAULT_HOSTS = ["http://localhost:9200"]
+
+clients = {}
+clients_lock = Lock()
+
+
+def getClient(hosts=None, maxsize=25):
+    """
+    Returns the Elasticsearch client of the given hosts, created at the first call and then shared by all the callers.
+    The client keeps a pool of persistent HTTP connections, so the searches don't pay the connection setup.
+    Parameters
+    ----------
+    hosts : list
+        Elasticsearch hosts (default is the local server).
+    maxsize : int
+        Maximum number of pooled connections for each host, i.e. of concurrent requests (default is 25).
+    Returns
+    -------
+    Elasticsearch
+        The shared client.
+    """
+    key = tuple(hosts or DEFAULT_HOSTS)
+    with clients_lock:
+        if key not in clients:
+            from elasticsearch import Elasticsearch
+            clients[key] = Elasticsearch(hosts=list(key), maxsize=maxsize)
+        return clients[key]
+
+
+def search(es, index, query=None, size=10):
+    """
+    Performs a query on an index.
+    Parameters
+    ----------
+    es : Elasticsearch
+        Client used for the search (or any object with the same search method).
+    index : str
+        Index (or alias) name.
+    query : dict
+        Elasticsearch query DSL.
+    size : int
+        Number of results (default is 10).
+    Returns
+    -------
+    dict
+        The Elasticsearch response.
+    """
+    count('search.queries')
+    with timer('search.search'):
+        return es.search(index=index, body={"query": query}, size=size)
+
+
+def msearch(es, index, queries, size=10, batch_size=100):
+    """
+    Performs many queries on an index with multi-search requests, each one carrying up to batch_size queries, so the
+    queries don't pay a round trip each.
+    Parameters
+    ----------
+    es : Elasticsearch
+        Client used for the search (or any object with the same msearch method).
+    index : str
+        Index (or alias) name.
+    queries : list
+        Elasticsearch queries DSL.
+    size : int
+        Number of results of each query (default is 10).
+    batch_size : int
+        Maximum number of queries of each multi-search request (default is 100).
+    Returns
+    -------
+    list
+        The Elasticsearch response of each query, in order (responses of failed queries contain the error).
+    """
+    responses = []
+    for start in range(0, len(queries), batch_size):
+        body = []
+        for query in queries[start:start + batch_size]:
+            body.extend([{}, {"query": query, "size": size}])
+        count('search.queries', len(body) // 2)
+        with timer('search.msearch'):
+            responses.extend(es.msearch(index=index, body=body)['responses'])
+
+    return responses
+
+
+def personalizedSearch(es, index, queries, preprocessor, users, size=100, k=10, batch_size=100):
+    """
+    Performs many queries with multi-search requests and re-ranks all the results for the users in one pass.
+    Parameters
+    ----------
+    es : Elasticsearch
+        Client used for the search (or any object with the same msearch method).
+    index : str
+        Index (or alias) name.
+    queries : list
+        Elasticsearch queries DSL.
+    preprocessor : Preprocessor
+        Preprocessor of the users tweets used for the personalization.
+    users : list
+        Users to which personalize the results (if empty all the users).
+    size : int
+        Number of results of each query to be re-ranked (default is 100).
+    k : int
+        Number of re-ranked results returned for each user (default is 10).
+    batch_size : int
+        Maximum number of queries of each multi-search request (default is 100).
+    Returns
+    -------
+    list
+        The personalized results of each query (as returned by personalize_query), or the Elasticsearch error for the
+        failed queries.
+    """
+    responses = msearch(es, index, queries, size, batch_size)
+    ok = [i for i, res in enumerate(responses) if 'error' not in res]
+    personalized = preprocessor.personalize_queries([responses[i] for i in ok], users, k)
+    for i, res in zip(ok, personalized):
+        responses[i] = res
+
+    return responses
+
+
+class QueryCache:
+    """
+    Cache of the search and personalization results, in front of an Elasticsearch client.
+    The results are keyed by the normalized query body (keys order doesn't matter), the size, the requested users and 
+    the versions of the index (bumped by indexDocuments) and of the users profiles (bumped by a profiles rebuild), so 
+    a new version never serves stale results; when a version changes the cache is also emptied.
+    The cached results are shared by all the callers, so they must not be modified.
+    Parameters
+    ----------
+    es : Elasticsearch
+        Client used for the searches (or any object with the same search method).
+    preprocessor : Preprocessor
+        Preprocessor of the users tweets used for the personalization (None for search only).
+    maxsize : int
+        Maximum number of cached results, the least recently used are evicted (default is 1000).
+    ttl : float
+        Seconds after which a cached result expires (default is 300, None to never expire).
+    """
+
+    def __init__(self, es, preprocessor=None, maxsize=1000, ttl=300):
+        self.es = es
+        self.preprocessor = preprocessor
+        self.cache = LRUCache(maxsize, ttl)
+        self.versions = {}
+
+    def version(self, index):
+        """
+        Returns the current version of the index and of the users profiles, emptying the cache if it changed.
+        """
+        version = (indexVersion(index), self.preprocessor and self.preprocessor.profiles_version)
+        if self.versions.setdefault(index, version) != version:
+            self.cache.clear()
+            self.versions[index] = version
+        return version
+
+    def cached(self, key, compute):
+        result = self.cache.get(key)
+        if result is None:
+            result = compute()
+            self.cache[key] = result
+        return result
+
+    def search(self, index, query=None, size=10):
+        """
+        Cached search, see search.
+        """
+        key = ('search', index, fingerprint(query), size, self.version(index))
+        return self.cached(key, lambda: search(self.es, index, query, size))
+
+    def personalize(self, index, query, users, size=100, k=10):
+        """
+        Cached personalized search: the results of the query re-ranked for each user (all the users if empty).
+        """
+        # the profiles are loaded before the version is read
+        self.preprocessor.load_profiles()
+        key = ('personalize', index, fingerprint(query), tuple(sorted(set(users))), size, k, self.version(index))
+        return self.cached(key, lambda: self.preprocessor.personalize_query(search(self.es, index, query, size), 
+                                                                            users, k))
+
+    def invalidate(self):
+        """
+        Empties the cache.
+        """
+        self.cache.clear()
+
+    def stats(self):
+        """
+        Returns the size and the hits and misses counters of the cache.
+        """
+        return self.cache.stats()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.utils import *
+from search import getClient, search, msearch, personalizedSearch, QueryCache
+from preprocessor import Preprocessor
+from bm25 import Client
+from pipeline import IngestPipeline
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 502: 'Bad Gateway'}
+
+
+class QueryService:
+    """
+    Resident search service: the users profiles and the NLTK models are loaded once at startup and the Elasticsearch
+    client (with its connection pool) is shared by all the requests, so each request pays only the search and the
+    re-rank.
+    The service speaks plain HTTP/1.1 with JSON bodies:
+        POST /search        {"query": {...}, "size": 10, "index": "..."} -> Elasticsearch response
+        POST /personalize   {"query": {...}, "users": [...], "size": 100, "k": 10} -> personalized results of each user
+        POST /msearch       {"queries": [...], "size": 10, "users": [...]} -> results of each query, personalized 
+                            when users is given
+        GET  /stats         requests, errors and latency percentiles (and throughput of the ingest stages)
+    At most max_concurrency requests are served at once, the others wait their turn; searches and re-ranks run in a
+    pool of threads, so the event loop keeps accepting connections.
+    Parameters
+    ----------
+    es : Elasticsearch
+        Client used for the searches (or any object with the same search method, e.g. a local stub).
+    preprocessor : Preprocessor
+        Preprocessor of the users tweets used for the personalization.
+    index : str
+        Default index (or alias) name.
+    max_concurrency : int
+        Maximum number of requests served at once (default is 8).
+    latency_window : int
+        Number of recent requests on which the latency percentiles are computed (default is 1000).
+    verbose : bool
+        Print the method, path, status and latency of each request (default is True).
+    cache : QueryCache
+        Optional cache of the search and personalization results, its counters are reported by /stats.
+    pipeline : IngestPipeline
+        Optional ingest pipeline of the new news and users tweets running in the service, so they are searched and
+        personalized within seconds; it is started with the service and its stages are reported by /stats.
+    """
+
+    def __init__(self, es, preprocessor, index, max_concurrency=8, latency_window=1000, verbose=True, cache=None,
+                 pipeline=None):
+        self.es = es
+        self.preprocessor = preprocessor
+        self.index = index
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_concurrency)
+        self.semaphore = None
+        self.latencies = deque(maxlen=latency_window)
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.verbose = verbose
+        self.cache = cache
+        self.pipeline = pipeline
+        self.routes = {'/search': self.basic, '/personalize': self.personalized, '/msearch': self.batch}
+
+    def warmup(self):
+        """
+        Loads the users profiles and the tagger model, so the first request doesn't pay them.
+        Returns
+        -------
+        int
+            Number of users available for the personalization.
+        """
+        profiles = self.preprocessor.load_profiles()
+        self.preprocessor.preprocess_texts(["warm up"])
+        return len(profiles['users'])
+
+    def basic(self, body):
+        """
+        Basic search: the Elasticsearch results of the query.
+        """
+        if self.cache is not None:
+            return self.cache.search(body.get('index', self.index), body['query'], body.get('size', 10))
+        return search(self.es, body.get('index', self.index), body['query'], body.get('size', 10))
+
+    def personalized(self, body):
+        """
+        Personalized search: the results of the query re-ranked for each requested user (all the users if empty).
+        """
+        users = body.get('users', [])
+        if users and not set(users) & set(self.preprocessor.load_profiles()['users']):
+            raise LookupError("Usernames provided not found in tweet dataset.")
+        k = body.get('k', 10)
+        if self.cache is not None:
+            return self.cache.personalize(body.get('index', self.index), body['query'], users, body.get('size', 100), k)
+        res = search(self.es, body.get('index', self.index), body['query'], body.get('size', 100))
+        return self.preprocessor.personalize_query(res, users, k)
+
+    def batch(self, body):
+        """
+        Batch search: the queries are sent with multi-search requests and, if users is given, all the results are 
+        re-ranked at once for each requested user (all the users if empty).
+        """
+        index = body.get('index', self.index)
+        if 'users' not in body:
+            return msearch(self.es, index, body['queries'], body.get('size', 10))
+        users = body['users']
+        if users and not set(users) & set(self.preprocessor.load_profiles()['users']):
+            raise LookupError("Usernames provided not found in tweet dataset.")
+        return personalizedSearch(self.es, index, body['queries'], self.preprocessor, users, body.get('size', 100),
+                                  body.get('k', 10))
+
+    def stats(self):
+        """
+        Requests and latency statistics of the service.
+        """
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3) if latencies else None
+
+        stats = {
+            'requests': self.requests, 'errors': self.errors, 'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency,
+            'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99),
+                           'max': percentile(1)}
+        }
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        if self.pipeline is not None:
+            stats['ingest'] = self.pipeline.stats()
+        return stats
+
+    async def handle(self, method, path, body):
+        """
+        Serves a request.
+        Returns
+        -------
+        tuple
+            HTTP status and JSON serializable payload.
+        """
+        if path == '/stats':
+            return 200, self.stats()
+        if path not in self.routes:
+            return 404, {'error': "Unknown endpoint %s" % path}
+        if method != 'POST':
+            return 405, {'error': "Use POST for %s" % path}
+
+        try:
+            body = json.loads(body or b'{}')
+            field = 'queries' if path == '/msearch' else 'query'
+            if not isinstance(body, dict) or field not in body:
+                raise ValueError("The request body must be a JSON object with the %s" % field)
+        except ValueError as e:
+            return 400, {'error': str(e)}
+
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                result = await asyncio.get_event_loop().run_in_executor(self.executor, self.routes[path], body)
+            except LookupError as e:
+                return 404, {'error': str(e)}
+            except Exception as e:
+                return 502, {'error': "%s: %s" % (type(e).__name__, e)}
+            finally:
+                self.in_flight -= 1
+
+        return 200, {'result': result}
+
+    async def connection(self, reader, writer):
+        """
+        Serves the requests of a connection, kept alive until the client closes it.
+        """
+        try:
+            while True:
+                request = await readRequest(reader)
+                if request is None:
+                    break
+                start = time.perf_counter()
+                method, path, headers, body = request
+                if method is None:
+                    status, payload = 400, {'error': "Malformed request"}
+                else:
+                    status, payload = await self.handle(method, path.split('?')[0], body)
+                took = (time.perf_counter() - start) * 1000
+
+                self.requests += 1
+                self.errors += status != 200
+                self.latencies.append(took)
+                payload['took_ms'] = round(took, 3)
+                close = method is None or headers.get('connection', '').lower() == 'close'
+                writer.write(response(status, payload, took, close))
+                await writer.drain()
+                if self.verbose:
+                    print("%s %s %s %s" % (method, path, (g if status == 200 else r)(status), y("%.1fms" % took)))
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000):
+        """
+        Starts listening on host and port (0 for a free port).
+        Returns
+        -------
+        asyncio.Server
+            The running server.
+        """
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return await asyncio.start_server(self.connection, host, port)
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        """
+        Serves the requests until interrupted.
+        """
+        server = await self.start(host, port)
+        pprint(g("Serving on http://%s:%d" % server.sockets[0].getsockname()[:2]))
+        if self.pipeline is not None:
+            self.pipeline.start()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self.pipeline is not None:
+                self.pipeline.stop()
+
+
+async def readRequest(reader):
+    """
+    Reads an HTTP/1.1 request.
+    Returns
+    -------
+    tuple
+        Method (None if the request is malformed), path, headers (lowercase names) and body, or None when the
+        connection is closed.
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode('latin-1').split()
+
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if len(parts) != 3:
+        return None, None, headers, b''
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+    return parts[0], parts[1], headers, body
+
+
+def response(status, payload, took, close=False):
+    """
+    Encodes an HTTP/1.1 JSON response, with the request latency in the X-Response-Time header.
+    """
+    body = json.dumps(payload, default=lambda o: o.item()).encode('utf-8')
+    head = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nX-Response-Time: %.3fms\r\n" \
+           "Connection: %s\r\n\r\n" % (status, REASONS[status], len(body), took, 'close' if close else 'keep-alive')
+    return head.encode('latin-1') + body
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Personalized search service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--index', default='twitter_index', help="index (or alias) name")
+    parser.add_argument('--es', nargs='+', default=None, help="Elasticsearch hosts")
+    parser.add_argument('--bm25', metavar='DATA', default=None,
+                        help="tweets file searched with the embedded BM25 index instead of Elasticsearch")
+    parser.add_argument('--users-tweets', nargs='+', default=["./datasets/group_one.json", "./datasets/group_two.json"],
+                        help="users tweets files used for the personalization")
+    parser.add_argument('--max-concurrency', type=int, default=8, help="maximum number of requests served at once")
+    parser.add_argument('--cache-size', type=int, default=1000, help="cached results (0 to disable the cache)")
+    parser.add_argument('--cache-ttl', type=float, default=300, help="seconds after which a cached result expires")
+    parser.add_argument('--ingest-news', default=None,
+                        help="news tweets file or store directory followed and indexed while serving")
+    parser.add_argument('--ingest-users', default=None,
+                        help="users tweets file or store directory followed and added to the profiles while serving")
+    args = parser.parse_args()
+
+    if args.bm25:
+        es = Client()
+        pprint(g("%d tweets indexed" % es.load(args.bm25, args.index)['indexed']))
+    else:
+        es = getClient(args.es, maxsize=args.max_concurrency)
+    # the followed users tweets are also a source of the profiles, so they are kept after a restart
+    users_tweets = list(args.users_tweets)
+    if args.ingest_users and args.ingest_users not in users_tweets:
+        users_tweets.append(args.ingest_users)
+    preprocessor = Preprocessor(users_tweets)
+    cache = QueryCache(es, preprocessor, args.cache_size, args.cache_ttl) if args.cache_size else None
+    pipeline = None
+    if args.ingest_news or args.ingest_users:
+        pipeline = IngestPipeline(es, args.index, preprocessor, args.ingest_news, args.ingest_users)
+    service = QueryService(es, preprocessor, args.index, args.max_concurrency, cache=cache, pipeline=pipeline)
+    pprint(g("%d users loaded" % service.warmup()))
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
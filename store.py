@@ -0,0 +1,278 @@
+import json
+import os
+import shutil
+import numpy as np
+from scipy import sparse
+from frequency import Vocabulary, TermCounts, HashingVocabulary, TweetTable, TOKEN_FIELDS
+
+# Columns of the pre-processed tweets
+STRING_FIELDS = ['tweet_id', 'screen_name', 'date', 'text', 'fingerprint']
+FREQUENCIES = ['freq_text', 'freq_user', 'freq_hashtags', 'freq_links', 'freq_emoji']
+PROFILES = ['text', 'mentions']
+
+
+class Strings:
+    '''
+    Column of strings stored as a UTF-8 blob and the offsets of each string, both memory-mapped.
+    '''
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class ProfileStore:
+    '''
+    Memory-mapped columnar store of the pre-processed users tweets and profiles.
+    The tweets are grouped by user, every column is a numpy array (token lists as term ids with the offsets of each
+    tweet), the frequency counters and the tf-idf profiles are sparse users × terms matrices. The arrays are opened
+    with mmap so only the pages actually read are loaded, and they are shared by all the processes reading the store.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as m:
+            self.meta = json.load(m)
+        self.users = self.meta['users']
+        self.terms = self.strings('terms')
+        self.terms_vocabulary = None
+
+    def array(self, name):
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def strings(self, name):
+        return Strings(self.array(name + '.blob'), self.array(name + '.off'))
+
+    def matrix(self, name, columns=None):
+        data, indices, indptr = self.array(name + '.data'), self.array(name + '.indices'), self.array(name + '.indptr')
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(self.users), columns or len(self.terms)),
+                                 copy=False)
+
+    def vocabulary(self):
+        '''
+        Global term dictionary of the store, the terms are decoded from the memory-mapped blob at the first use.
+        :return: the Vocabulary, term ids are the store ones
+        '''
+        if self.terms_vocabulary is None:
+            blob, offsets = bytes(self.terms.blob), self.terms.offsets.tolist()
+            self.terms_vocabulary = Vocabulary(blob[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:]))
+        return self.terms_vocabulary
+
+    def tweets(self, user):
+        '''
+        Read the pre-processed tweets of a single user, the token columns are copied as they are (the term ids are
+        the ones of the store vocabulary).
+        :param user: user name;
+        :return: TweetTable with tweets ids as keys and the pre-processed tweets as values
+        '''
+        i = self.users.index(user)
+        start, end = self.array('user_offsets')[i:i + 2]
+        strings = {field: self.strings(field) for field in STRING_FIELDS}
+        fields = {field: [strings[field][t] for t in range(start, end)] for field in STRING_FIELDS[1:4]}
+        fields['author'] = [user] * (end - start)
+        tokens = {}
+        for field in TOKEN_FIELDS:
+            ids, offsets = self.array(field + '.ids'), self.array(field + '.off')[start:end + 1]
+            tokens[field] = (ids[offsets[0]:offsets[-1]], offsets)
+        # hashtags is None for the tweets without it, in the stores written before its column only for the empty ones
+        if os.path.exists(os.path.join(self.path, 'hashtags.none.npy')):
+            none = self.array('hashtags.none')[start:end]
+        else:
+            none = np.diff(tokens['hashtags'][1]) == 0
+
+        return TweetTable(self.vocabulary(), [strings['tweet_id'][t] for t in range(start, end)], fields, tokens, none)
+
+    def frequency(self, kind, user):
+        '''
+        Read a frequency counter of a single user.
+        :param kind: name of the counter (freq_text, freq_user, freq_hashtags, freq_links or freq_emoji);
+        :param user: user name;
+        :return: TermCounts of the user
+        '''
+        row = self.matrix(kind)[self.users.index(user)]
+        return TermCounts(self.vocabulary(), row.indices, row.data)
+
+    def profile(self, kind):
+        '''
+        Read a tf-idf profile, its vocabulary is the store term dictionary (idf is 0 for the terms not in the profile)
+        or, for the hashed profiles, the HashingVocabulary with the same n_features.
+        :param kind: text or mentions;
+        :return: dictionary with the vocabulary, the idf array and the users × terms tf-idf matrix (and the counts 
+            matrix of the hashed profiles)
+        '''
+        n_features = self.meta.get('hashing', {}).get(kind)
+        if n_features:
+            return {'vocabulary': HashingVocabulary(n_features), 'idf': self.array('profile_' + kind + '.idf'),
+                    'matrix': self.matrix('profile_' + kind, n_features),
+                    'counts': self.matrix('profile_' + kind + '.counts', n_features)}
+        return {'vocabulary': self.vocabulary(), 'idf': self.array('profile_' + kind + '.idf'),
+                'matrix': self.matrix('profile_' + kind)}
+
+    def profiles(self):
+        '''
+        Read the users profiles, in the format produced by Preprocessor.build_profiles.
+        '''
+        profiles = {kind: self.profile(kind) for kind in PROFILES}
+        profiles.update(users=self.users, fingerprints=self.meta['fingerprints'], sources=self.meta['sources'])
+        return profiles
+
+    def load(self):
+        '''
+        Read all the pre-processed tweets, in the format produced by Preprocessor.parser.
+        '''
+        tweets = {'tweets': {}, 'frequency': {kind: {} for kind in FREQUENCIES}, 'fingerprints': {}}
+        fingerprints = self.strings('fingerprint')
+        ids = self.strings('tweet_id')
+        offsets = self.array('user_offsets')
+        for i, user in enumerate(self.users):
+            tweets['tweets'][user] = self.tweets(user)
+            for t in range(offsets[i], offsets[i + 1]):
+                tweets['fingerprints'][ids[t]] = fingerprints[t]
+            for kind in FREQUENCIES:
+                tweets['frequency'][kind][user] = self.frequency(kind, user)
+
+        with open(os.path.join(self.path, 'sources.json'), encoding='utf-8') as s:
+            tweets['sources'] = json.load(s)
+
+        return tweets
+
+
+def save_store(path, tweets, profiles):
+    '''
+    Write the pre-processed tweets and the users profiles in a new columnar store, replacing the existing one.
+    The store is written in a temporary directory then moved, so the processes that already mapped the previous
+    store keep reading it.
+    :param path: store directory;
+    :param tweets: pre-processed tweets, as produced by Preprocessor.parser;
+    :param profiles: users profiles, as produced by Preprocessor.build_profiles (same users of tweets);
+    '''
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    def save(name, array):
+        np.save(os.path.join(tmp, name + '.npy'), array)
+
+    def save_strings(name, values):
+        encoded = [v.encode('utf-8') for v in values]
+        save(name + '.blob', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        save(name + '.off', np.concatenate([[0], np.cumsum([len(e) for e in encoded], dtype=np.int64)]))
+
+    def save_matrix(name, matrix):
+        matrix = matrix.tocsr()
+        matrix.sort_indices()
+        save(name + '.data', matrix.data)
+        save(name + '.indices', matrix.indices.astype(np.int32))
+        save(name + '.indptr', matrix.indptr.astype(np.int64))
+
+    users = profiles['users']
+    terms = {}
+
+    def term_ids(values):
+        return [terms.setdefault(v, len(terms)) for v in values]
+
+    # the tweets tables are written as they are, their vocabulary is the start of the store one
+    tables = [tweets['tweets'][user] for user in users]
+    vocabulary = tables[0].vocabulary if tables and isinstance(tables[0], TweetTable) else None
+    if vocabulary is not None:
+        term_ids(vocabulary.terms)
+
+    # Tweets columns, grouped by user
+    strings = {field: [] for field in STRING_FIELDS}
+    tokens = {field: ([], [0]) for field in TOKEN_FIELDS}
+    none = []
+    user_offsets = [0]
+    for table in tables:
+        if isinstance(table, TweetTable) and table.vocabulary is vocabulary:
+            table.compact()
+            strings['tweet_id'].extend(table)
+            strings['fingerprint'].extend(tweets['fingerprints'][tweet_id] for tweet_id in table)
+            none.append(np.frombuffer(bytes(table.none), dtype=np.uint8))
+            for field in STRING_FIELDS[1:4]:
+                strings[field].extend(table.fields[field])
+            for field, (ids, offsets) in tokens.items():
+                column, column_offsets = table.column(field)
+                offsets.extend((column_offsets[1:] + offsets[-1]).tolist())
+                ids.append(column)
+        else:
+            for tweet_id, tweet in table.items():
+                strings['tweet_id'].append(tweet_id)
+                strings['fingerprint'].append(tweets['fingerprints'][tweet_id])
+                none.append(np.array([tweet['hashtags'] is None], dtype=np.uint8))
+                for field in STRING_FIELDS[1:4]:
+                    strings[field].append(tweet[field])
+                for field, (ids, offsets) in tokens.items():
+                    ids.append(np.array(term_ids(tweet[field] or []), dtype=np.int32))
+                    offsets.append(offsets[-1] + len(ids[-1]))
+        user_offsets.append(len(strings['tweet_id']))
+
+    # Frequencies and profiles terms are added to the same dictionary
+    for kind in FREQUENCIES:
+        for user in users:
+            term_ids(tweets['frequency'][kind][user])
+    hashing = {kind: profiles[kind]['vocabulary'].n_features for kind in PROFILES
+               if isinstance(profiles[kind]['vocabulary'], HashingVocabulary)}
+    for kind in PROFILES:
+        if kind not in hashing:
+            term_ids(profiles[kind]['vocabulary'])
+
+    for field in STRING_FIELDS:
+        save_strings(field, strings[field])
+    for field, (ids, offsets) in tokens.items():
+        save(field + '.ids', np.concatenate(ids).astype(np.int32) if ids else np.zeros(0, dtype=np.int32))
+        save(field + '.off', np.array(offsets, dtype=np.int64))
+    save('hashtags.none', np.concatenate(none) if none else np.zeros(0, dtype=np.uint8))
+    save('user_offsets', np.array(user_offsets, dtype=np.int64))
+    save_strings('terms', list(terms))
+
+    for kind in FREQUENCIES:
+        rows, cols, counts = [], [], []
+        for i, user in enumerate(users):
+            for term, count in tweets['frequency'][kind][user].items():
+                rows.append(i)
+                cols.append(terms[term])
+                counts.append(count)
+        save_matrix(kind, sparse.csr_matrix((np.array(counts, dtype=np.int32), (rows, cols)),
+                                            shape=(len(users), len(terms))))
+
+    # Profiles columns are re-mapped on the global term ids, the hashed ones are saved as they are
+    for kind in PROFILES:
+        if kind in hashing:
+            save_matrix('profile_' + kind, profiles[kind]['matrix'])
+            save_matrix('profile_' + kind + '.counts', profiles[kind]['counts'])
+            save('profile_' + kind + '.idf', profiles[kind]['idf'])
+            continue
+        vocabulary = profiles[kind]['vocabulary']
+        remap = np.zeros(len(vocabulary), dtype=np.int64)
+        idf = np.zeros(len(terms))
+        for term, j in vocabulary.items():
+            remap[j] = terms[term]
+        idf[remap] = profiles[kind]['idf']
+        matrix = profiles[kind]['matrix'].tocoo()
+        save_matrix('profile_' + kind, sparse.csr_matrix((matrix.data, (matrix.row, remap[matrix.col])),
+                                                         shape=(len(users), len(terms))))
+        save('profile_' + kind + '.idf', idf)
+
+    with open(os.path.join(tmp, 'sources.json'), 'w', encoding='utf-8') as s:
+        json.dump(tweets['sources'], s)
+    with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as m:
+        json.dump({
+            'users': users,
+            'fingerprints': profiles['fingerprints'],
+            'hashing': hashing,
+            'sources': {file: {k: v for k, v in source.items() if k != 'tweets'}
+                        for file, source in tweets['sources'].items()}
+        }, m)
+
+    old = path + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
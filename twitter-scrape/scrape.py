@@ -2,23 +2,37 @@
 
 import argparse
 import json, csv
-import pandas as pd
+import random
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from math import ceil
-from os import path, makedirs
+from os import path
+from threading import Condition
 
-import tweepy
 from api_key import key
-from requests import get, codes
+from requests import Session, codes
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout
 from requests_oauthlib import OAuth1
 
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from utils.tweetstore import TweetStore
+
 
 # CONSTANTS
 DATE_FORMAT = "%Y-%m-%d"
+TWEET_DATE_FORMAT = "%a %b %d %H:%M:%S %z %Y"
 TWEET_LIMIT = 3200  # recent tweets
 API_LIMIT = 200  # tweets at once
 OUT_DIR = 'out/' # folder of outputs
+BASE_URL = "https://api.twitter.com/1.1/"  # can be pointed to a local stub of the API
+RATE_LIMIT = 900  # user_timeline requests allowed in each window (user auth)
+RATE_WINDOW = 15 * 60  # seconds of a rate limit window
+MAX_RETRIES = 5  # retries of a request failed with 429, 5xx or a connection error
+MAX_BACKOFF = 60  # seconds
 
 # OUTPUT COLORS
 RESET = "\033[0m"
@@ -28,95 +42,209 @@ g = lambda s: "\033[32m" + str(s) + RESET  # green
 y = lambda s: "\033[33m" + str(s) + RESET  # yellow
 
 
-class Scraper:
+class ScrapeError(Exception):
+    """
+    A user that can't be scraped (missing or private).
+    """
 
-    def __init__(self, handle, multiUsr=False):
-        self.api = self.__authorize()
-        self.handle = handle.lower()
-        if multiUsr:
-            self.outfile = "all_usrs.json"
-        else:
-            self.outfile = self.handle + ".json"
-        
-        self.new_tweets = set()  # ids
-        self.tweets = self.__retrieve_existing()  # actual tweets
+
+class RateLimiter:
+    """
+    Token bucket shared by all the workers: a request takes a token, the tokens are refilled at rate / window per
+    second up to burst (by default the whole window allowance, the API counts the requests in fixed windows). The
+    rate limit headers of the API responses (x-rate-limit-remaining and x-rate-limit-reset) lower the tokens to the
+    remaining requests and, when none is left, hold all the workers until the window resets; the requests refused
+    by the API (429) or failed (5xx, connection errors) hold the workers for an exponential backoff with jitter, or
+    until the reset time if the API gives it.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, window=RATE_WINDOW, burst=None):
+        self.rate = rate / window  # tokens per second
+        self.burst = burst or max(1, rate)
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+        self.window_reset = None  # when the API window resets the bucket is full again
+        self.condition = Condition()
+
+    def __refill(self, now):
+        if self.window_reset is not None and now >= self.window_reset:
+            self.tokens = float(self.burst)
+            self.window_reset = None
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        # blocks until a token is available and the workers are not held
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.__refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+                self.condition.wait(wait)
+
+    def pause(self, seconds):
+        # holds all the workers for the given seconds
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.condition.notify_all()
+
+    def update(self, headers):
+        # follows the rate limit headers of a response
+        remaining = headers.get("x-rate-limit-remaining")
+        if remaining is None:
+            return
+        with self.condition:
+            now = time.monotonic()
+            self.__refill(now)
+            self.tokens = min(self.tokens, int(remaining))
+            if int(remaining) <= 0:
+                delay = self.reset_delay(headers, 1)
+                self.window_reset = now + delay
+                self.paused_until = max(self.paused_until, now + delay)
+
+    def backoff(self, attempt, headers=None):
+        # holds the workers after a refused or failed request, returns the seconds waited
+        delay = min(MAX_BACKOFF, 2 ** attempt) * (0.5 + random.random() / 2)
+        if headers is not None:
+            delay = self.reset_delay(headers, delay)
+        self.pause(delay)
+        return delay
 
     @staticmethod
-    def __authorize():
-        consumer_key = key["consumer_key"]
-        consumer_secret = key["consumer_secret"]
-        access_token = key["access_token"]
-        access_token_secret = key["access_token_secret"]
+    def reset_delay(headers, default):
+        # seconds until the reset of the rate limit window (epoch seconds in x-rate-limit-reset)
+        try:
+            return max(0.0, float(headers["x-rate-limit-reset"]) - time.time()) + 1
+        except (KeyError, TypeError, ValueError):
+            return default
 
-        auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-        auth.set_access_token(access_token, access_token_secret)
-        api = tweepy.API(auth)
-        return api
 
-    def __retrieve_existing(self):
-        tweets = dict()
-        if path.exists(OUT_DIR + self.outfile):
-            with open(OUT_DIR + self.outfile) as o:
-                tweets = json.load(o)
+class TwitterClient:
+    """
+    Client of the Twitter REST API shared by all the scrapers: the OAuth1 signer is built once, the connections are
+    kept alive in a pool of one connection for each worker and every request goes through the shared rate limiter,
+    retrying the refused and failed ones.
+    """
 
-        return tweets
+    def __init__(self, base_url=BASE_URL, workers=1, limiter=None, retries=MAX_RETRIES, timeout=30):
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.limiter = limiter or RateLimiter()
+        self.retries = retries
+        self.timeout = timeout
+        self.session = Session()
+        self.session.auth = OAuth1(key["consumer_key"], key["consumer_secret"], key["access_token"],
+                                   key["access_token_secret"])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, endpoint, **params):
+        """
+        GET an API endpoint (e.g. statuses/user_timeline.json).
+        :return: the decoded JSON response
+        :raise HTTPError: for the client errors and after the last retry
+        """
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(self.base_url + endpoint, params=params, timeout=self.timeout)
+            except (ConnectionError, Timeout):
+                if attempt == self.retries:
+                    raise
+                self.limiter.backoff(attempt)
+                continue
+
+            self.limiter.update(response.headers)
+            if response.status_code == codes.ok:
+                return response.json()
+            if (response.status_code == codes.too_many_requests or response.status_code >= 500) \
+                    and attempt < self.retries:
+                self.limiter.backoff(attempt, response.headers if response.status_code == 429 else None)
+                continue
+            response.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+class Scraper:
+
+    def __init__(self, handle, multiUsr=False, client=None, store=None, compress=False):
+        self.client = client or TwitterClient()
+        self.handle = handle.lower()
+        if multiUsr:
+            self.outfile = "all_usrs"
+        else:
+            self.outfile = self.handle
+        
+        self.new_tweets = dict()  # tweets not yet stored
+        # append-only store of the tweets, shared by the scrapers of a concurrent multi-user run
+        self.tweets = open_store(self.outfile, compress) if store is None else store
 
     def __check_if_scrapable(self):
-        try:
-            u = self.api.get_user(self.handle)
-            if not u.following and u.protected:
-                exit("Cannot scrape a private user unless this API account is following them.")
-        except tweepy.TweepError as e:
-            if e.api_code == 50:
-                exit("This user does not exist.")
-            else:
-                raise e
-
-    def scrape(self, start, end, retweet):
+        u = get_user(self.client, self.handle)
+        if not u.get("following") and u.get("protected"):
+            raise ScrapeError("Cannot scrape a private user unless this API account is following them.")
+
+    def scrape(self, start, end, retweet, incremental=True):
         self.__check_if_scrapable()
         pprint(g("scraping user"), w("@") + y(self.handle) + g("..."))
         pprint(g("including retweet: ") + w(retweet))
-        pprint(w(len(self.tweets)), g("existing tweets in"), y(self.outfile))
-        self.__quickscrape(start, end, retweet)
+        pprint(w(len(self.tweets)), g("existing tweets in"), y(OUT_DIR + self.outfile))
+        # only the tweets newer than the stored ones are fetched
+        since_id = self.tweets.newest(self.handle) if incremental else None
+        self.__quickscrape(start, end, retweet, since_id)
         
 
 
-    def __quickscrape(self, start, end, retweet):
+    def __quickscrape(self, start, end, retweet, since_id=None):
         # can't use Tweepy, need to call actual API
-        def authorize():
-            return OAuth1(key["consumer_key"], key["consumer_secret"], key["access_token"], key["access_token_secret"])
-
         def form_initial_query():
-            base_url = "https://api.twitter.com/1.1/statuses/user_timeline.json"
-            query = "?screen_name={}&count={}&tweet_mode=extended".format(self.handle, API_LIMIT)
-            return base_url + query
+            query = dict(screen_name=self.handle, count=API_LIMIT, tweet_mode="extended")
+            if since_id is not None:
+                query["since_id"] = since_id
+            return query
 
-        def form_subsequent_query(max_id):
-            base_url = "https://api.twitter.com/1.1/statuses/user_timeline.json"  # don't use the is_retweet field!
-            query = "?screen_name={}&count={}&tweet_mode=extended&max_id={}".format(self.handle, API_LIMIT, max_id)
-            return base_url + query
+        def form_subsequent_query(max_id):  # don't use the is_retweet field!
+            query = form_initial_query()
+            query["max_id"] = max_id
+            return query
 
         def make_request(query):
-            request = get(query, auth=authorize())
-            if request.status_code == codes.ok:
-                return dict((tw["id_str"], tw) for tw in request.json())
-            else:
-                request.raise_for_status()
+            return dict((tw["id_str"], tw) for tw in self.client.get("statuses/user_timeline.json", **query))
+
+        def get_date(tw):  # parse the timestamp as a datetime and remove timezone
+            return datetime.strptime(tw[1]["created_at"], TWEET_DATE_FORMAT).replace(tzinfo=None)
 
         def retrieve_payload():
             recent_payload = make_request(form_initial_query())  # query initial 200 tweets
             all_tweets = dict(recent_payload)
+            pages = 1
 
             for _ in range(ceil(TWEET_LIMIT / API_LIMIT) - 1):  # retrieve the other 3000 tweets
-                oldest_tweet = list(recent_payload.keys())[-1]  # most recently added tweet is oldest
-                recent_payload = make_request(form_subsequent_query(max_id=oldest_tweet))
+                # only an empty page ends the timeline (or the tweets newer than since_id): the deleted and suspended
+                # tweets are removed after count is applied, so a shorter page can come before the end
+                if not recent_payload:
+                    break
+                oldest_tweet = list(recent_payload.items())[-1]  # most recently added tweet is oldest
+                if get_date(oldest_tweet) < start:  # the following pages are all older than start
+                    break
+                # max_id is inclusive, the oldest tweet is not fetched again
+                recent_payload = make_request(form_subsequent_query(max_id=int(oldest_tweet[0]) - 1))
                 all_tweets.update(recent_payload)
+                pages += 1
+            pprint(g("fetched"), w(pages), g("pages of"), y(self.handle) +
+                   (g(" since tweet ") + w(since_id) if since_id is not None else ""))
             return all_tweets
 
         def filter_tweets(tweets, retweet):
-            def get_date(tw):  # parse the timestamp as a datetime and remove timezone
-                return datetime.strptime(tw[1]["created_at"], "%a %b %d %H:%M:%S %z %Y").replace(tzinfo=None)
-
             def is_retweet(tw): # check if is a retweet
                 return "retweeted_status" in tw[1]
 
@@ -146,28 +274,83 @@ class Scraper:
             return tweets_dict
 
         new_tweets = extract_metadata(filter_tweets(retrieve_payload(), retweet))
-        pprint(g("found"), w(len(new_tweets.keys() - self.tweets.keys())), g("new tweets"))
-        self.tweets.update(new_tweets)
+        self.new_tweets = {id: tw for id, tw in new_tweets.items() if id not in self.tweets}
+        pprint(g("found"), w(len(self.new_tweets)), g("new tweets of"), y(self.handle))
 
     def dump_tweets(self):
-        # write out to json
-        if not path.exists(OUT_DIR):
-            makedirs(path.dirname(OUT_DIR), exist_ok=True)
-        with open(OUT_DIR + self.outfile, "w") as o:
-            json.dump(self.tweets, o, indent=4)
-        pprint(g("stored tweets in"), y(OUT_DIR + self.outfile))
+        # append the new tweets to the store, nothing already stored is rewritten
+        stored = self.tweets.append(self.new_tweets.values())
+        self.new_tweets = dict()
+        pprint(g("stored"), w(stored), g("tweets in"), y(OUT_DIR + self.outfile))
 
 
 # HELPER functions
-def get_join_date(handle):
+def open_store(name, compress=False):
+    """
+    Helper method - opens the tweets store in OUT_DIR, importing the tweets of the JSON file written by the previous
+    versions of the scraper (name.json) when the store is created
+    :return: the TweetStore
+    """
+    created = not path.isdir(OUT_DIR + name)
+    store = TweetStore(OUT_DIR + name, compress)
+    if created and path.exists(OUT_DIR + name + ".json"):
+        with open(OUT_DIR + name + ".json") as o:
+            store.append(json.load(o).values())
+        pprint(g("imported"), w(len(store)), g("tweets from"), y(OUT_DIR + name + ".json"))
+    return store
+
+def get_user(client, handle):
+    """
+    Helper method - retrieves the profile of a user
+    :return: the user object of the API
+    """
+    try:
+        return client.get("users/show.json", screen_name=handle)
+    except HTTPError as e:
+        try:
+            errors = e.response.json().get("errors", [])
+        except ValueError:
+            errors = []
+        if any(error.get("code") == 50 for error in errors):
+            raise ScrapeError("This user does not exist.")
+        raise e
+
+def get_join_date(handle, client=None):
     """
     Helper method - checks a user's twitter page for the date they joined
     :return: the "%day %month %year" a user joined
     """
-    baby_scraper = Scraper(handle)
-    join_date = baby_scraper.api.get_user(handle).created_at
+    created_at = get_user(client or TwitterClient(), handle)["created_at"]
+    join_date = datetime.strptime(created_at, TWEET_DATE_FORMAT).replace(tzinfo=None)
     return join_date
 
+def scrape_users(handles, since, until, retweet, client, workers=4, incremental=True, compress=False):
+    """
+    Scrape many users concurrently in a pool of worker threads, sharing the client (its connections pool and rate 
+    limiter) and the all_usrs store, to which the new tweets of each user are appended.
+    :return: the handles that could not be scraped, with the error
+    """
+    tweets = open_store("all_usrs", compress)
+
+    def work(handle):
+        begin = datetime.strptime(since, DATE_FORMAT) if since else get_join_date(handle, client)
+        end = datetime.strptime(until, DATE_FORMAT) if until else datetime.now()
+
+        user = Scraper(handle, multiUsr=True, client=client, store=tweets)
+        user.scrape(begin, end, retweet, incremental)
+        user.dump_tweets()
+
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(work, handle): handle for handle in handles}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (ScrapeError, HTTPError, ConnectionError, Timeout) as e:
+                failed[futures[future]] = e
+                pprint(y(futures[future]) + ": " + str(e))
+    return failed
+
 def pprint(*arguments):  # output formatting
     print(bw("["), *arguments, bw("]"))
 
@@ -181,6 +364,13 @@ if __name__ == "__main__":
     parser.add_argument("--since", help="Get Tweets after this date (Example: 2010-01-01).")
     parser.add_argument("--until", help="Get Tweets before this date (Example: 2018-12-07).")
     parser.add_argument("--retweet", help="Get Tweets retweetted (Example: True or False). The default is False.")
+    parser.add_argument("--workers", type=int, default=4, help="Users scraped concurrently with --file. The default is 4.")
+    parser.add_argument("--rate", type=int, default=RATE_LIMIT,
+                        help="Requests allowed in each 15 minutes window. The default is %d." % RATE_LIMIT)
+    parser.add_argument("--base-url", default=BASE_URL, help="API base URL (e.g. a local stub of the API).")
+    parser.add_argument("--compress", action="store_true", help="Gzip the new shards of the tweets store.")
+    parser.add_argument("--full", action="store_true",
+                        help="Fetch the whole timelines, not only the tweets newer than the stored ones.")
     args = parser.parse_args()
 
     if args.retweet is not None:
@@ -196,26 +386,33 @@ if __name__ == "__main__":
         # multi-user search
         if args.file is not None:
             try:
-                users = pd.read_csv(args.file, header=None)
-            except:
+                with open(args.file, newline='') as f:
+                    users = [row[0] for row in csv.reader(f) if row]
+            except OSError:
+                users = []
+            if not users:
                 exit("This file does not exist or is empty.")
             
-            for usr in users[0]:
-                if not usr.startswith("#"):
-                    begin = datetime.strptime(args.since, DATE_FORMAT) if args.since else get_join_date(usr)
-                    end = datetime.strptime(args.until, DATE_FORMAT) if args.until else datetime.now()
-
-                    user = Scraper(usr, multiUsr=True)
-                    user.scrape(begin, end, retweet)
-                    user.dump_tweets()
+            handles = [usr for usr in users if not usr.startswith("#")]
+            client = TwitterClient(args.base_url, args.workers, RateLimiter(args.rate))
+            start = time.time()
+            failed = scrape_users(handles, args.since, args.until, retweet, client, args.workers, not args.full,
+                                  args.compress)
+            pprint(g("scraped"), w(len(handles) - len(failed)), g("users in"), w("%.1fs" % (time.time() - start)))
+            if failed:
+                exit("Failed users: " + ", ".join(failed))
         else:   
             print("ERROR: No username or usernames file given, terminating.")
             sys.exit()
     # single user search
     else: 
-        begin = datetime.strptime(args.since, DATE_FORMAT) if args.since else get_join_date(args.username)
-        end = datetime.strptime(args.until, DATE_FORMAT) if args.until else datetime.now()
+        client = TwitterClient(args.base_url, 1, RateLimiter(args.rate))
+        try:
+            begin = datetime.strptime(args.since, DATE_FORMAT) if args.since else get_join_date(args.username, client)
+            end = datetime.strptime(args.until, DATE_FORMAT) if args.until else datetime.now()
 
-        user = Scraper(args.username)
-        user.scrape(begin, end, retweet)
+            user = Scraper(args.username, client=client, compress=args.compress)
+            user.scrape(begin, end, retweet, not args.full)
+        except ScrapeError as e:
+            exit(str(e))
         user.dump_tweets()
\ No newline at end of file
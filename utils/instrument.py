@@ -0,0 +1,166 @@
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import time
+import tracemalloc
+from threading import Lock
+
+# Comma separated list of the enabled features: timers (named timers and counters), cprofile and tracemalloc ('1' is
+# timers only), e.g. IR_INSTRUMENT=timers,tracemalloc
+ENV = 'IR_INSTRUMENT'
+# File in which the summary is dumped at exit (default is instrument.json)
+ENV_OUT = 'IR_INSTRUMENT_OUT'
+
+enabled = False
+timers = {}
+counters = {}
+lock = Lock()
+profiler = None
+registered = False
+
+
+class NullTimer:
+    '''
+    Timer of the disabled instrumentation, a shared context manager that does nothing.
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    '''
+    Context manager adding its elapsed time to the named timer.
+    '''
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with lock:
+            stats = timers.get(self.name)
+            if stats is None:
+                timers[self.name] = [1, elapsed, elapsed]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+        return False
+
+
+def timer(name):
+    '''
+    Time a block of code under a name, the calls, total and maximum time of each name are reported by summary:
+
+        with timer('parser.tag'):
+            ...
+
+    When the instrumentation is disabled a shared no-op context manager is returned.
+    '''
+    return Timer(name) if enabled else NULL_TIMER
+
+
+def count(name, n=1):
+    '''
+    Add n to the named counter (nothing when the instrumentation is disabled).
+    '''
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + n
+
+
+def configure(features=None):
+    '''
+    Enable the instrumentation features, by default the ones in the IR_INSTRUMENT environment variable (nothing if
+    unset). cProfile and tracemalloc start at once and run until the exit, when the summary is dumped.
+    :param features: comma separated list of timers, cprofile and tracemalloc ('1' for timers only, '' to disable);
+    '''
+    global enabled, profiler, registered
+    features = os.environ.get(ENV, '') if features is None else features
+    features = {f.strip().lower() for f in features.split(',') if f.strip() and f.strip() != '0'}
+    enabled = bool(features)
+    if 'cprofile' in features and profiler is None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if 'tracemalloc' in features and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if enabled and not registered:
+        atexit.register(dump)
+        registered = True
+
+
+def reset():
+    '''
+    Clear the timers and the counters.
+    '''
+    with lock:
+        timers.clear()
+        counters.clear()
+
+
+def summary(top=20):
+    '''
+    Summary of the instrumentation: for each timer the calls, total, mean and maximum time in milliseconds, the
+    counters and, when enabled, the top functions by cumulative time (cProfile) and the current and peak traced
+    memory with the top allocation sites (tracemalloc).
+    :param top: number of functions and allocation sites reported;
+    :return: JSON serializable dictionary
+    '''
+    with lock:
+        result = {
+            'timers': {name: {'calls': calls, 'total_ms': total * 1000, 'mean_ms': total * 1000 / calls,
+                              'max_ms': longest * 1000}
+                       for name, (calls, total, longest) in sorted(timers.items())},
+            'counters': dict(sorted(counters.items()))
+        }
+
+    if profiler is not None:
+        profiler.disable()
+        stats = pstats.Stats(profiler).stats
+        profiler.enable()
+        functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+        result['cprofile'] = [{'function': '%s:%d(%s)' % key, 'calls': calls, 'tottime_s': tottime,
+                               'cumtime_s': cumtime} for key, (_, calls, tottime, cumtime, _) in functions]
+
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        sites = tracemalloc.take_snapshot().statistics('lineno')[:top]
+        result['tracemalloc'] = {'current_mb': current / 2 ** 20, 'peak_mb': peak / 2 ** 20,
+                                 'top': [{'site': str(s.traceback), 'size_mb': s.size / 2 ** 20, 'count': s.count}
+                                         for s in sites]}
+
+    return result
+
+
+def dump(path=None):
+    '''
+    Write the summary in a JSON file, with cProfile enabled the raw profile is also written in path.prof (readable
+    with pstats or snakeviz).
+    :param path: output file (default is IR_INSTRUMENT_OUT or instrument.json);
+    :return: the summary
+    '''
+    path = path or os.environ.get(ENV_OUT, 'instrument.json')
+    result = summary()
+    with open(path, 'w', encoding='utf-8') as o:
+        json.dump(result, o, indent=1)
+    if profiler is not None:
+        profiler.dump_stats(path + '.prof')
+    return result
+
+
+configure()
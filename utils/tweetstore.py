@@ -0,0 +1,139 @@
+import gzip
+import json
+import os
+import re
+from threading import Lock
+
+# shards are numbered in the order they are written, the compressed ones end with .gz
+SHARD_RE = re.compile(r'^shard-(\d+)\.jsonl(\.gz)?$')
+INDEX_FILE = 'index.tsv'
+SHARD_SIZE = 64 << 20
+
+
+def shards(path):
+    '''
+    Shard files of a store directory, in the order they were written.
+    '''
+    names = [(int(m.group(1)), name) for name in os.listdir(path) for m in [SHARD_RE.match(name)] if m]
+    return [os.path.join(path, name) for _, name in sorted(names)]
+
+
+def open_shard(file, mode='rt'):
+    '''
+    Open a JSON lines shard, gzip compressed if its name ends with .gz.
+    '''
+    if file.endswith('.gz'):
+        return gzip.open(file, mode, encoding='utf-8')
+    return open(file, mode, encoding='utf-8')
+
+
+def iter_store(path):
+    '''
+    Yields the (tweet_id, tweet) pairs of a store directory, shard after shard. A tweet written twice (e.g. by a run
+    interrupted after writing a shard and before updating the index) is yielded only once.
+    '''
+    seen = set()
+    for file in shards(path):
+        with open_shard(file) as f:
+            for line in f:
+                if line.strip():
+                    tweet = json.loads(line)
+                    if tweet['tweet_id'] not in seen:
+                        seen.add(tweet['tweet_id'])
+                        yield tweet['tweet_id'], tweet
+
+
+def store_stat(path):
+    '''
+    Total size and latest modification time of the shards of a store directory, which change with every append.
+    '''
+    stats = [os.stat(file) for file in shards(path)]
+    return sum(s.st_size for s in stats), max((s.st_mtime for s in stats), default=0.0)
+
+
+class TweetStore:
+    '''
+    Append-only store of tweets in a directory of JSON lines shards (shard-00000.jsonl, shard-00001.jsonl.gz when
+    compressed, ...) readable with utils.iter_tweets like a single tweets file.
+    Each tweet is stored once: the index (index.tsv) with the id and the screen name of the stored tweets is loaded
+    when the store is opened and the tweets already stored are skipped, so a write costs only the new tweets and
+    nothing already stored is read or rewritten. A new shard is started when the last one reaches shard_size bytes.
+    The store can be shared by many threads.
+    :param path: store directory, created if missing;
+    :param compress: gzip the shards started by this store (the existing ones keep their format);
+    :param shard_size: size in bytes after which a new shard is started;
+    '''
+
+    def __init__(self, path, compress=False, shard_size=SHARD_SIZE):
+        self.path = path
+        self.compress = compress
+        self.shard_size = shard_size
+        self.ids = set()
+        self.newest_ids = {}
+        self.lock = Lock()
+        os.makedirs(path, exist_ok=True)
+
+        index = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index):
+            with open(index, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        self.index(*line.rstrip('\n').split('\t'))
+        else:
+            # store without index (e.g. shards copied from another store), the index is rebuilt from the shards
+            with open(index, 'w', encoding='utf-8') as o:
+                for tweet_id, tweet in iter_store(path):
+                    o.write('%s\t%s\n' % (tweet_id, tweet['screen_name'].lower()))
+                    self.index(tweet_id, tweet['screen_name'].lower())
+
+    def index(self, tweet_id, screen_name):
+        self.ids.add(tweet_id)
+        if int(tweet_id) > self.newest_ids.get(screen_name, -1):
+            self.newest_ids[screen_name] = int(tweet_id)
+
+    def __contains__(self, tweet_id):
+        return tweet_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter_store(self.path)
+
+    def newest(self, screen_name):
+        '''
+        Id of the most recent stored tweet of a user, None if there are none.
+        '''
+        return self.newest_ids.get(screen_name.lower())
+
+    def shard(self):
+        # last shard, or a new one if it is full or in the other format
+        files = shards(self.path)
+        if files and os.path.getsize(files[-1]) < self.shard_size and files[-1].endswith('.gz') == self.compress:
+            return files[-1]
+        number = int(SHARD_RE.match(os.path.basename(files[-1])).group(1)) + 1 if files else 0
+        return os.path.join(self.path, 'shard-%05d.jsonl%s' % (number, '.gz' if self.compress else ''))
+
+    def append(self, tweets):
+        '''
+        Append the tweets not already stored to the last shard, then add them to the index.
+        :param tweets: iterable of tweets, each with its tweet_id and screen_name;
+        :return: number of tweets written
+        '''
+        with self.lock:
+            new = {}
+            for tweet in tweets:
+                if tweet['tweet_id'] not in self.ids:
+                    new.setdefault(tweet['tweet_id'], tweet)
+            if not new:
+                return 0
+
+            with open_shard(self.shard(), 'at') as o:
+                o.write(''.join(json.dumps(tweet) + '\n' for tweet in new.values()))
+            with open(os.path.join(self.path, INDEX_FILE), 'a', encoding='utf-8') as o:
+                o.write(''.join('%s\t%s\n' % (tweet_id, tweet['screen_name'].lower())
+                                for tweet_id, tweet in new.items()))
+            for tweet_id, tweet in new.items():
+                self.index(tweet_id, tweet['screen_name'].lower())
+
+        return len(new)
@@ -1,3 +1,12 @@
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+from utils.tweetstore import shards, open_shard, iter_store, store_stat
+
 # OUTPUT COLORS
 RESET = "\033[0m"
 bw = lambda s: "\033[1m\033[37m" + str(s) + RESET  # bold white
@@ -8,4 +17,203 @@ r = lambda s: "\033[31m" + str(s) + RESET  # red
 
 def pprint(*arguments):
     # output formatting helper function
-    print(bw("["), *arguments, bw("]"))
\ No newline at end of file
+    print(bw("["), *arguments, bw("]"))
+
+def printError(res):
+    # prints the error of a failed query of a multi-search
+    error = res['error']
+    print(r("ERROR: ") + str(error.get('reason', error) if isinstance(error, dict) else error) + "\n")
+
+def printRes(res):
+    # prints the hits of a search result (or its error)
+    if 'error' in res:
+        printError(res)
+        return
+    for doc in res['hits']['hits']:
+        print(y("Tweet ID: ") + doc['_id'] + 
+                g("\nUser: ") + doc['_source']['user_name'] +
+                g("\nCreated at: ") + doc['_source']['date'] +
+                g("\nText: ") + doc['_source']['text'] + 
+                r("\nScore: ") + str(doc['_score']) + "\n")
+
+def printResAdv(res):
+    # prints the personalized hits of each user (or the error of the search)
+    if 'error' in res:
+        printError(res)
+        return
+    for usr in res:
+        pprint('Personalized results for user: ' + usr)
+        for doc in res[usr]['news']:
+            print(y("Tweet ID: ") + doc['_id'] + 
+                    g("\nUser: ") + doc['_source']['user_name'] +
+                    g("\nCreated at: ") + doc['_source']['date'] +
+                    g("\nText: ") + doc['_source']['text'] + 
+                    r("\nPersonalized score: ") + str(doc['new_score']) + "\n")
+
+class LRUCache:
+    '''
+    Dictionary bounded to maxsize entries, when full the least recently used entry is evicted. With ttl the entries 
+    expire ttl seconds after they were set. The hits and misses of get are counted.
+    '''
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data[key] = (value, None if self.ttl is None else time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        entry = self.data.get(key)
+        return entry is not None and (entry[1] is None or entry[1] >= time.monotonic())
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses, 
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+def fingerprint(obj):
+    '''
+    Content hash of a JSON serializable object, independent from the keys order.
+    '''
+    return hashlib.blake2b(json.dumps(obj, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def file_digest(file, chunk_size=1 << 20):
+    '''
+    Content hash of a file, or of the shards of a tweets store directory.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    for name in shards(file) if os.path.isdir(file) else [file]:
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stat(file):
+    '''
+    Size and modification time of a file, or of the shards of a tweets store directory (total size and latest time).
+    '''
+    if os.path.isdir(file):
+        return store_stat(file)
+    stat = os.stat(file)
+    return stat.st_size, stat.st_mtime
+
+
+def iter_tweets(file, chunk_size=1 << 16):
+    '''
+    Yields the (tweet_id, tweet) pairs of a tweets file, reading it incrementally instead of loading it in memory.
+    Supported formats are the JSON object with tweets ids as keys, JSON lines (.jsonl, or gzip compressed .jsonl.gz) 
+    with a tweet object, containing its tweet_id, on each line and the sharded store directory written by the 
+    scraper (see utils/tweetstore.py).
+    '''
+    if os.path.isdir(file):
+        yield from iter_store(file)
+        return
+
+    if file.endswith(('.jsonl', '.jsonl.gz')):
+        with open_shard(file) as f:
+            for line in f:
+                if line.strip():
+                    tweet = json.loads(line)
+                    yield tweet['tweet_id'], tweet
+        return
+
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'\s*')
+
+    with open(file, encoding='utf-8') as f:
+        buf = f.read(chunk_size)
+        pos = 0
+        eof = not buf
+
+        def skip(pos):
+            # skip whitespaces, reading more data if they reach the end of the buffer
+            nonlocal buf, eof
+            pos = whitespace.match(buf, pos).end()
+            while pos == len(buf) and not eof:
+                more = f.read(chunk_size)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = whitespace.match(buf, 0).end()
+            return pos
+
+        def decode(pos):
+            # decode the JSON value at pos, reading more data while it is incomplete
+            nonlocal buf, eof
+            while True:
+                try:
+                    return decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    more = f.read(chunk_size)
+                    eof = not more
+                    buf = buf[pos:] + more
+                    pos = 0
+
+        def expect(pos, chars):
+            pos = skip(pos)
+            if pos >= len(buf) or buf[pos] not in chars:
+                raise json.JSONDecodeError("Expecting one of %r" % chars, buf, pos)
+            return pos + 1
+
+        pos = expect(pos, '{')
+        pos = skip(pos)
+        if buf[pos:pos + 1] == '}':
+            return
+
+        while True:
+            key, pos = decode(skip(pos))
+            pos = expect(pos, ':')
+            tweet, pos = decode(skip(pos))
+            yield key, tweet
+
+            pos = expect(pos, ',}')
+            if buf[pos - 1] == '}':
+                return
+            # drop the already decoded data from the buffer
+            if pos > chunk_size:
+                buf = buf[pos:]
+                pos = 0
+
+
+def to_jsonl(file, out):
+    '''
+    Converts a tweets JSON file (tweets ids as keys) in the equivalent JSON lines file.
+    '''
+    with open(out, 'w', encoding='utf-8') as o:
+        for tweet_id, tweet in iter_tweets(file):
+            o.write(json.dumps(dict(tweet, tweet_id=tweet_id)) + '\n')